@@ -0,0 +1,73 @@
+"""
+Memory used by the file system model, in bytes per directory entry.
+
+Measures parsed listings (names and type flags only), the File/Directory objects created for the entries,
+and a cache of many listings that share most of their names, with and without interned names.
+
+Usage: python -m benchmarks.fs_memory [--entries N] [--dirs D]
+"""
+import argparse
+import tracemalloc
+from typing import Dict
+
+from src.file_system.dir_cache import DirectoryCache
+from src.file_system.fs_parser import FSParser
+
+
+def encoded_listing(path: str, entries: int) -> bytes:
+    children = ''.join(f'\x00{"fd"[i % 2]}entry_{i:07d}.txt' for i in range(entries))
+    return f'd{path}{children}'.encode('utf-8')
+
+
+def measure(build) -> int:
+    """
+    Bytes still allocated by the result of build(), once it returns.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return allocated
+
+
+def cache_listings(payloads, intern_names: bool) -> DirectoryCache:
+    cache = DirectoryCache(max_entries=len(payloads), max_bytes=1 << 40, intern_names=intern_names)
+    for payload in payloads:
+        directory = FSParser.parse(payload)
+        cache.put(directory.name, directory, None, len(payload))
+    return cache
+
+
+def run(entries: int, dirs: int) -> Dict[str, float]:
+    """
+    :return: Dict[str, float] - bytes per entry, by measured structure.
+    """
+    payload = encoded_listing('/bench', entries)
+    listing = FSParser.parse(payload).children
+    results = {
+        'parsed listing': measure(lambda: FSParser.parse(payload)) / entries,
+        'component objects': measure(lambda: list(listing)) / entries,
+    }
+    # Directories of the same project tend to share most entry names
+    small = max(1, entries // dirs)
+    payloads = [encoded_listing(f'/bench/{i}', small) for i in range(dirs)]
+    total = small * dirs
+    results['cached listings'] = measure(lambda: cache_listings(payloads, intern_names=False)) / total
+    results['cached listings, interned'] = measure(lambda: cache_listings(payloads, intern_names=True)) / total
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--entries', type=int, default=100_000, help='entries per listing')
+    arg_parser.add_argument('--dirs', type=int, default=20, help='listings held by the cache')
+    args = arg_parser.parse_args()
+
+    for name, per_entry in run(args.entries, args.dirs).items():
+        print(f'{name:<28}{per_entry:8.1f} bytes/entry')
+
+
+if __name__ == '__main__':
+    main()
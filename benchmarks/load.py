@@ -0,0 +1,345 @@
+"""
+End-to-end load generator: drives clients against a server through a proxy that degrades the network.
+
+Each client keeps a number of commands outstanding (a closed loop), picked at random from a mix of
+OPEN, SAVE and DELETE commands. Datagrams go through a local UDP proxy that drops, delays and reorders them,
+so the retransmission logic and the queueing of the clients are exercised as on a real network.
+Unless --server is given, a FileSystemServer serving a temporary directory is started as the backend.
+Reports commands per second, failures, retransmissions and latency percentiles, optionally as JSON.
+
+Usage: python -m benchmarks.load [--clients N] [--concurrency N] [--duration SECONDS] [--mix open=70,save=20,delete=10]
+                                 [--loss P] [--latency MS] [--jitter MS] [--reorder P] [--server HOST:PORT]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.client.client import Client
+from src.client.client_log import ClientLog
+from src.client.command import DeleteCommand, OpenCommand, SaveCommand
+from src.client.command_queue import CommandQueue
+from src.client.metrics import PrometheusText
+from src.fs_server import FileSystemServer
+
+Peer = Tuple[str, int]
+
+
+class LossyProxy:
+    """
+    UDP proxy between clients and a server that drops each datagram with probability loss, delays it by
+    latency +/- jitter seconds and, with probability reorder, holds it back long enough for later datagrams
+    to overtake it. Every client gets a socket of its own towards the server, so replies find their way back.
+    """
+
+    def __init__(self, target: Peer, loss: float = 0.0, latency: float = 0.0, jitter: float = 0.0,
+                 reorder: float = 0.0, reorder_delay: float = None, seed: int = None):
+        self.target = target
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = 2 * (latency + jitter) + 0.005 if reorder_delay is None else reorder_delay
+        self.random = random.Random(seed)
+        self.address: Optional[Peer] = None
+        self.upstream: Dict[Peer, socket.socket] = {}
+        self.stats = {'forwarded': 0, 'dropped': 0, 'reordered': 0}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.listener: Optional[socket.socket] = None
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self, ip: str = '127.0.0.1'):
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+        self.listener = socket.socket(family, socket.SOCK_DGRAM)
+        self.listener.bind((ip, 0))
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()[:2]
+        self.loop = asyncio.new_event_loop()
+        self.loop.add_reader(self.listener, self.on_client_datagram)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='lossy-proxy', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        for sock in (self.listener, *self.upstream.values()):
+            self.loop.remove_reader(sock)
+            sock.close()
+        self.loop.close()
+
+    def on_client_datagram(self):
+        try:
+            data, peer = self.listener.recvfrom(Client.MSG_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        sock = self.upstream.get(peer)
+        if sock is None:
+            family = socket.AF_INET6 if ':' in self.target[0] else socket.AF_INET
+            sock = self.upstream[peer] = socket.socket(family, socket.SOCK_DGRAM)
+            sock.connect(self.target)
+            sock.setblocking(False)
+            self.loop.add_reader(sock, self.on_server_datagram, sock, peer)
+        self.forward(lambda: sock.send(data))
+
+    def on_server_datagram(self, sock: socket.socket, peer: Peer):
+        try:
+            data = sock.recv(Client.MSG_BUFFER_SIZE)
+        except OSError:
+            # Nothing to read, or ICMP port unreachable if the server is down
+            return
+        self.forward(lambda: self.listener.sendto(data, peer))
+
+    def forward(self, send: Callable):
+        if self.random.random() < self.loss:
+            self.stats['dropped'] += 1
+            return
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        if self.random.random() < self.reorder:
+            delay += self.reorder_delay
+            self.stats['reordered'] += 1
+        self.stats['forwarded'] += 1
+        if delay:
+            self.loop.call_later(delay, LossyProxy.send, send)
+        else:
+            LossyProxy.send(send)
+
+    @staticmethod
+    def send(send: Callable):
+        try:
+            send()
+        except OSError:
+            pass
+
+
+class LoadDriver:
+    """
+    Keeps concurrency commands outstanding on one client until stopped, and records their latency.
+    A command completes when its callback is called and fails when its failure callback is.
+    Latencies include the time spent in the command queue.
+    """
+
+    def __init__(self, index: int, client: Client, mix: Dict[str, int], concurrency: int, seed: int = None):
+        self.index = index
+        self.client = client
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.concurrency = concurrency
+        self.random = random.Random(seed)
+        self.directory = f'/load-{index}'
+        self.saved: List[str] = []
+        self.next_file = 0
+        self.is_running = False
+        self.outstanding = 0
+        self.lock = threading.Lock()
+        self.drained = threading.Event()
+        # (kind, latency in seconds, succeeded)
+        self.results: List[Tuple[str, float, bool]] = []
+
+    def start(self):
+        self.is_running = True
+        for _ in range(self.concurrency):
+            self.issue()
+
+    def stop(self):
+        with self.lock:
+            self.is_running = False
+            if not self.outstanding:
+                self.drained.set()
+
+    def issue(self):
+        with self.lock:
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            if kind == 'delete' and not self.saved:
+                kind = 'save'
+            saved = None
+            if kind == 'open':
+                cmd = OpenCommand(self.directory)
+            elif kind == 'save':
+                saved = f'{self.directory}/file-{self.next_file}'
+                self.next_file += 1
+                cmd = SaveCommand(saved, 'x' * self.random.choice((16, 256, 2048)))
+            else:
+                cmd = DeleteCommand(self.saved.pop(self.random.randrange(len(self.saved))))
+            self.outstanding += 1
+        start = time.perf_counter()
+        cmd.callback = lambda *_: self.complete(kind, start, True, saved)
+        cmd.failure_callback = lambda _: self.complete(kind, start, False)
+        self.client.msg_queue.put(cmd)
+
+    def complete(self, kind: str, start: float, succeeded: bool, saved: str = None):
+        with self.lock:
+            self.results.append((kind, time.perf_counter() - start, succeeded))
+            if succeeded and saved:
+                # Only files known to exist are deleted
+                self.saved.append(saved)
+            self.outstanding -= 1
+            running = self.is_running
+            if not running and not self.outstanding:
+                self.drained.set()
+        if running:
+            self.issue()
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+
+    def at(fraction: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+    return {'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99), 'max_ms': latencies[-1] * 1000,
+            'mean_ms': statistics.mean(latencies) * 1000}
+
+
+def run(args: argparse.Namespace) -> dict:
+    root = server = None
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        target = Client.RESOLVER.resolve(host.strip('[]'), int(port))[0][1][:2]
+    else:
+        root = tempfile.mkdtemp(prefix='coap-load-')
+        server = FileSystemServer(root, port=0, workers=args.workers)
+        server.start()
+        target = (server.ip, server.port)
+    ClientLog.configure(path=args.log_file, level=logging.getLevelName(args.log_level))
+    proxy = LossyProxy(target, args.loss, args.latency / 1000, args.jitter / 1000, args.reorder, seed=args.seed)
+    proxy.start()
+    clients, drivers, threads = [], [], []
+    mix = parse_mix(args.mix)
+    try:
+        for index in range(args.clients):
+            client = Client(proxy.address[0], proxy.address[1], msg_queue=CommandQueue(),
+                            max_in_flight=args.max_in_flight, ack_timeout=args.ack_timeout)
+            # Wait for the responses of every command, so that each one has a latency
+            client.confirmation_required = True
+            client.metrics.registry.add_label('client', str(index))
+            if root is not None:
+                os.makedirs(os.path.join(root, f'load-{index}'), exist_ok=True)
+            seed = None if args.seed is None else args.seed + index
+            drivers.append(LoadDriver(index, client, mix, args.concurrency, seed))
+            threads.append(threading.Thread(target=client.run, daemon=True))
+            clients.append(client)
+        for thread in threads:
+            thread.start()
+        start = time.perf_counter()
+        for driver in drivers:
+            driver.start()
+        time.sleep(args.duration)
+        for driver in drivers:
+            driver.stop()
+        for driver in drivers:
+            driver.drained.wait(args.drain_timeout)
+        elapsed = time.perf_counter() - start
+        if args.metrics:
+            with open(args.metrics, 'w') as file:
+                file.write(PrometheusText.render(client.metrics.registry for client in clients))
+    finally:
+        for client in clients:
+            client.is_running = False
+        for thread in threads:
+            thread.join()
+        for client in clients:
+            client.close()
+        proxy.stop()
+        if server:
+            server.stop()
+        if root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    results = [result for driver in drivers for result in driver.results]
+    by_kind = {}
+    for kind in mix:
+        latencies = [latency for k, latency, ok in results if k == kind and ok]
+        by_kind[kind] = {'completed': len(latencies), 'failed': sum(1 for k, _, ok in results if k == kind and not ok),
+                         **percentiles(latencies)}
+    completed = [latency for _, latency, ok in results if ok]
+    return {
+        'config': vars(args),
+        'elapsed_s': elapsed,
+        'completed': len(completed),
+        'failed': len(results) - len(completed),
+        'outstanding': sum(driver.outstanding for driver in drivers),
+        'cmds_per_sec': len(completed) / elapsed,
+        'retransmissions': sum(client.retransmissions for client in clients),
+        'latency': percentiles(completed),
+        'by_kind': by_kind,
+        'proxy': dict(proxy.stats),
+        'log_records_dropped': ClientLog.dropped(),
+    }
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """
+    Parses a command mix such as 'open=70,save=20,delete=10'.
+
+    :raises ValueError: if a command is unknown or no command has a positive weight.
+    """
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in ('open', 'save', 'delete'):
+            raise ValueError(f'Unknown command in mix: {kind}')
+        weights[kind] = int(weight or 1)
+    if not any(weight > 0 for weight in weights.values()):
+        raise ValueError('The mix needs at least one command with a positive weight')
+    if 'delete' in weights and 'save' not in weights:
+        # Only files saved by the driver are deleted, it saves one whenever there is nothing to delete
+        weights['save'] = 0
+    return weights
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--clients', type=int, default=4, help='number of clients, each with its own socket')
+    arg_parser.add_argument('--concurrency', type=int, default=4, help='commands outstanding per client')
+    arg_parser.add_argument('--max-in-flight', type=int, default=4, help='requests pipelined by each client')
+    arg_parser.add_argument('--duration', type=float, default=10.0, help='seconds spent issuing commands')
+    arg_parser.add_argument('--drain-timeout', type=float, default=30.0,
+                            help='seconds to wait for outstanding commands at the end')
+    arg_parser.add_argument('--mix', default='open=70,save=20,delete=10', help='relative weights of the commands')
+    arg_parser.add_argument('--loss', type=float, default=0.0, help='probability of dropping a datagram')
+    arg_parser.add_argument('--latency', type=float, default=0.0, help='one-way delay in milliseconds')
+    arg_parser.add_argument('--jitter', type=float, default=0.0, help='random delay variation in milliseconds')
+    arg_parser.add_argument('--reorder', type=float, default=0.0, help='probability of reordering a datagram')
+    arg_parser.add_argument('--ack-timeout', type=float, default=None, help='initial retransmission timeout')
+    arg_parser.add_argument('--server', help='HOST:PORT of a running server, instead of a local FileSystemServer')
+    arg_parser.add_argument('--workers', type=int, default=4, help='worker threads of the local server')
+    arg_parser.add_argument('--seed', type=int, help='seed for reproducible command mixes and network faults')
+    arg_parser.add_argument('--log-level', default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                            help='level of the client log, INFO logs every message')
+    arg_parser.add_argument('--log-file', default=os.path.join(tempfile.gettempdir(), 'coap_load_client_log.txt'),
+                            help='client log file, in the temporary directory by default')
+    arg_parser.add_argument('--metrics', help='file the client metrics are written to, in the Prometheus text format')
+    arg_parser.add_argument('--output', help='JSON file the report is written to')
+    args = arg_parser.parse_args()
+
+    report = run(args)
+    print(f'{report["completed"]} commands in {report["elapsed_s"]:.1f}s: {report["cmds_per_sec"]:,.1f} cmds/s, '
+          f'{report["failed"]} failed, {report["outstanding"]} unfinished, '
+          f'{report["retransmissions"]} retransmissions')
+    print(f'proxy: {report["proxy"]["forwarded"]} forwarded, {report["proxy"]["dropped"]} dropped, '
+          f'{report["proxy"]["reordered"]} reordered')
+    print(f'\n{"command":<10}{"done":>8}{"failed":>8}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for kind, stats in (*report['by_kind'].items(), ('all', {**report['latency'], 'completed': report['completed'],
+                                                            'failed': report['failed']})):
+        print(f'{kind:<10}{stats["completed"]:>8}{stats["failed"]:>8}' + ''.join(
+            f'{stats.get(key, 0.0):>10.1f}' for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms')))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'\nReport written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
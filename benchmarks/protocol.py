@@ -0,0 +1,153 @@
+"""
+Throughput, latency and allocations of the protocol layer.
+
+Measures encoding (CoAP.wrap, CoAP.pack_into, CoAP.build_header) and decoding (CoAPMessage.from_bytes) of messages
+with payloads of several sizes, CoAPMessage.logging_format, and FSParser.parse of listings of 10 to 1M entries.
+For every case, reports operations per second, p50/p99 latency and the bytes allocated by one operation.
+The memory used by the file system model (see fs_memory) is included too.
+Results are written as JSON, and compared with the results of an earlier revision if given.
+
+Usage: python -m benchmarks.protocol [--output FILE] [--compare FILE] [--max-entries N] [--min-time SECONDS]
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from benchmarks import fs_memory
+from src.client.coap_message import CoAP, CoAPMessage
+from src.file_system.fs_parser import FSParser
+
+PAYLOAD_SIZES = (0, 64, 1024, 16384)
+LISTING_SIZES = (10, 100, 1_000, 10_000, 100_000, 1_000_000)
+# Operations shorter than this are timed in batches, since the timer itself takes a fraction of a microsecond
+MIN_SAMPLE_TIME = 50e-6
+MAX_SAMPLES = 1000
+
+
+def sample_message(payload_size: int) -> CoAPMessage:
+    """
+    A response as the client typically receives it: token, ETag and Block2 options, text payload.
+    """
+    return CoAPMessage(payload='x' * payload_size, msg_type=CoAP.TYPE_ACK, msg_class=CoAP.CLASS_SUCCESS,
+                       msg_code=CoAP.CODE_CONTENT, msg_id=0x1234, token_length=4, token=0xCAFEBABE,
+                       options=[(CoAP.OPTION_ETAG, b'\x01\x02\x03\x04'), (CoAP.OPTION_BLOCK2, b'\x0e')])
+
+
+def allocated_bytes(operation: Callable) -> int:
+    """
+    Peak memory allocated while running the operation once.
+    """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    operation()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - before
+
+
+def benchmark(operation: Callable, min_time: float) -> Dict[str, float]:
+    """
+    Runs the operation repeatedly for at least min_time seconds.
+
+    :return: Dict[str, float] - operations per second, p50/p99 latency in microseconds and bytes allocated.
+    """
+    # Warm-up, which also tells how many operations make up a sample
+    start = time.perf_counter()
+    operation()
+    batch = max(1, int(MIN_SAMPLE_TIME / max(time.perf_counter() - start, 1e-9)))
+    samples: List[float] = []
+    total_time = 0.0
+    while (total_time < min_time or len(samples) < 3) and len(samples) < MAX_SAMPLES:
+        start = time.perf_counter()
+        for _ in range(batch):
+            operation()
+        elapsed = time.perf_counter() - start
+        samples.append(elapsed / batch)
+        total_time += elapsed
+    samples.sort()
+    return {
+        'ops_per_sec': len(samples) * batch / total_time,
+        'p50_us': statistics.median(samples) * 1e6,
+        'p99_us': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6,
+        'alloc_bytes': allocated_bytes(operation),
+    }
+
+
+def run(max_entries: int, min_time: float) -> Dict[str, Dict[str, float]]:
+    results = {}
+    buffer = bytearray(65535)
+    for size in PAYLOAD_SIZES:
+        msg = sample_message(size)
+        encoded = CoAP.wrap(msg)
+        view = memoryview(encoded)
+        results[f'wrap/{size}B'] = benchmark(lambda: CoAP.wrap(msg), min_time)
+        results[f'pack_into/{size}B'] = benchmark(lambda: CoAP.pack_into(msg, buffer), min_time)
+        results[f'from_bytes/{size}B'] = benchmark(lambda: CoAPMessage.from_bytes(view), min_time)
+        results[f'logging_format/{size}B'] = benchmark(lambda: msg.logging_format(encoded), min_time)
+    results['build_header'] = benchmark(lambda: CoAP.build_header(sample_message(0)), min_time)
+    for entries in LISTING_SIZES:
+        if entries > max_entries:
+            break
+        payload = fs_memory.encoded_listing('/bench', entries)
+        results[f'parse/{entries}'] = benchmark(lambda: FSParser.parse(payload), min_time)
+    return results
+
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]):
+    print(f'\n{"case":<24}{"ops/s change":>14}{"p99 change":>14}{"alloc change":>14}')
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        changes = [result[key] / old[key] - 1 if old[key] else 0.0 for key in ('ops_per_sec', 'p99_us')]
+        alloc_change = result['alloc_bytes'] - old['alloc_bytes']
+        print(f'{name:<24}{changes[0]:>+14.1%}{changes[1]:>+14.1%}{alloc_change:>+13d}B')
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to')
+    arg_parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    arg_parser.add_argument('--max-entries', type=int, default=LISTING_SIZES[-1], help='largest listing parsed')
+    arg_parser.add_argument('--min-time', type=float, default=0.5, help='seconds spent on each case')
+    args = arg_parser.parse_args()
+
+    results = run(args.max_entries, args.min_time)
+    print(f'{"case":<24}{"ops/s":>14}{"p50 us":>12}{"p99 us":>12}{"alloc B":>12}')
+    for name, result in results.items():
+        print(f'{name:<24}{result["ops_per_sec"]:>14,.0f}{result["p50_us"]:>12.2f}{result["p99_us"]:>12.2f}'
+              f'{result["alloc_bytes"]:>12,d}')
+    memory_entries = min(args.max_entries, 100_000)
+    report = {
+        'revision': revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results,
+        'fs_memory_bytes_per_entry': fs_memory.run(memory_entries, dirs=20),
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'\nResults written to {args.output}')
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
 import logging
-import queue
 import threading
 import tkinter as tk
-from src.client.client import Client
+from typing import Optional
+
 from src.client.command import FSCommand, PingCommand
+from src.client.connection_pool import ConnectionPool, Connection
+from src.client.metrics import PrometheusFileExporter
+from src.client.prefetcher import Prefetcher
 from src.gui.browser_page import BrowserPage
 from src.gui.connection_page import ConnectionPage
 
@@ -11,11 +14,28 @@ from src.gui.connection_page import ConnectionPage
 class AppRoot(tk.Tk):
     """
     Top level view of the application.
-    Contains GUI pages and the CoAP Client, as well as the thread that runs the client.
+    Contains GUI pages and the pool of connections to CoAP servers, each with the thread that runs its client.
+    Commands are sent to the active connection. Connecting to another server keeps the previous connection
+    in the pool, so switching back to it is immediate, until it is shut down for being idle.
+    With prefetch set, the browser requests the neighbours of the displayed directory in the background.
+    With metrics_path set, the metrics of all clients are periodically written to that file in the Prometheus
+    text format.
     """
 
-    def __init__(self, *args, **kwargs):
+    # Prefetches never take up the whole pipeline, commands issued by the user are sent right away
+    MAX_IN_FLIGHT = Prefetcher.MAX_CONCURRENT + 1
+    # Milliseconds between checks for idle connections
+    IDLE_CHECK_INTERVAL = 30000
+
+    def __init__(self, *args, prefetch: bool = True, metrics_path: str = None, **kwargs):
         tk.Tk.__init__(self, *args, **kwargs)
+        self.prefetch = prefetch
+        self.connections = ConnectionPool(max_in_flight=AppRoot.MAX_IN_FLIGHT)
+        self.metrics_exporter = None
+        if metrics_path:
+            self.metrics_exporter = PrometheusFileExporter(metrics_path, self.connections.registries)
+            self.metrics_exporter.start()
+        self.connection: Optional[Connection] = None
         # Dictionary with all app pages
         self.pages = {
             'connection': ConnectionPage('Connect', master=self),
@@ -25,10 +45,11 @@ class AppRoot(tk.Tk):
         self.geometry('1000x600')
         self.resizable(False, False)
         self.show_page('connection')
+        self.after(AppRoot.IDLE_CHECK_INTERVAL, self.close_idle_connections)
 
-        self.client = None
-        self.client_thread = None
-        self.msg_queue = queue.Queue()
+    @property
+    def client(self):
+        return self.connection.client if self.connection else None
 
     def show_page(self, frame_name: str):
         try:
@@ -41,28 +62,38 @@ class AppRoot(tk.Tk):
 
     def on_connect(self, ip: str, port: int):
         self.active_page.display_message('connecting...', color='green', duration=-1)
-        self.client_thread = threading.Thread(target=lambda: self.start_client(ip, port))
-        self.client_thread.start()
+        # Resolving the name and creating the socket may block, which is done outside of the GUI thread
+        threading.Thread(target=lambda: self.start_client(ip, port)).start()
 
     def start_client(self, ip: str, port: int):
         try:
-            self.client = Client(server_ip=ip, server_port=port, msg_queue=self.msg_queue)
-            self.show_page('browser')
-            # Allow the client to display messages on the current page
-            self.client.display_message_callback = self.active_page.display_message
-            self.send_to_client(PingCommand())
-            self.client.run()
+            connection = self.connections.connect(ip, port)
         except OSError as err:
             self.active_page.display_message(err.strerror)
+            return
+        self.connection = connection
+        self.pages['browser'].switch_server(connection)
+        self.show_page('browser')
+        # Allow the client to display messages on the current page
+        connection.client.display_message_callback = self.active_page.display_message
+        connection.client.confirmation_required = bool(self.pages['browser'].is_confirmable.get())
+        self.send_to_client(PingCommand())
+
+    def close_idle_connections(self):
+        for connection in self.connections.close_idle(active=self.connection):
+            logging.info(f'Closed idle connection to {connection.address}')
+        self.after(AppRoot.IDLE_CHECK_INTERVAL, self.close_idle_connections)
 
     def set_message_confirmation(self, is_confirmable: bool):
         if self.client:
             self.client.confirmation_required = is_confirmable
 
     def send_to_client(self, cmd: FSCommand):
-        self.msg_queue.put(cmd)
+        if self.connection:
+            self.connection.send(cmd)
 
     def destroy(self):
-        if self.client:
-            self.client.is_running = False
+        if self.metrics_exporter:
+            self.metrics_exporter.stop()
+        self.connections.close_all()
         super().destroy()
@@ -0,0 +1,128 @@
+import asyncio
+from typing import Optional
+
+from src.client.base_client import BaseClient
+from src.client.coap_message import CoAPMessage, CoAP
+from src.client.command import FSCommand
+from src.client.exceptions import InvalidResponse
+from src.client.in_flight import PendingRequest
+
+
+class AsyncPendingRequest(PendingRequest):
+    """
+    Request in flight whose completion is signaled through an asyncio future.
+    The request expires by means of an event loop timer instead of being polled.
+    """
+
+    def __init__(self, coap_msg: CoAPMessage, loop: asyncio.AbstractEventLoop, on_timeout, cmd: FSCommand = None,
+                 timeout: float = 1.0, attempts: int = 1, max_retransmit: int = 0):
+        super().__init__(coap_msg, cmd, timeout=timeout, attempts=attempts, max_retransmit=max_retransmit)
+        self.loop = loop
+        self.on_timeout = on_timeout
+        self.future = loop.create_future()
+        self.timer = loop.call_later(timeout, on_timeout, self)
+
+    def restart_timer(self):
+        super().restart_timer()
+        self.timer.cancel()
+        self.timer = self.loop.call_later(self.timeout, self.on_timeout, self)
+
+    def complete(self, response: Optional[CoAPMessage]):
+        super().complete(response)
+        self.timer.cancel()
+        if not self.future.done():
+            self.future.set_result(response)
+
+
+class AsyncClient(BaseClient, asyncio.DatagramProtocol):
+    """
+    Implements the client end of the client-server communication on top of an asyncio event loop.
+    Commands have the same semantics as with the blocking Client, but they are sent with 'await client.request(cmd)'.
+    Any number of requests can be awaited concurrently, since responses are matched by token and message ID.
+    No thread or message queue is required and the client does not wake up unless a datagram or a timeout arrives.
+    """
+
+    def __init__(self, server_ip: str, server_port: int, **protocol_params):
+        BaseClient.__init__(self, server_ip, server_port, **protocol_params)
+        self.transport = None
+        self.loop = None
+
+    async def __aenter__(self) -> 'AsyncClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def connect(self):
+        """
+        Resolves the server address in a worker thread, without blocking the event loop,
+        and opens the datagram endpoint.
+        """
+        self.loop = asyncio.get_running_loop()
+        addresses = await asyncio.wrap_future(AsyncClient.RESOLVER.resolve_async(self.server_ip, self.server_port))
+        family, address = addresses[0]
+        self.server_ip = address[0]
+        await self.loop.create_datagram_endpoint(lambda: self, family=family)
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    async def request(self, cmd: FSCommand) -> Optional[CoAPMessage]:
+        """
+        Sends the command to the server and waits for the response, then processes the response
+        exactly like the blocking Client does. A Reset response causes the command to be sent again.
+
+        :param cmd: The command to be sent.
+        :return: Optional[CoAPMessage] - the final response from the server, None in case of errors or
+                 if the command does not expect any response.
+        """
+        while True:
+            coap_msg = self.command_to_coap(cmd)
+            if not self.expects_response(coap_msg, cmd):
+                # Neither confirmable nor requiring data from the server - nothing to wait for
+                self.send_message(coap_msg)
+                cmd.exec(response_data='')
+                return None
+            coap_response = await self.submit(self.create_request(coap_msg)).future
+            if coap_response is None:
+                cmd.fail('No response from server')
+                return None
+            if coap_response.msg_type != CoAP.TYPE_RESET:
+                self.process_response(coap_response, cmd)
+                return coap_response
+            self.logger.info(f'(RESPONSE)\tReset')
+            self.metrics.resets.inc()
+
+    def create_request(self, coap_msg: CoAPMessage, cmd: FSCommand = None) -> AsyncPendingRequest:
+        return AsyncPendingRequest(coap_msg, self.loop, self.on_timeout, cmd, timeout=self.initial_timeout(),
+                                   attempts=AsyncClient.MAX_RESEND_ATTEMPTS, max_retransmit=self.max_retransmit)
+
+    def requeue(self, cmd: FSCommand):
+        self.loop.create_task(self.request(cmd))
+
+    def send_bytes(self, msg: bytes, ip: str, port: int):
+        self.transport.sendto(msg, (ip, port))
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            # The datagram is never reused, so the message can keep a view into it
+            self.dispatch_response(CoAPMessage.from_bytes(memoryview(data)))
+        except InvalidResponse as e:
+            self.logger.error(e)
+            self.resend_unacknowledged()
+
+    def error_received(self, exc: Exception):
+        self.logger.error(f'(SOCKET ERROR)\t{exc}')
+
+    def connection_lost(self, exc: Optional[Exception]):
+        # Wake up everyone still waiting for a response
+        for request in self.in_flight:
+            self.in_flight.remove(request)
+            request.complete(None)
+        self.observations.clear()
+        self.transport = None
@@ -0,0 +1,515 @@
+import abc
+import logging
+import random
+import time
+from typing import Dict, Optional
+
+from src.client.block_transfer import BlockOption, BlockTransfer
+from src.client.client_log import ClientLog, EncodedMessage
+from src.client.coap_message import CoAPMessage, CoAP
+from src.client.command import FSCommand
+from src.client.exceptions import InvalidFormat
+from src.client.in_flight import InFlightTable, PendingRequest
+from src.client.metrics import ClientMetrics
+from src.client.observation import Observation
+from src.client.resolver import Resolver
+
+
+class BaseClient(metaclass=abc.ABCMeta):
+    """
+    Interface for the client end of the client-server communication.
+    Holds the protocol logic shared by all transports: building CoAP requests out of commands,
+    matching responses to the requests in flight and executing commands once the server answered.
+    Subclasses decide how messages are sent and how the client waits for responses.
+    """
+
+    MSG_BUFFER_SIZE = 65535
+    MAX_RESEND_ATTEMPTS = 16
+    # Retransmission parameters (RFC-7252 section 4.8), except for a shorter default ACK_TIMEOUT
+    ACK_TIMEOUT = 1.0
+    ACK_RANDOM_FACTOR = 1.5
+    MAX_RETRANSMIT = 4
+    # Payloads larger than this are transferred block-wise (RFC-7959)
+    BLOCK_SIZE = 1024
+    # Shared by all clients, so reconnecting to a known host needs no lookup
+    RESOLVER = Resolver()
+
+    def __init__(self, server_ip: str, server_port: int, ack_timeout: float = None, ack_random_factor: float = None,
+                 max_retransmit: int = None, block_size: int = None):
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.ack_timeout = BaseClient.ACK_TIMEOUT if ack_timeout is None else ack_timeout
+        self.ack_random_factor = BaseClient.ACK_RANDOM_FACTOR if ack_random_factor is None else ack_random_factor
+        self.max_retransmit = BaseClient.MAX_RETRANSMIT if max_retransmit is None else max_retransmit
+        self.block_size = BaseClient.BLOCK_SIZE if block_size is None else block_size
+        if not BlockOption.is_valid_size(self.block_size):
+            raise ValueError(f'Invalid block size: {self.block_size}')
+        self.last_msg_id = 0
+        self.last_token = None
+        # Requests sent to the server that are still waiting for a response
+        self.in_flight = InFlightTable()
+        # Commands registered for notifications from the server, by token
+        self.observations: Dict[int, Observation] = {}
+        # Every message is encoded into the same buffer before being sent
+        self.send_buffer = bytearray(BaseClient.MSG_BUFFER_SIZE)
+        self.send_view = memoryview(self.send_buffer)
+        self.confirmation_required = False
+        # Counters and histograms of the traffic, exported by a MetricsExporter
+        self.metrics = ClientMetrics(f'{server_ip}:{server_port}')
+        self.metrics.gauge('coap_client_in_flight', 'Requests waiting for a response', lambda: len(self.in_flight))
+        self.metrics.gauge('coap_client_observations', 'Resources observed', lambda: len(self.observations))
+        # Callable used to asychronously display client messages in the GUI
+        self.display_message_callback = None
+
+        # Shared by all clients, records are written by a background thread (see ClientLog)
+        self.logger = ClientLog.get_logger()
+
+    @property
+    def retransmissions(self) -> int:
+        return self.metrics.retransmissions.value
+
+    @abc.abstractmethod
+    def send_bytes(self, msg: bytes, ip: str, port: int):
+        pass
+
+    @abc.abstractmethod
+    def requeue(self, cmd: FSCommand):
+        """
+        Schedules the command to be sent again, after the server rejected it with a Reset.
+
+        :param cmd: The command to be sent again.
+        :return: None
+        """
+        pass
+
+    def command_to_coap(self, cmd: FSCommand) -> CoAPMessage:
+        if self.confirmation_required or cmd.confirmation_required():
+            msg_type = CoAP.TYPE_CONF
+        else:
+            msg_type = CoAP.TYPE_NON_CONF
+        msg_class = cmd.get_coap_class()
+        msg_code = cmd.get_coap_code()
+        payload = cmd.coap_payload
+        self.next_msg_id()
+        if msg_class == CoAP.CLASS_METHOD and msg_code == CoAP.CODE_EMPTY:
+            self.last_token = None
+            token_length = 0
+        else:
+            # Tokens of requests in flight must be unique, otherwise responses cannot be told apart
+            self.last_token = BaseClient.generate_token()
+            while self.in_flight.has_token(self.last_token):
+                self.last_token = BaseClient.generate_token()
+            token_length = CoAP.token_length(self.last_token)
+        return CoAPMessage(payload=payload, msg_type=msg_type, msg_class=msg_class, msg_code=msg_code,
+                           msg_id=self.last_msg_id, token_length=token_length, token=self.last_token,
+                           options=cmd.coap_options)
+
+    def next_msg_id(self) -> int:
+        self.last_msg_id = (self.last_msg_id + 1) & 0xFFFF
+        return self.last_msg_id
+
+    def expects_response(self, coap_msg: CoAPMessage, cmd: FSCommand) -> bool:
+        """
+        Confirmable messages and commands that need server data wait for a response.
+        So do payloads that must be transferred block-wise, since every block is answered by the server.
+        """
+        return coap_msg.msg_type == CoAP.TYPE_CONF or cmd.server_data_required() \
+            or coap_msg.payload_length > self.block_size
+
+    def initial_timeout(self) -> float:
+        """
+        The initial timeout of a request is chosen randomly between ACK_TIMEOUT and ACK_TIMEOUT * ACK_RANDOM_FACTOR,
+        so that clients that lost packets at the same time do not retransmit in lockstep.
+        """
+        return random.uniform(self.ack_timeout, self.ack_timeout * self.ack_random_factor)
+
+    def create_request(self, coap_msg: CoAPMessage, cmd: FSCommand = None) -> PendingRequest:
+        return PendingRequest(coap_msg, cmd, timeout=self.initial_timeout(), attempts=BaseClient.MAX_RESEND_ATTEMPTS,
+                              max_retransmit=self.max_retransmit)
+
+    def join_in_flight(self, cmd: FSCommand) -> bool:
+        """
+        Single-flight requests: if an identical request is already in flight, the command waits for its response
+        instead of sending a new request. The commands are coalesced, so the response, the error or the timeout
+        of the request reaches all of them. Identical requests carry the same options, so a command that observes
+        its resource only joins requests that register an observation too.
+        The observation belongs to the command that owns the request, see FSCommand.supersedes().
+
+        :param cmd: The command about to be sent.
+        :return: bool - True if the command joined a request in flight and must not be sent.
+        """
+        request = self.in_flight.identical(cmd)
+        if request is None:
+            return False
+        if cmd.supersedes(request.cmd):
+            cmd.coalesce(request.cmd)
+            request.cmd = cmd
+        else:
+            request.cmd.coalesce(cmd)
+        self.logger.info(f'(REQUEST)\tIdentical request already in flight, waiting for its response')
+        return True
+
+    def submit(self, request: PendingRequest) -> PendingRequest:
+        """
+        Sends the message of a request to the server and registers the request in the in-flight table.
+
+        :param request: The request to be sent.
+        :return: PendingRequest - the same request, for convenience.
+        """
+        if request.coap_msg.payload_length > self.block_size:
+            # The payload does not fit in a single block - upload it block-wise
+            request.transfer = BlockTransfer(request.coap_msg.payload_bytes, self.block_size)
+            request.coap_msg = self.block1_message(request, first=True)
+        self.in_flight.add(request)
+        self.metrics.requests.inc()
+        self.send_message(request.coap_msg)
+        return request
+
+    def dispatch_response(self, coap_response: CoAPMessage):
+        """
+        Hands a message received from the server to the request it answers.
+        Received messages that do not belong to any request in flight are handled as notifications,
+        the ones that are not notifications either are irrelevant and are ignored.
+        If the request was created for a command, the command is processed right away.
+
+        :param coap_response: The message received from the server.
+        :return: None
+        """
+        request = self.in_flight.match(coap_response)
+        if request is None:
+            self.dispatch_notification(coap_response)
+            return
+        if not request.retransmitted:
+            self.metrics.rtt.observe(time.monotonic() - request.sent_at)
+        if self.has_unrecognized_options(coap_response):
+            return
+        if coap_response.msg_type == CoAP.TYPE_ACK and coap_response.is_empty():
+            # Acknowledge does not carry a piggybacked response - wait for the separate response
+            self.logger.info(f"Request acknowledged")
+            request.acknowledged = True
+            request.restart_timer()
+            return
+        if self.continue_transfer(request, coap_response):
+            return
+        self.in_flight.remove(request)
+        request.complete(coap_response)
+        self.metrics.request_duration.observe(time.monotonic() - request.started_at)
+        if request.cmd:
+            self.process_response(coap_response, request.cmd)
+
+    def dispatch_notification(self, coap_response: CoAPMessage):
+        """
+        Hands a notification (RFC-7641) to the command observing the resource. Notifications that arrive out
+        of order are ignored. Notifications that nobody observes anymore are rejected with a Reset, which
+        makes the server remove the observer. Notifications too large for a single message carry the first
+        block of the resource, the remaining blocks are requested like for any other response.
+
+        :param coap_response: The message received from the server.
+        :return: None
+        """
+        if coap_response.msg_type not in (CoAP.TYPE_CONF, CoAP.TYPE_NON_CONF) or not coap_response.token_length:
+            return
+        if self.has_unrecognized_options(coap_response):
+            return
+        observation = self.observations.get(coap_response.token)
+        if observation is None or not observation.cmd.observe:
+            self.observations.pop(coap_response.token, None)
+            if CoAP.OPTION_OBSERVE in coap_response.options:
+                self.logger.info('(NOTIFICATION)\tRejected, resource no longer observed')
+                self.reject_response(coap_response)
+            return
+        sequence = coap_response.options.get_uint(CoAP.OPTION_OBSERVE)
+        if not observation.is_fresh(sequence):
+            self.logger.info('(NOTIFICATION)\tIgnored, outdated')
+            if coap_response.msg_type == CoAP.TYPE_CONF:
+                self.acknowledge_response(coap_response)
+            return
+        if sequence is not None:
+            observation.update(sequence)
+        block2 = coap_response.get_option(CoAP.OPTION_BLOCK2)
+        if block2 is not None and BlockOption.from_bytes(block2).more:
+            self.fetch_notification(observation, coap_response, BlockOption.from_bytes(block2))
+            if coap_response.msg_type == CoAP.TYPE_CONF:
+                self.acknowledge_response(coap_response)
+            return
+        self.process_response(coap_response, observation.cmd)
+
+    def fetch_notification(self, observation: Observation, coap_response: CoAPMessage, block: BlockOption):
+        """
+        Requests the remaining blocks of a notification. The request is not an observation request,
+        so the reassembled notification is executed by the observing command as a regular response.
+        """
+        coap_msg = self.command_to_coap(observation.cmd)
+        coap_msg.remove_option(CoAP.OPTION_OBSERVE)
+        coap_msg.remove_option(CoAP.OPTION_ETAG)
+        request = self.create_request(coap_msg, observation.cmd)
+        request.transfer = BlockTransfer(coap_msg.payload_bytes, self.block_size)
+        request.transfer.add_block2(block, coap_response.payload_buffer)
+        request.coap_msg = self.block2_message(request)
+        self.in_flight.add(request)
+        self.metrics.requests.inc()
+        self.send_message(request.coap_msg)
+
+    def update_observation(self, coap_response: CoAPMessage, cmd: FSCommand):
+        """
+        Registers the command for notifications once the server accepted the observation, i.e. once
+        a successful response carries the Observe option. Any other response ends the observation.
+        """
+        if not coap_response.token_length:
+            return
+        sequence = coap_response.options.get_uint(CoAP.OPTION_OBSERVE)
+        if cmd.observe and sequence is not None and coap_response.msg_class == CoAP.CLASS_SUCCESS:
+            if coap_response.token not in self.observations:
+                self.observations[coap_response.token] = Observation(cmd, coap_response.token, sequence)
+        else:
+            self.observations.pop(coap_response.token, None)
+
+    def forget_cancelled_observations(self):
+        """
+        Removes the observations whose command was cancelled (see CachedListingCommand.cancel_observation())
+        and deregisters them with a GET that carries Observe=1 and the token of the observation.
+        The cached ETag is sent along, so the server usually answers without the listing. If the request
+        is lost, the next notification is rejected with a Reset instead.
+        Commands are cancelled by other threads, the observations are only modified by the client.
+        """
+        cancelled = [observation for observation in self.observations.values() if not observation.cmd.observe]
+        for observation in cancelled:
+            del self.observations[observation.token]
+            coap_msg = self.command_to_coap(observation.cmd)
+            coap_msg.token = observation.token
+            coap_msg.token_length = CoAP.token_length(observation.token)
+            coap_msg.set_option(CoAP.OPTION_OBSERVE, CoAP.encode_uint(CoAP.OBSERVE_DEREGISTER))
+            self.logger.info('(NOTIFICATION)\tObservation cancelled, deregistering')
+            self.send_message(coap_msg)
+
+    def has_unrecognized_options(self, coap_response: CoAPMessage) -> bool:
+        unrecognized = coap_response.options.unrecognized_critical()
+        if unrecognized:
+            # Responses with unrecognized critical options must be rejected (RFC-7252 section 5.4.1)
+            self.logger.error(f'(RESPONSE)\tRejected, unrecognized critical options: {unrecognized}')
+            if coap_response.msg_type == CoAP.TYPE_CONF:
+                self.reject_response(coap_response)
+        return bool(unrecognized)
+
+    def continue_transfer(self, request: PendingRequest, coap_response: CoAPMessage) -> bool:
+        """
+        Advances the block-wise transfer of a request, if the response is part of one.
+        A 2.31 Continue response to a Block1 request triggers the upload of the next block. A response that
+        carries a Block2 option with the 'more' flag set triggers the request for the next block of the response.
+        Once the last Block2 block arrives, the response payload is replaced with the reassembled payload.
+
+        :param request: The request answered by the response.
+        :param coap_response: The response from the server.
+        :return: bool - True if the exchange continues with another message.
+        """
+        if coap_response.msg_class != CoAP.CLASS_SUCCESS:
+            return False
+        transfer = request.transfer
+        if transfer and transfer.is_uploading and coap_response.msg_code == CoAP.CODE_CONTINUE:
+            block1 = coap_response.get_option(CoAP.OPTION_BLOCK1)
+            preferred_size = transfer.block_size
+            if block1 is not None:
+                block = BlockOption.from_bytes(block1)
+                if block.num != transfer.sent_block.num:
+                    # Late duplicate of an earlier Continue - keep waiting for the current block
+                    return True
+                preferred_size = block.size
+            transfer.block1_acknowledged(preferred_size)
+            if transfer.is_uploading:
+                self.send_next_message(request, self.block1_message(request))
+                return True
+            return False
+
+        block2 = coap_response.get_option(CoAP.OPTION_BLOCK2)
+        if block2 is None:
+            return False
+        block = BlockOption.from_bytes(block2)
+        if transfer is None:
+            request.transfer = transfer = BlockTransfer(request.coap_msg.payload_bytes, self.block_size)
+            # Only the first block tells whether an observation was established
+            transfer.observe = coap_response.get_option(CoAP.OPTION_OBSERVE)
+        if block.offset < len(transfer.response_payload):
+            # Late duplicate of a block that was already received - keep waiting for the current block
+            return True
+        transfer.add_block2(block, coap_response.payload_buffer)
+        if block.more:
+            self.send_next_message(request, self.block2_message(request))
+            return True
+        coap_response.payload = bytes(transfer.response_payload)
+        if transfer.observe is not None:
+            coap_response.set_option(CoAP.OPTION_OBSERVE, transfer.observe)
+        return False
+
+    def block1_message(self, request: PendingRequest, first: bool = False) -> CoAPMessage:
+        block = request.transfer.next_block1()
+        coap_msg = self.follow_up_message(request.coap_msg, request.transfer.block_data(block))
+        coap_msg.set_option(CoAP.OPTION_BLOCK1, block.to_bytes())
+        if first:
+            # Let the server know the total size of the payload
+            coap_msg.set_option(CoAP.OPTION_SIZE1, CoAP.encode_uint(len(request.transfer.request_payload)))
+        return coap_msg
+
+    def block2_message(self, request: PendingRequest) -> CoAPMessage:
+        payload = request.transfer.request_payload
+        coap_msg = self.follow_up_message(request.coap_msg, payload if len(payload) <= self.block_size else b'')
+        # Blocks of an observed resource are requested without registering again (RFC-7959 section 2.6)
+        coap_msg.remove_option(CoAP.OPTION_OBSERVE)
+        coap_msg.set_option(CoAP.OPTION_BLOCK2, request.transfer.next_block2().to_bytes())
+        return coap_msg
+
+    def follow_up_message(self, coap_msg: CoAPMessage, payload: bytes) -> CoAPMessage:
+        """
+        Creates the next message of an exchange, with the same header and token but a new message ID.
+        Block options of the previous message are not carried over.
+        """
+        options = coap_msg.options.copy()
+        for number in (CoAP.OPTION_BLOCK1, CoAP.OPTION_BLOCK2, CoAP.OPTION_SIZE1):
+            options.remove(number)
+        return CoAPMessage(payload=payload, msg_type=coap_msg.msg_type, msg_class=coap_msg.msg_class,
+                           msg_code=coap_msg.msg_code, msg_id=self.next_msg_id(), token_length=coap_msg.token_length,
+                           token=coap_msg.token, options=options)
+
+    def send_next_message(self, request: PendingRequest, coap_msg: CoAPMessage):
+        self.in_flight.remove(request)
+        request.continue_with(coap_msg, self.initial_timeout())
+        self.in_flight.add(request)
+        self.metrics.requests.inc()
+        self.send_message(coap_msg)
+
+    def resend_unacknowledged(self):
+        """
+        Called when an incorrect message was received. Since the message cannot be attributed to any request,
+        every request still waiting for an acknowledge is resent, up to a set maximum amount of retransmissions.
+        """
+        self.metrics.invalid_responses.inc()
+        for request in self.in_flight:
+            if request.acknowledged:
+                continue
+            request.attempts -= 1
+            if request.attempts > 0:
+                request.restart_timer()
+                request.retransmitted = True
+                self.metrics.retransmissions.inc()
+                self.send_message(request.coap_msg)
+            else:
+                self.logger.error('Too many invalid responses - abandonning retransmission')
+                self.in_flight.remove(request)
+                request.complete(None)
+                if request.cmd:
+                    request.cmd.fail('Too many invalid responses')
+
+    def on_timeout(self, request: PendingRequest):
+        """
+        Called when a request reached its deadline without a response.
+        The request is retransmitted with an exponentially increasing timeout until it runs out of retransmissions.
+        Requests that were already acknowledged are not retransmitted, since the server is processing them.
+
+        :param request: The request that timed out.
+        :return: None
+        """
+        if request.acknowledged or request.retransmissions_left <= 0:
+            self.expire(request)
+            return
+        self.logger.warning(f'(TIMEOUT)\tRetransmitting request, {request.retransmissions_left} attempts left',
+                            extra={'event': 'retransmission', 'msg_id': request.coap_msg.msg_id})
+        request.back_off()
+        self.metrics.retransmissions.inc()
+        self.send_message(request.coap_msg)
+
+    def expire(self, request: PendingRequest):
+        self.logger.error('(TIMEOUT)\tServer not responding', extra={'event': 'timeout',
+                                                                     'msg_id': request.coap_msg.msg_id})
+        self.in_flight.remove(request)
+        request.complete(None)
+        self.metrics.timeouts.inc()
+        self.metrics.request_duration.observe(time.monotonic() - request.started_at)
+        self.report_failure(request.cmd, 'Server not responding')
+
+    def process_response(self, coap_response: CoAPMessage, cmd: FSCommand):
+        """
+        Checks the response code and executes the command in case of OK response.
+        Any errors or unknown responses are logged.
+
+        :param coap_response: The response from the server.
+        :param cmd: The current comand awaiting response.
+        :return: None
+        """
+        if coap_response.msg_type == CoAP.TYPE_RESET:
+            # Response type is Reset - send the command again
+            self.logger.info(f'(RESPONSE)\tReset')
+            self.metrics.resets.inc()
+            self.requeue(cmd)
+            return
+
+        start = time.monotonic()
+        self.metrics.response(coap_response.msg_class)
+        response_code = 100 * coap_response.msg_class + coap_response.msg_code
+        if coap_response.msg_class == CoAP.CLASS_SUCCESS:
+            self.logger.info('(RESPONSE)\t%d: %s', response_code, CoAP.RESPONSE_CODE.get(response_code, 'Unknown'),
+                             extra={'event': 'response', 'code': response_code, 'msg_id': coap_response.msg_id})
+            self.update_observation(coap_response, cmd)
+            # Success - execute the command locally to be up to date with the server
+            try:
+                cmd.exec_response(coap_response)
+            except InvalidFormat as e:
+                self.report_failure(cmd, f'Incorrect server data: {e.msg}', duration=3)
+        elif coap_response.msg_class in (CoAP.CLASS_CERROR, CoAP.CLASS_SERROR):
+            # Client or Server error - also ends the observation, if any
+            self.observations.pop(coap_response.token, None)
+            msg = f'{response_code}: {CoAP.RESPONSE_CODE.get(response_code, "Unknown")}'
+            self.logger.error(f'(RESPONSE)\t{msg}', extra={'event': 'response', 'code': response_code,
+                                                           'msg_id': coap_response.msg_id})
+            self.report_failure(cmd, msg)
+        elif coap_response.msg_class == CoAP.CLASS_METHOD:
+            # Method class is not a valid response class
+            msg = f'Invalid response code: {response_code}'
+            self.logger.error(f'(RESPONSE)\t{msg}')
+            self.report_failure(cmd, msg)
+        else:
+            # Other response classes not recognized/implemented
+            msg = f'Unknown response code: {response_code}'
+            self.logger.warning(f'(RESPONSE)\t{msg}')
+            self.report_failure(cmd, msg, color='orange3')
+
+        if coap_response.msg_type == CoAP.TYPE_CONF:
+            # Response type is Confirmable - send an Acknowledge
+            self.acknowledge_response(coap_response)
+        self.metrics.processing.observe(time.monotonic() - start)
+
+    def acknowledge_response(self, coap_response: CoAPMessage):
+        ack_for_server = CoAPMessage(payload='', msg_type=CoAP.TYPE_ACK, msg_class=CoAP.CLASS_METHOD,
+                                     msg_code=CoAP.CODE_EMPTY, msg_id=coap_response.msg_id)
+        self.send_message(ack_for_server)
+
+    def send_message(self, coap_msg: CoAPMessage):
+        coap_data = self.send_view[:CoAP.pack_into(coap_msg, self.send_buffer)]
+        if coap_msg.msg_type == CoAP.TYPE_ACK:
+            self.logger.info('Response acknowledged', extra={'event': 'ack', 'msg_id': coap_msg.msg_id})
+        elif self.logger.isEnabledFor(logging.INFO):
+            # The message is formatted by the log thread, from a copy since the send buffer is reused
+            self.logger.info('(REQUEST)\t%s', EncodedMessage(coap_msg, bytes(coap_data)),
+                             extra={'event': 'request', 'msg_id': coap_msg.msg_id, 'token': coap_msg.token})
+        self.send_bytes(coap_data, self.server_ip, self.server_port)
+
+    def reject_response(self, coap_response: CoAPMessage):
+        reset_for_server = CoAPMessage(payload='', msg_type=CoAP.TYPE_RESET, msg_class=CoAP.CLASS_METHOD,
+                                       msg_code=CoAP.CODE_EMPTY, msg_id=coap_response.msg_id)
+        self.send_message(reset_for_server)
+
+    def report_failure(self, cmd: Optional[FSCommand], msg: str, duration: int = 2, color: str = 'red'):
+        """
+        Lets the command know that it failed. The user only sees errors of commands they issued themselves.
+        """
+        if cmd is not None:
+            cmd.fail(msg)
+        if cmd is None or not cmd.is_background:
+            self.display_message(msg, duration, color)
+
+    def display_message(self, msg: str, duration: int = 2, color: str = 'red'):
+        if self.display_message_callback:
+            self.display_message_callback(msg, duration, color)
+
+    @staticmethod
+    def generate_token() -> int:
+        # A zero token would be encoded with no bytes at all
+        return random.randint(1, 0xFF_FF_FF_FF)
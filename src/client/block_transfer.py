@@ -0,0 +1,100 @@
+from src.client.coap_message import CoAP
+from src.client.exceptions import InvalidFormat
+
+
+class BlockOption:
+    """
+    Value of a Block1 or Block2 option, as specified by RFC-7959 section 2.2.
+    Encodes the block number, whether more blocks follow and the block size exponent (size = 2 ** (SZX + 4)).
+    """
+
+    MIN_SIZE = 16
+    MAX_SIZE = 1024
+
+    def __init__(self, num: int, more: bool, size: int):
+        self.num = num
+        self.more = more
+        self.size = size
+
+    def __str__(self) -> str:
+        return f'{self.num}/{int(self.more)}/{self.size}'
+
+    @property
+    def offset(self) -> int:
+        return self.num * self.size
+
+    @property
+    def szx(self) -> int:
+        return self.size.bit_length() - 5
+
+    def to_bytes(self) -> bytes:
+        return CoAP.encode_uint((self.num << 4) | (int(self.more) << 3) | self.szx)
+
+    @classmethod
+    def from_bytes(cls, value: bytes) -> 'BlockOption':
+        if len(value) > 3:
+            raise InvalidFormat("Block option value is too long")
+        raw = CoAP.decode_uint(value)
+        szx = raw & 0x07
+        if szx == 7:
+            raise InvalidFormat("Block option uses reserved size exponent 7")
+        return cls(raw >> 4, bool(raw & 0x08), 1 << (szx + 4))
+
+    @staticmethod
+    def is_valid_size(size: int) -> bool:
+        return BlockOption.MIN_SIZE <= size <= BlockOption.MAX_SIZE and size & (size - 1) == 0
+
+
+class BlockTransfer:
+    """
+    State of a block-wise transfer (RFC-7959) belonging to a single request.
+    Holds the full request payload, which is uploaded in Block1 blocks, and the response payload,
+    which is downloaded in Block2 blocks and streamed into a single buffer.
+    """
+
+    def __init__(self, request_payload: bytes, block_size: int):
+        self.request_payload = request_payload
+        self.block_size = block_size
+        # Number of request payload bytes acknowledged by the server
+        self.uploaded = 0
+        self.sent_block = None
+        self.response_payload = bytearray()
+        # Observe option of the first response block, if any
+        self.observe = None
+
+    @property
+    def is_uploading(self) -> bool:
+        return self.uploaded < len(self.request_payload)
+
+    def next_block1(self) -> BlockOption:
+        """
+        Describes the next block of the request payload. Since the server may ask for a smaller block size
+        at any point, the block number is always derived from the amount of data already uploaded.
+        """
+        num = self.uploaded // self.block_size
+        more = self.uploaded + self.block_size < len(self.request_payload)
+        self.sent_block = BlockOption(num, more, self.block_size)
+        return self.sent_block
+
+    def block_data(self, block: BlockOption) -> bytes:
+        return self.request_payload[block.offset:block.offset + block.size]
+
+    def block1_acknowledged(self, preferred_size: int):
+        """
+        Marks the last block sent as received by the server. The server may ask for smaller blocks from now on.
+        """
+        self.uploaded = min(self.sent_block.offset + self.sent_block.size, len(self.request_payload))
+        self.block_size = min(self.block_size, preferred_size)
+
+    def add_block2(self, block: BlockOption, data: bytes):
+        """
+        Appends a block of the response payload. Blocks must arrive in order, since each one is requested
+        only after the previous one was received.
+        """
+        if block.offset != len(self.response_payload):
+            raise InvalidFormat(f"Unexpected response block {block}")
+        self.response_payload += data
+        self.block_size = min(self.block_size, block.size)
+
+    def next_block2(self) -> BlockOption:
+        return BlockOption(len(self.response_payload) // self.block_size, False, self.block_size)
@@ -1,91 +1,102 @@
-import logging
+import selectors
 import socket
-import random
-import math
 import queue
+import time
 from typing import Optional
 
-from src.client.exceptions import InvalidResponse, InvalidFormat
+from src.client.base_client import BaseClient
+from src.client.exceptions import InvalidResponse
 from src.client.coap_message import CoAPMessage, CoAP
 from src.client.command import FSCommand
+from src.client.command_queue import CommandQueue
 
 
-class Client:
+class Client(BaseClient):
     """
     Implements the client end of the client-server communication.
     The run() method is blocking so it's recommended to run it in a separate thread.
     The communication with other threads is done via message queues.
+    Several requests can be pipelined by setting max_in_flight, in which case responses are matched
+    to their requests by token and message ID. Commands identical to a request in flight share its response.
+    While resources are observed, the client keeps listening for notifications between commands.
+    With a CommandQueue, the client sleeps until a message, a new command or the next deadline arrives:
+    the queue wakes it up through a socket pair. Other queues are polled every PIPELINE_POLL_INTERVAL seconds
+    while the client waits for responses or notifications.
     """
 
-    MSG_BUFFER_SIZE = 65535
-    MAX_RESEND_ATTEMPTS = 16
-    SOCK_TIMEOUT = 1.0
     QUEUE_TIMEOUT = 1.0
-
-    def __init__(self, server_ip: str, server_port: int, msg_queue: 'queue.Queue[FSCommand]' = None):
-        self.server_ip = socket.gethostbyname(server_ip)
-        self.server_port = server_port
-        self.socket_inst = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-        self.socket_inst.settimeout(Client.SOCK_TIMEOUT)
+    PIPELINE_POLL_INTERVAL = 0.01
+
+    def __init__(self, server_ip: str, server_port: int, msg_queue: 'queue.Queue[FSCommand]' = None,
+                 max_in_flight: int = 1, sock: socket.socket = None, **protocol_params):
+        # Host names are resolved to their preferred address, which may be an IPv6 address
+        family, address = Client.RESOLVER.resolve(server_ip, server_port)[0]
+        super().__init__(address[0], server_port, **protocol_params)
+        # An already open socket to the server can be reused, e.g. the one that won Resolver.connect()
+        self.socket_inst = sock or socket.socket(family=family, type=socket.SOCK_DGRAM)
+        # Datagrams are received into the same buffer, messages parsed from it refer to it until detached
+        self.recv_buffer = memoryview(bytearray(Client.MSG_BUFFER_SIZE))
         self.msg_queue = msg_queue
-        self.last_msg_id = 0
-        self.last_token = None
-        self.confirmation_required = False
+        self.max_in_flight = max(1, max_in_flight)
         self.is_running = False
-        # Callable used to asychronously display client messages in the GUI
-        self.display_message_callback = None
-
-        # Initialize logger
-        self.logger = logging.Logger(name='CLIENT', level=logging.INFO)
-        file_handler = logging.FileHandler('client_log.txt')
-        formatter = logging.Formatter('<%(name)s@%(asctime)s>:[%(levelname)s] \t%(message)s')
-        file_handler.setFormatter(formatter)
-        file_handler.setLevel(logging.DEBUG)
-        self.logger.addHandler(file_handler)
+        if msg_queue is not None:
+            self.metrics.gauge('coap_client_queue_depth', 'Commands waiting to be sent', msg_queue.qsize)
+        # Waits for messages and for new commands at the same time
+        self.selector: Optional[selectors.BaseSelector] = None
+        self.wakeup_reader = self.wakeup_writer = None
+        if isinstance(msg_queue, CommandQueue):
+            self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+            self.wakeup_reader.setblocking(False)
+            self.wakeup_writer.setblocking(False)
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.socket_inst, selectors.EVENT_READ)
+            self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+            msg_queue.put_callback = self.wake_up
 
     def run(self):
         """
         Runs the client-server communication. Messages are received from the message queue.
-        The client will wait for a response before sending another message from the queue,
+        Up to max_in_flight requests are sent before waiting for their responses. With the default of a single
+        request in flight, the client will wait for a response before sending another message from the queue,
         unless the server takes too long or sends too many invalid responses.
+        Responses are dispatched to their commands as they arrive, regardless of the order of the requests.
         """
         self.is_running = True
         while self.is_running:
-            # Receive command from message queue
+            self.forget_cancelled_observations()
+            self.fill_pipeline()
+            if len(self.in_flight) or self.observations:
+                self.poll()
+
+    def fill_pipeline(self):
+        """
+        Sends commands from the message queue until the in-flight table is full or the queue is empty.
+        When nothing is in flight and no notifications are expected, the client blocks on the queue
+        for at most QUEUE_TIMEOUT seconds.
+        """
+        while len(self.in_flight) < self.max_in_flight:
+            idle = not len(self.in_flight) and not self.observations
             try:
-                cmd = self.msg_queue.get(block=True, timeout=Client.QUEUE_TIMEOUT)
+                cmd = self.msg_queue.get(block=idle, timeout=Client.QUEUE_TIMEOUT)
             except queue.Empty:
                 # No commands for now, check client state and try again
-                continue
-            # Build CoAP message out of command and send it
-            coap_msg = self.command_to_coap(cmd)
-            if coap_msg.msg_type == CoAP.TYPE_CONF or cmd.server_data_required():
-                coap_response = self.send_and_receive(coap_msg)
-                if coap_response:
-                    self.process_response(coap_response, cmd)
-            else:
-                # This message is neither confirmable nor requires data from the server.
-                # In this case, we simply send it to the server without caring about any response
-                self.send_message(coap_msg)
-                cmd.exec(response_data='')
-
-    def command_to_coap(self, cmd: FSCommand) -> CoAPMessage:
-        if self.confirmation_required or cmd.confirmation_required():
-            msg_type = CoAP.TYPE_CONF
-        else:
-            msg_type = CoAP.TYPE_NON_CONF
-        msg_class = cmd.get_coap_class()
-        msg_code = cmd.get_coap_code()
-        payload = cmd.coap_payload
-        self.last_msg_id += 1
-        if msg_class == CoAP.CLASS_METHOD and msg_code == CoAP.CODE_EMPTY:
-            self.last_token = None
-            token_length = 0
+                return
+            if isinstance(self.msg_queue, CommandQueue):
+                self.metrics.queue_wait(cmd.priority, cmd.queue_wait)
+            self.dispatch_command(cmd)
+
+    def dispatch_command(self, cmd: FSCommand):
+        if self.join_in_flight(cmd):
+            return
+        # Build CoAP message out of command and send it
+        coap_msg = self.command_to_coap(cmd)
+        if self.expects_response(coap_msg, cmd):
+            self.submit(self.create_request(coap_msg, cmd))
         else:
-            self.last_token = Client.generate_token()
-            token_length = int(math.ceil(math.log(self.last_token, 256)))
-        return CoAPMessage(payload=payload, msg_type=msg_type, msg_class=msg_class, msg_code=msg_code,
-                           msg_id=self.last_msg_id, token_length=token_length, token=self.last_token)
+            # This message is neither confirmable nor requires data from the server.
+            # In this case, we simply send it to the server without caring about any response
+            self.send_message(coap_msg)
+            cmd.exec(response_data='')
 
     def send_and_receive(self, coap_request: CoAPMessage) -> Optional[CoAPMessage]:
         """
@@ -94,122 +105,103 @@ class Client:
         A correct response has a matching token. In case of confirmable messages, the acknowledge is transmitted with a
         piggybacked response or separately. Any incorrect response will trigger a retransmission attempt, up to a set
         maximum amount of retransmissions. If the client runs out of retransmissions, the transmission will be aborted.
-        If the server does not send any response during the socket timeout period, the transmission will be aborted.
+        If the server does not send any response in time, the message is retransmitted with exponential backoff and
+        the transmission is aborted once the client runs out of retransmissions.
         Received messages without a matching token are considered irrelevant and are ignored.
+        Other requests in flight keep being served while waiting.
 
         :param coap_request: The message to be sent.
         :return: Optional[CoAPMessage] - returns None in case of errors.
         """
-        send_again = True
-        attempts = Client.MAX_RESEND_ATTEMPTS
-        while send_again:
-            send_again = False
-            self.send_message(coap_request)
-            try:
-                coap_response = self.recv_message()
-                if coap_request.msg_type == CoAP.TYPE_NON_CONF:
-                    # Response to Non-Confirmable request
-                    while self.last_token and self.last_token != coap_response.token:
-                        coap_response = self.recv_message()
-                    return coap_response
-                elif coap_request.msg_type == CoAP.TYPE_CONF:
-                    # Acknowledge to Confirmable request
-                    while self.last_msg_id != coap_response.msg_id:
-                        coap_response = self.recv_message()
-                    if coap_response.msg_type != CoAP.TYPE_ACK:
-                        raise InvalidResponse('Confirmable message not acknowledged')
-                    else:
-                        self.logger.info(f"Request acknowledged")
-                    if coap_response.is_empty():
-                        # Acknowledge does not carry a piggybacked response - wait for response
-                        coap_response = self.recv_message()
-                        while self.last_token and self.last_token != coap_response.token:
-                            coap_response = self.recv_message()
-                    return coap_response
-            except socket.timeout:
-                self.logger.error('(TIMEOUT)\tServer not responding')
-                self.display_message('Server not responding')
-            except InvalidResponse as e:
-                self.logger.error(e)
-                # Received messsage was incorrect - try to resend
-                attempts -= 1
-                if attempts > 0:
-                    send_again = True
-                else:
-                    self.logger.error('Too many invalid responses - abandonning retransmission')
-        # Something wrong - return nothing
-        return None
-
-    def process_response(self, coap_response: CoAPMessage, cmd: FSCommand):
-        """
-        Checks the response code and executes the command in case of OK response.
-        Any errors or unknown responses are logged.
+        request = self.submit(self.create_request(coap_request))
+        while not request.done:
+            self.poll()
+        return request.response
 
-        :param coap_response: The response from the server.
-        :param cmd: The current comand awaiting response.
-        :return: None
+    def poll(self):
         """
-        if coap_response.msg_type == CoAP.TYPE_RESET:
-            # Response type is Reset - put the command back in the queue for retransmission
-            self.logger.info(f'(RESPONSE)\tReset')
-            self.msg_queue.put(cmd)
-            return
+        Waits for a single message from the server and hands it to the request it answers.
+        The wait ends at the earliest deadline in the in-flight table, or after QUEUE_TIMEOUT seconds if the
+        client is only listening for notifications. If the pipeline still has free slots, the wait also ends
+        when a new command is queued, so that it is not delayed.
+        Requests whose deadline has passed are retransmitted or aborted.
+        """
+        deadline = self.in_flight.next_deadline()
+        timeout = Client.QUEUE_TIMEOUT if deadline is None else max(0.0, deadline - time.monotonic())
+        if len(self.in_flight) < self.max_in_flight:
+            if self.selector is None:
+                timeout = min(timeout, Client.PIPELINE_POLL_INTERVAL)
+            elif not self.wait_for_message(timeout):
+                self.expire_requests()
+                return
+            else:
+                # The message is already there
+                timeout = 0.0
+        self.socket_inst.settimeout(timeout)
+        coap_response = None
+        try:
+            coap_response = self.recv_message()
+            self.dispatch_response(coap_response)
+        except (socket.timeout, BlockingIOError):
+            # A zero timeout switches the socket to non-blocking mode, which fails instead of timing out
+            pass
+        except InvalidResponse as e:
+            self.logger.error(e)
+            self.resend_unacknowledged()
+        finally:
+            if coap_response:
+                # The receive buffer is about to be reused
+                coap_response.detach()
+        self.expire_requests()
+
+    def wait_for_message(self, timeout: float) -> bool:
+        """
+        Waits until a message arrives or a command is queued, at most timeout seconds.
 
-        response_code = 100 * coap_response.msg_class + coap_response.msg_code
-        if coap_response.msg_class == CoAP.CLASS_SUCCESS:
-            self.logger.info(f'(RESPONSE)\t{response_code}: {CoAP.RESPONSE_CODE.get(response_code, "Unknown")}')
-            # Success - execute the command locally to be up to date with the server
+        :return: bool - True if a message can be received.
+        """
+        ready = [key.fileobj for key, _ in self.selector.select(timeout)]
+        if self.wakeup_reader in ready:
             try:
-                cmd.exec(coap_response.payload)
-            except InvalidFormat as e:
-                self.display_message(f'Incorrect server data: {e.msg}', duration=3)
-        elif coap_response.msg_class in (CoAP.CLASS_CERROR, CoAP.CLASS_SERROR):
-            # Client or Server error
-            msg = f'{response_code}: {CoAP.RESPONSE_CODE.get(response_code, "Unknown")}'
-            self.logger.error(f'(RESPONSE)\t{msg}')
-            self.display_message(msg)
-        elif coap_response.msg_class == CoAP.CLASS_METHOD:
-            # Method class is not a valid response class
-            msg = f'Invalid response code: {response_code}'
-            self.logger.error(f'(RESPONSE)\t{msg}')
-            self.display_message_callback(msg)
-        else:
-            # Other response classes not recognized/implemented
-            msg = f'Unknown response code: {response_code}'
-            self.logger.warning(f'(RESPONSE)\t{msg}')
-            self.display_message(msg, color='orange3')
-
-        if coap_response.msg_type == CoAP.TYPE_CONF:
-            # Response type is Confirmable - send an Acknowledge
-            self.acknowledge_response(coap_response)
-
-    def acknowledge_response(self, coap_response: CoAPMessage):
-        ack_for_server = CoAPMessage(payload='', msg_type=CoAP.TYPE_ACK, msg_class=CoAP.CLASS_METHOD,
-                                     msg_code=CoAP.CODE_EMPTY, msg_id=coap_response.msg_id)
-        self.send_message(ack_for_server)
-
-    def display_message(self, msg: str, duration: int = 2, color: str = 'red'):
-        if self.display_message_callback:
-            self.display_message_callback(msg, duration, color)
-
-    def send_message(self, coap_msg: CoAPMessage):
-        coap_data = CoAP.wrap(coap_msg)
-        if coap_msg.msg_type == CoAP.TYPE_ACK:
-            self.logger.info(f"Response acknowledged")
-        else:
-            self.logger.info(f"(REQUEST)\t{coap_msg.logging_format()}")
-        self.send_bytes(coap_data, self.server_ip, self.server_port)
+                while self.wakeup_reader.recv(Client.MSG_BUFFER_SIZE):
+                    pass
+            except BlockingIOError:
+                pass
+        return self.socket_inst in ready
+
+    def wake_up(self):
+        """
+        Interrupts poll() once a command is queued. Called by the threads that queue commands.
+        """
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            # The socket buffer is full, so a wake-up is pending anyway, or the client was closed
+            pass
+
+    def expire_requests(self):
+        for request in self.in_flight.expired(time.monotonic()):
+            self.on_timeout(request)
+
+    def requeue(self, cmd: FSCommand):
+        # Put the command back in the queue for retransmission
+        self.msg_queue.put(cmd)
 
     def recv_message(self) -> CoAPMessage:
-        coap_bytes = self.recv_bytes()
-        return CoAPMessage.from_bytes(coap_bytes)
+        """
+        Receives a message into the reusable receive buffer. The payload of the message is a view into the buffer,
+        so the message must be detached before the next message is received.
+        """
+        length = self.socket_inst.recv_into(self.recv_buffer)
+        return CoAPMessage.from_bytes(self.recv_buffer[:length])
 
     def send_bytes(self, msg: bytes, ip: str, port: int):
         self.socket_inst.sendto(msg, (ip, port))
 
-    def recv_bytes(self) -> bytes:
-        return self.socket_inst.recv(Client.MSG_BUFFER_SIZE)
-
-    @staticmethod
-    def generate_token() -> int:
-        return random.randint(0, 0xFF_FF_FF_FF)
+    def close(self):
+        if self.selector is not None:
+            self.msg_queue.put_callback = None
+            self.selector.close()
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+        self.socket_inst.close()
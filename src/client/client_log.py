@@ -0,0 +1,170 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+from typing import Optional
+
+from src.client.coap_message import CoAPMessage
+
+# Attributes every LogRecord has, anything else was passed as a structured field through 'extra'
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the formatting of records to the listener thread, unlike QueueHandler which
+    formats every message in the thread that logs it. Arguments of log calls must therefore not change
+    after the call, e.g. encoded messages are passed as bytes copies of the send buffer.
+    When the queue is full, records are dropped instead of blocking the caller.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # Tracebacks refer to live frames, they are formatted right away
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats records as JSON lines: time, level, logger and message, plus the structured fields of the record
+    (e.g. event, msg_id, token), so that logs can be filtered and aggregated by tools.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class EncodedMessage:
+    """
+    Log argument that formats an encoded message only when the record is written, see CoAPMessage.logging_format().
+    """
+
+    __slots__ = ('coap_msg', 'encoded')
+
+    def __init__(self, coap_msg: CoAPMessage, encoded: bytes):
+        self.coap_msg = coap_msg
+        self.encoded = encoded
+
+    def __str__(self) -> str:
+        return self.coap_msg.logging_format(self.encoded)
+
+
+class ClientLog:
+    """
+    Non-blocking log shared by all clients.
+    Clients log into a bounded queue, a listener thread formats the records and writes them to a rotating file,
+    so neither formatting nor disk I/O slow down sending and receiving. The file is rotated once it reaches
+    max_bytes, and backup_count old files are kept.
+    With structured set, records are written as JSON lines that include their structured fields.
+    """
+
+    NAME = 'CLIENT'
+    PATH = 'client_log.txt'
+    LEVEL = logging.INFO
+    MAX_BYTES = 5 * 1024 * 1024
+    BACKUP_COUNT = 3
+    # Records waiting to be written, further records are dropped
+    MAX_QUEUED = 10000
+    TEXT_FORMAT = '<%(name)s@%(asctime)s>:[%(levelname)s] \t%(message)s'
+
+    lock = threading.Lock()
+    listener: Optional[logging.handlers.QueueListener] = None
+    handler: Optional[DeferredQueueHandler] = None
+
+    @staticmethod
+    def get_logger() -> logging.Logger:
+        """
+        Returns the client logger, configured with the defaults if configure() was not called.
+        """
+        with ClientLog.lock:
+            if ClientLog.listener is None:
+                ClientLog.start()
+        return logging.getLogger(ClientLog.NAME)
+
+    @staticmethod
+    def configure(path: str = PATH, level: int = LEVEL, max_bytes: int = MAX_BYTES, backup_count: int = BACKUP_COUNT,
+                  structured: bool = False, max_queued: int = MAX_QUEUED):
+        """
+        (Re)configures the client logger. Records still queued are written with the previous configuration.
+
+        :param path: The log file, None to discard records.
+        :param level: Records below this level are neither formatted nor queued.
+        :param max_bytes: Size at which the file is rotated, 0 to never rotate it.
+        :param backup_count: Number of rotated files kept.
+        :param structured: Whether records are written as JSON lines.
+        :param max_queued: Number of records waiting to be written before further records are dropped.
+        :return: None
+        """
+        with ClientLog.lock:
+            ClientLog.stop()
+            ClientLog.start(path, level, max_bytes, backup_count, structured, max_queued)
+
+    @staticmethod
+    def start(path: str = PATH, level: int = LEVEL, max_bytes: int = MAX_BYTES, backup_count: int = BACKUP_COUNT,
+              structured: bool = False, max_queued: int = MAX_QUEUED):
+        if path is None:
+            file_handler = logging.NullHandler()
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                                delay=True)
+        file_handler.setFormatter(StructuredFormatter() if structured else logging.Formatter(ClientLog.TEXT_FORMAT))
+        log_queue = queue.Queue(max_queued)
+        ClientLog.handler = DeferredQueueHandler(log_queue)
+        ClientLog.listener = logging.handlers.QueueListener(log_queue, file_handler)
+        ClientLog.listener.start()
+        logger = logging.getLogger(ClientLog.NAME)
+        logger.setLevel(level)
+        # Client records only go to the client log
+        logger.propagate = False
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(ClientLog.handler)
+
+    @staticmethod
+    def stop():
+        """
+        Writes the records still queued and closes the log file.
+        """
+        if ClientLog.listener is None:
+            return
+        logging.getLogger(ClientLog.NAME).removeHandler(ClientLog.handler)
+        ClientLog.listener.stop()
+        for handler in ClientLog.listener.handlers:
+            handler.close()
+        ClientLog.listener = None
+
+    @staticmethod
+    def dropped() -> int:
+        """
+        Number of records dropped because the listener could not keep up.
+        """
+        return ClientLog.handler.dropped if ClientLog.handler else 0
+
+
+@atexit.register
+def flush_client_log():
+    with ClientLog.lock:
+        ClientLog.stop()
@@ -1,14 +1,107 @@
+import bisect
+import struct
+from typing import Union, Optional, List, Tuple, Iterable, Iterator
+
 from src.client.exceptions import InvalidFormat
 
 
+class CoAPOptions:
+    """
+    Ordered table of CoAP options, kept sorted by option number as required for encoding.
+    Option numbers and values are stored in two parallel lists, so lookups are binary searches and no
+    object is allocated per option. Repeated options keep the order in which they were added.
+    Messages without options all share the read-only CoAPOptions.EMPTY table.
+    """
+
+    __slots__ = ('numbers', 'values')
+
+    EMPTY = None
+
+    def __init__(self, options: Iterable[Tuple[int, bytes]] = ()):
+        self.numbers: List[int] = []
+        self.values: List[bytes] = []
+        for number, value in options:
+            self.add(number, value)
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __iter__(self) -> Iterator[Tuple[int, bytes]]:
+        return zip(self.numbers, self.values)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CoAPOptions) and self.numbers == other.numbers and self.values == other.values
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({list(self)})'
+
+    def __contains__(self, number: int) -> bool:
+        i = bisect.bisect_left(self.numbers, number)
+        return i < len(self.numbers) and self.numbers[i] == number
+
+    def get(self, number: int) -> Optional[bytes]:
+        """
+        Returns the value of the first occurrence of an option, or None if the option is not present.
+        """
+        i = bisect.bisect_left(self.numbers, number)
+        if i < len(self.numbers) and self.numbers[i] == number:
+            return self.values[i]
+        return None
+
+    def get_all(self, number: int) -> List[bytes]:
+        return self.values[bisect.bisect_left(self.numbers, number):bisect.bisect_right(self.numbers, number)]
+
+    def get_uint(self, number: int, default: Optional[int] = None) -> Optional[int]:
+        value = self.get(number)
+        return default if value is None else CoAP.decode_uint(value)
+
+    def add(self, number: int, value: bytes):
+        """
+        Adds an option after all the options with a lower or equal number.
+        """
+        i = bisect.bisect_right(self.numbers, number)
+        self.numbers.insert(i, number)
+        self.values.insert(i, value)
+
+    def remove(self, number: int):
+        start = bisect.bisect_left(self.numbers, number)
+        end = bisect.bisect_right(self.numbers, number)
+        del self.numbers[start:end]
+        del self.values[start:end]
+
+    def set(self, number: int, value: bytes):
+        """
+        Replaces all occurrences of an option with a single one.
+        """
+        self.remove(number)
+        self.add(number, value)
+
+    def copy(self) -> 'CoAPOptions':
+        options = CoAPOptions()
+        options.numbers = self.numbers.copy()
+        options.values = self.values.copy()
+        return options
+
+    def unrecognized_critical(self) -> List[int]:
+        """
+        Lists the critical options (odd option numbers) that are not implemented by this client.
+        A message carrying any of them must be rejected, as specified by RFC-7252 section 5.4.1.
+        """
+        return [number for number in self.numbers if number & 0x01 and number not in CoAP.KNOWN_OPTIONS]
+
+
+CoAPOptions.EMPTY = CoAPOptions()
+
+
 class CoAPMessage:
     """
     Encapsulates a CoAP-style message, providing an easy means of accessing all header fields.
     Is responsible for validating messages and throws exceptions in case of incorrect formats.
     """
 
-    def __init__(self, payload: str, msg_type: int, msg_class: int, msg_code: int, msg_id: int,
-                 header_version=0x1, token_length=0x0, token=0x0):
+    def __init__(self, payload: Union[str, bytes], msg_type: int, msg_class: int, msg_code: int, msg_id: int,
+                 header_version=0x1, token_length=0x0, token=0x0,
+                 options: Union[CoAPOptions, Iterable[Tuple[int, bytes]]] = None):
         self.payload = payload
         self.header_version = header_version
         self.msg_type = msg_type
@@ -17,35 +110,136 @@ class CoAPMessage:
         self.msg_code = msg_code
         self.msg_id = msg_id
         self.token = token
+        if options is None:
+            options = CoAPOptions.EMPTY
+        elif not isinstance(options, CoAPOptions):
+            options = CoAPOptions(options)
+        self.options = options
+
+    @property
+    def payload(self) -> str:
+        """
+        The payload as text. Received payloads are kept as bytes and only decoded when first accessed,
+        since a block of a larger payload may end in the middle of a UTF-8 character and since
+        many payloads (e.g. of acknowledges) are never read.
+        """
+        if self._payload is None:
+            try:
+                # str() decodes memoryviews directly, without copying them to bytes first
+                self._payload = str(self._payload_bytes, 'utf-8')
+            except UnicodeDecodeError:
+                raise InvalidFormat("Message payload is not valid UTF-8")
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload: Union[str, bytes, memoryview]):
+        """
+        Sets the payload. Memoryviews are stored as they are, without copying. If the view refers to a buffer
+        that will be reused, detach() must be called before the buffer changes.
+        """
+        if isinstance(payload, str):
+            self._payload, self._payload_bytes = payload, None
+        elif isinstance(payload, memoryview):
+            self._payload, self._payload_bytes = None, payload
+        else:
+            self._payload, self._payload_bytes = None, bytes(payload)
+
+    @property
+    def payload_bytes(self) -> bytes:
+        if self._payload_bytes is None:
+            self._payload_bytes = self._payload.encode('utf-8')
+        elif isinstance(self._payload_bytes, memoryview):
+            self._payload_bytes = self._payload_bytes.tobytes()
+        return self._payload_bytes
+
+    @property
+    def payload_buffer(self) -> Union[bytes, memoryview]:
+        """
+        The encoded payload, possibly as a view into the buffer the message was parsed from.
+        Use it to copy the payload somewhere else without an intermediate bytes object.
+        """
+        if self._payload_bytes is None:
+            return self.payload_bytes
+        return self._payload_bytes
+
+    @property
+    def payload_length(self) -> int:
+        return len(self.payload_buffer)
+
+    def detach(self):
+        """
+        Makes sure the message does not refer to the buffer it was parsed from anymore.
+        Payloads that were already decoded are simply dropped, since they can be encoded again if needed.
+        """
+        if isinstance(self._payload_bytes, memoryview):
+            self._payload_bytes = None if self._payload is not None else self._payload_bytes.tobytes()
+
+    def get_option(self, number: int) -> Optional[bytes]:
+        """
+        Returns the value of the first occurrence of an option, or None if the message does not carry it.
+        """
+        return self.options.get(number)
+
+    def set_option(self, number: int, value: bytes):
+        """
+        Replaces all occurrences of an option with a single one.
+        """
+        self.writable_options().set(number, value)
+
+    def add_option(self, number: int, value: bytes):
+        self.writable_options().add(number, value)
+
+    def remove_option(self, number: int):
+        if number in self.options:
+            self.options.remove(number)
+
+    def writable_options(self) -> CoAPOptions:
+        # The shared empty table must never be modified
+        if self.options is CoAPOptions.EMPTY:
+            self.options = CoAPOptions()
+        return self.options
 
     def __str__(self) -> str:
         return f"""[VERSION]:\t{self.header_version}\n[TYPE]:\t\t{self.msg_type}\n[TKN LEN]:\t{self.token_length}
 [CLASS]:\t{self.msg_class}\n[CODE]:\t\t{self.msg_code}\n[MSG ID]:\t{self.msg_id}
 [TOKEN]:\t{hex(self.token) if self.token_length else ''}
-[PAYLOAD]:\t{self.payload}\n"""
+[OPTIONS]:\t{self.options}
+[PAYLOAD]:\t{self.payload_bytes}\n"""
 
-    def logging_format(self) -> str:
-        data_bytes = CoAP.build_header(self)
-        ans = data_bytes.hex(sep=' ', bytes_per_sep=1)
-        if self.payload:
-            ans += f' ff {bytes(self.payload, encoding="utf-8")}'
+    def logging_format(self, encoded: Union[bytes, bytearray, memoryview] = None) -> str:
+        """
+        Formats the message for logging: header, token and options as hex, followed by the payload.
+
+        :param encoded: The message as already encoded by CoAP.wrap/CoAP.pack_into, so that it is not encoded again.
+        :return: str - the formatted message.
+        """
+        if encoded is None:
+            encoded = CoAP.wrap(self)
+        payload_length = self.payload_length
+        header_end = len(encoded) - payload_length - (1 if payload_length else 0)
+        ans = encoded[:header_end].hex(sep=' ', bytes_per_sep=1)
+        if payload_length:
+            ans += f' ff {self.payload_bytes}'
         return ans
 
     @classmethod
-    def from_bytes(cls, data_bytes: bytes) -> 'CoAPMessage':
+    def from_bytes(cls, data_bytes: Union[bytes, bytearray, memoryview]) -> 'CoAPMessage':
         """
         Creates a CoAPMessage from bytes encoded using the CoAP protocol.
         This method will also check any format inconsistencies according to RFC-7252 and will throw InvalidFormat.
+        If the data is a memoryview, the payload is not copied: the message keeps a view into the same buffer
+        (see detach()). Option values are always copied, since they are small.
 
         :param data_bytes: The bytes that encode the message.
         """
-        header_bytes = data_bytes[0:4]
-        header_version = (0xC0 & header_bytes[0]) >> 6
-        msg_type = (0x30 & header_bytes[0]) >> 4
-        token_length = (0x0F & header_bytes[0]) >> 0
-        msg_class = (header_bytes[1] >> 5) & 0x07
-        msg_code = (header_bytes[1] >> 0) & 0x1F
-        msg_id = (header_bytes[2] << 8) | header_bytes[3]
+        if len(data_bytes) < CoAP.HEADER_LEN:
+            raise InvalidFormat("Message is shorter than the CoAP header")
+        first_byte, second_byte, msg_id = CoAP.HEADER_STRUCT.unpack_from(data_bytes)
+        header_version = (0xC0 & first_byte) >> 6
+        msg_type = (0x30 & first_byte) >> 4
+        token_length = (0x0F & first_byte) >> 0
+        msg_class = (second_byte >> 5) & 0x07
+        msg_code = (second_byte >> 0) & 0x1F
 
         # Check if the header has reserved field values
         if header_version not in CoAP.VALID_VERSIONS:
@@ -63,14 +257,16 @@ class CoAPMessage:
 
         token = 0x0
         if token_length:
+            if len(data_bytes) < 4 + token_length:
+                raise InvalidFormat("Message is shorter than its token")
             token = int.from_bytes(data_bytes[4:4 + token_length], 'big')
-        payload = data_bytes[5 + token_length:].decode('utf-8')
-        return cls(payload, msg_type, msg_class, msg_code, msg_id,
-                   header_version=header_version, token_length=token_length, token=token)
+        options, payload_start = CoAP.decode_options(data_bytes, 4 + token_length)
+        return cls(data_bytes[payload_start:], msg_type, msg_class, msg_code, msg_id,
+                   header_version=header_version, token_length=token_length, token=token, options=options)
 
     def is_empty(self):
         return self.msg_class == CoAP.CLASS_METHOD and self.msg_code == CoAP.CODE_EMPTY \
-               and self.token_length == 0x0 and self.token is None and len(self.payload) == 0
+               and self.token_length == 0x0 and not self.token and self.payload_length == 0
 
     def requires_acknowledge(self):
         return self.msg_type == CoAP.TYPE_CONF or (self.msg_type == CoAP.TYPE_ACK and not self.is_empty())
@@ -88,6 +284,15 @@ class CoAP:
     """
 
     HEADER_LEN = 4
+    # Version/type/token length byte, class/code byte and message ID, in network byte order
+    HEADER_STRUCT = struct.Struct('!BBH')
+    # Header followed by the token, for the token lengths that map to an integer format
+    TOKEN_HEADER_STRUCTS = {
+        1: struct.Struct('!BBHB'),
+        2: struct.Struct('!BBHH'),
+        4: struct.Struct('!BBHI'),
+        8: struct.Struct('!BBHQ')
+    }
     VALID_VERSIONS = (1, )
     PAYLOAD_MARKER = b'\xFF'
     DEFAULT_PORT = 5683
@@ -119,6 +324,52 @@ class CoAP:
     CODE_POST = 2
     CODE_DELETE = 4
 
+    # Response codes
+    CODE_CREATED = 1
+    CODE_DELETED = 2
+    CODE_VALID = 3
+    CODE_CHANGED = 4
+    CODE_CONTENT = 5
+    CODE_CONTINUE = 31
+
+    # Option numbers
+    OPTION_IF_MATCH = 1
+    OPTION_URI_HOST = 3
+    OPTION_ETAG = 4
+    OPTION_IF_NONE_MATCH = 5
+    OPTION_OBSERVE = 6
+    OPTION_URI_PORT = 7
+    OPTION_LOCATION_PATH = 8
+    OPTION_URI_PATH = 11
+    OPTION_CONTENT_FORMAT = 12
+    OPTION_MAX_AGE = 14
+    OPTION_URI_QUERY = 15
+    OPTION_ACCEPT = 17
+    OPTION_LOCATION_QUERY = 20
+    OPTION_BLOCK2 = 23
+    OPTION_BLOCK1 = 27
+    OPTION_SIZE2 = 28
+    OPTION_PROXY_URI = 35
+    OPTION_PROXY_SCHEME = 39
+    OPTION_SIZE1 = 60
+    KNOWN_OPTIONS = frozenset((OPTION_IF_MATCH, OPTION_URI_HOST, OPTION_ETAG, OPTION_IF_NONE_MATCH, OPTION_OBSERVE,
+                               OPTION_URI_PORT, OPTION_LOCATION_PATH, OPTION_URI_PATH, OPTION_CONTENT_FORMAT,
+                               OPTION_MAX_AGE, OPTION_URI_QUERY, OPTION_ACCEPT, OPTION_LOCATION_QUERY, OPTION_BLOCK2,
+                               OPTION_BLOCK1, OPTION_SIZE2, OPTION_PROXY_URI, OPTION_PROXY_SCHEME, OPTION_SIZE1))
+
+    # Observe option values in requests (RFC-7641 section 2)
+    OBSERVE_REGISTER = 0
+    OBSERVE_DEREGISTER = 1
+
+    # Content formats
+    FORMAT_TEXT = 0
+    FORMAT_OCTET_STREAM = 42
+
+    # Option header nibbles announcing extended delta/length fields
+    OPTION_EXT_BYTE = 13
+    OPTION_EXT_WORD = 14
+    OPTION_EXT_RESERVED = 15
+
     # Response code translation
     RESPONSE_CODE = {
         # Success
@@ -126,6 +377,8 @@ class CoAP:
         202: 'Deleted',
         203: 'Valid',
         204: 'Changed',
+        205: 'Content',
+        231: 'Continue',
         # Client error
         400: 'Bad Request',
         401: 'Unauthorized',
@@ -133,6 +386,8 @@ class CoAP:
         403: 'Forbidden',
         404: 'Not Found',
         405: 'Method Not Allowed',
+        408: 'Request Entity Incomplete',
+        413: 'Request Entity Too Large',
         # Server error
         500: 'Internal Server Error',
         501: 'Not Implemented',
@@ -150,22 +405,161 @@ class CoAP:
         :param msg: The CoAPMEssage object to be encoded.
         :return: bytes representing the encoded message.
         """
-
         coap_header = CoAP.build_header(msg)
-        payload = b''
-        if len(msg.payload):
-            payload = CoAP.PAYLOAD_MARKER + msg.payload.encode('utf-8')
-        return coap_header + payload
+        if msg.options:
+            coap_header += CoAP.encode_options(msg.options)
+        payload = msg.payload_buffer
+        if len(payload):
+            return b''.join((coap_header, CoAP.PAYLOAD_MARKER, payload))
+        return coap_header
+
+    @staticmethod
+    def pack_into(msg: CoAPMessage, buffer: bytearray, offset: int = 0) -> int:
+        """
+        Encodes a CoAPMessage into a preallocated buffer, which avoids any intermediate bytes objects
+        when the same buffer is used for every message.
+
+        :param msg: The CoAPMessage object to be encoded.
+        :param buffer: The writable buffer that receives the message.
+        :param offset: The position in the buffer where the message starts.
+        :return: int - the position in the buffer right after the message.
+        """
+        token_length = msg.token_length
+        options = CoAP.encode_options(msg.options) if msg.options else b''
+        payload = msg.payload_buffer
+        payload_length = len(payload)
+        start = offset + CoAP.HEADER_LEN + token_length
+        end = start + len(options) + (1 + payload_length if payload_length else 0)
+        if end > len(buffer):
+            raise ValueError(f'Buffer too small for a {end - offset} bytes message')
+
+        header_struct = CoAP.TOKEN_HEADER_STRUCTS.get(token_length)
+        first_byte = (msg.header_version << 6) | ((0b11 & msg.msg_type) << 4) | (0x0F & token_length)
+        second_byte = ((0b111 & msg.msg_class) << 5) | (0x1F & msg.msg_code)
+        if not token_length:
+            CoAP.HEADER_STRUCT.pack_into(buffer, offset, first_byte, second_byte, 0xFFFF & msg.msg_id)
+        elif header_struct:
+            header_struct.pack_into(buffer, offset, first_byte, second_byte, 0xFFFF & msg.msg_id, msg.token)
+        else:
+            CoAP.HEADER_STRUCT.pack_into(buffer, offset, first_byte, second_byte, 0xFFFF & msg.msg_id)
+            buffer[offset + CoAP.HEADER_LEN:start] = msg.token.to_bytes(token_length, 'big')
+        if options:
+            buffer[start:start + len(options)] = options
+            start += len(options)
+        if payload_length:
+            buffer[start] = 0xFF
+            buffer[start + 1:end] = payload
+        return end
 
     @staticmethod
     def build_header(msg: CoAPMessage) -> bytes:
-        header = 0x00
-        header |= msg.header_version << CoAP.VERSION
-        header |= (0b11 & msg.msg_type) << CoAP.MSG_TYPE
-        header |= (0xFF & msg.token_length) << CoAP.TOKEN_LENGTH
-        header |= (0b111 & msg.msg_class) << CoAP.MSG_CLASS
-        header |= (0x1F & msg.msg_code) << CoAP.MSG_CODE
-        header |= (0xFFFF & msg.msg_id) << CoAP.MSG_ID
-        if msg.token_length:
-            header = (header << 8 * msg.token_length) | msg.token
-        return header.to_bytes(CoAP.HEADER_LEN + msg.token_length, 'big')
+        token_length = msg.token_length
+        header_struct = CoAP.TOKEN_HEADER_STRUCTS.get(token_length)
+        first_byte = (msg.header_version << 6) | ((0b11 & msg.msg_type) << 4) | (0x0F & token_length)
+        second_byte = ((0b111 & msg.msg_class) << 5) | (0x1F & msg.msg_code)
+        if not token_length:
+            return CoAP.HEADER_STRUCT.pack(first_byte, second_byte, 0xFFFF & msg.msg_id)
+        elif header_struct:
+            return header_struct.pack(first_byte, second_byte, 0xFFFF & msg.msg_id, msg.token)
+        return CoAP.HEADER_STRUCT.pack(first_byte, second_byte, 0xFFFF & msg.msg_id) \
+            + msg.token.to_bytes(token_length, 'big')
+
+    @staticmethod
+    def token_length(token: int) -> int:
+        """
+        Number of bytes needed to encode a token.
+        """
+        return (token.bit_length() + 7) // 8
+
+    @staticmethod
+    def encode_options(options: CoAPOptions) -> bytes:
+        """
+        Encodes options as specified by RFC-7252 section 3.1: each option is preceded by the delta
+        from the previous option number and by its length, both extended with 1 or 2 bytes if needed.
+
+        :param options: The options to be encoded.
+        :return: bytes representing the encoded options.
+        """
+        encoded = bytearray()
+        last_number = 0
+        for number, value in options:
+            delta_nibble, delta_ext = CoAP.split_option_field(number - last_number)
+            length_nibble, length_ext = CoAP.split_option_field(len(value))
+            encoded.append((delta_nibble << 4) | length_nibble)
+            encoded += delta_ext
+            encoded += length_ext
+            encoded += value
+            last_number = number
+        return bytes(encoded)
+
+    @staticmethod
+    def decode_options(data_bytes: bytes, offset: int) -> Tuple[CoAPOptions, int]:
+        """
+        Decodes the options that start at the given offset, up to the payload marker or the end of the message.
+        Messages without options do not allocate an option table.
+
+        :param data_bytes: The bytes that encode the message.
+        :param offset: The position of the first option, right after the token.
+        :return: The decoded options and the position where the payload starts.
+        """
+        end = len(data_bytes)
+        if offset == end:
+            return CoAPOptions.EMPTY, end
+        if data_bytes[offset] == CoAP.PAYLOAD_MARKER[0]:
+            if offset + 1 == end:
+                raise InvalidFormat("Payload marker followed by an empty payload")
+            return CoAPOptions.EMPTY, offset + 1
+
+        options = CoAPOptions()
+        numbers, values = options.numbers, options.values
+        number = 0
+        while offset < end:
+            option_header = data_bytes[offset]
+            offset += 1
+            if option_header == CoAP.PAYLOAD_MARKER[0]:
+                if offset == end:
+                    raise InvalidFormat("Payload marker followed by an empty payload")
+                return options, offset
+            delta, offset = CoAP.read_option_field(option_header >> 4, data_bytes, offset)
+            length, offset = CoAP.read_option_field(option_header & 0x0F, data_bytes, offset)
+            if offset + length > end:
+                raise InvalidFormat("Option value exceeds message length")
+            # Deltas are never negative, so appending keeps the table sorted
+            number += delta
+            numbers.append(number)
+            values.append(bytes(data_bytes[offset:offset + length]))
+            offset += length
+        return options, end
+
+    @staticmethod
+    def split_option_field(value: int) -> Tuple[int, bytes]:
+        if value < 13:
+            return value, b''
+        elif value < 269:
+            return CoAP.OPTION_EXT_BYTE, (value - 13).to_bytes(1, 'big')
+        return CoAP.OPTION_EXT_WORD, (value - 269).to_bytes(2, 'big')
+
+    @staticmethod
+    def read_option_field(nibble: int, data_bytes: bytes, offset: int) -> Tuple[int, int]:
+        if nibble < CoAP.OPTION_EXT_BYTE:
+            return nibble, offset
+        elif nibble == CoAP.OPTION_EXT_BYTE:
+            if offset + 1 > len(data_bytes):
+                raise InvalidFormat("Truncated option header")
+            return data_bytes[offset] + 13, offset + 1
+        elif nibble == CoAP.OPTION_EXT_WORD:
+            if offset + 2 > len(data_bytes):
+                raise InvalidFormat("Truncated option header")
+            return int.from_bytes(data_bytes[offset:offset + 2], 'big') + 269, offset + 2
+        raise InvalidFormat("Option header uses reserved value 15")
+
+    @staticmethod
+    def encode_uint(value: int) -> bytes:
+        """
+        Encodes an unsigned integer option value using as few bytes as possible (zero is encoded as no bytes).
+        """
+        return value.to_bytes((value.bit_length() + 7) // 8, 'big')
+
+    @staticmethod
+    def decode_uint(value: bytes) -> int:
+        return int.from_bytes(value, 'big')
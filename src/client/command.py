@@ -1,8 +1,12 @@
 import abc
-from typing import Callable
+import posixpath
+from typing import Callable, Hashable, Iterable, List, Optional, Tuple
 
-from src.client.coap_message import CoAP
-from src.file_system.fs_parser import FSParser
+from src.client.coap_message import CoAP, CoAPMessage, CoAPOptions
+from src.client.exceptions import InvalidFormat
+from src.file_system.dir_cache import DirectoryCache
+from src.file_system.file_system import Directory, DirectoryListing, FSComponent
+from src.file_system.fs_parser import DirectoryParser, FSParser
 
 
 class FSCommand(metaclass=abc.ABCMeta):
@@ -21,9 +25,89 @@ class FSCommand(metaclass=abc.ABCMeta):
     CMD_NEWF = '\x04'
     CMD_NEWD = '\x05'
     CMD_DEL = '\x06'
+    CMD_BATCH = '\x07'
 
-    def __init__(self, callback: Callable):
+    # Scheduling priorities, lower is served first
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_BACKGROUND = 1
+    PRIORITY_BULK = 2
+
+    def __init__(self, callback: Callable, priority: int = PRIORITY_INTERACTIVE):
         self.callback = callback
+        self.priority = priority
+        # Called with a description of the error if the command fails
+        self.failure_callback: Optional[Callable[[str], None]] = None
+        # Whether the command keeps receiving notifications after the response, see CachedListingCommand
+        self.observe = False
+        # Identical commands executed together with this one, see coalesce()
+        self.coalesced: List[FSCommand] = []
+        # Seconds spent in the command queue before being sent
+        self.queue_wait = 0.0
+
+    @property
+    def is_background(self) -> bool:
+        """
+        Background commands were not issued by the user, so their errors are not displayed.
+        """
+        return self.priority == FSCommand.PRIORITY_BACKGROUND
+
+    @property
+    def coalesce_key(self) -> Optional[Hashable]:
+        """
+        Commands with the same key send the same request and can share it, see request_key().
+        None for commands that must always be sent on their own.
+        The key depends on the state of the command, e.g. whether it observes, so it is computed once
+        when the command is queued or sent.
+        """
+        return None
+
+    @staticmethod
+    def request_key(msg_class: int, msg_code: int, payload: str, options: CoAPOptions) -> Hashable:
+        """
+        Identity of a request: its method, its payload (e.g. the path) and its options as sent, e.g. ETag and Observe.
+        """
+        return msg_class, msg_code, payload, tuple(options)
+
+    def coalesce(self, other: 'FSCommand'):
+        """
+        Makes the command stand for an identical command as well: the other command is not sent,
+        it completes or fails together with this one.
+
+        :param other: A command with the same coalesce_key.
+        :return: None
+        """
+        self.coalesced.append(other)
+        self.coalesced.extend(other.coalesced)
+        other.coalesced = []
+
+    def supersedes(self, other: 'FSCommand') -> bool:
+        """
+        Whether the command should stand for an identical one when the two are coalesced: commands of higher
+        priority do, and so do newer commands of the same priority, which reflect the latest state of the GUI.
+        Whether they observe comes first, since only the command that is sent receives notifications: an observing
+        command supersedes one whose observation was cancelled, and never the other way around.
+        """
+        if self.observe != other.observe:
+            return self.observe
+        return self.priority <= other.priority
+
+    def take_coalesced(self) -> List['FSCommand']:
+        # Coalesced commands wait for a single response, later notifications are not theirs
+        coalesced, self.coalesced = self.coalesced, []
+        return coalesced
+
+    def fail(self, reason: str):
+        """
+        Called when the command could not be executed: the server did not respond, answered with an error
+        or sent incorrect data.
+
+        :param reason: Description of the error.
+        :return: None
+        """
+        if self.failure_callback:
+            self.failure_callback(reason)
+        for cmd in self.take_coalesced():
+            cmd.fail(reason)
 
     @staticmethod
     @abc.abstractmethod
@@ -48,6 +132,21 @@ class FSCommand(metaclass=abc.ABCMeta):
     def coap_payload(self) -> str:
         raise NotImplementedError('Attempt to access property of abstract base class FSCommand')
 
+    @property
+    def coap_options(self) -> CoAPOptions:
+        return CoAPOptions.EMPTY
+
+    def exec_response(self, coap_response: CoAPMessage):
+        """
+        Called once the client has received an OK response from the server.
+        By default, the command is executed with the response payload. Commands that depend on
+        the response code or options override this method.
+
+        :param coap_response: The complete response from the server.
+        :return: None
+        """
+        self.exec(coap_response.payload)
+
     @abc.abstractmethod
     def exec(self, response_data: str):
         """
@@ -60,6 +159,103 @@ class FSCommand(metaclass=abc.ABCMeta):
         pass
 
 
+class CachedListingCommand(FSCommand, abc.ABC):
+    """
+    Base class for commands that receive directory listings which can be kept in a DirectoryCache.
+    If the expected listing is cached, its ETag is sent along with the request. A 2.03 Valid response
+    without payload means the cached listing is still up to date, so it is reused without parsing anything.
+    Listings received in full replace the cached ones.
+    With observe set, the command also registers for notifications (RFC-7641): whenever the listing changes,
+    the server sends it again and the callback is called with the new listing. The observation lasts until
+    cancel_observation() is called.
+    Listings larger than STREAM_THRESHOLD bytes are parsed in chunks. If chunk_callback is set, it is called with
+    the name of the directory and every chunk of children as soon as the chunk is parsed, so that the first
+    children can be displayed before the whole listing is parsed. The callback still receives the whole listing.
+    """
+
+    STREAM_THRESHOLD = 256 * 1024
+
+    def __init__(self, callback: Callable, cache: DirectoryCache = None, observe: bool = False,
+                 priority: int = FSCommand.PRIORITY_INTERACTIVE):
+        super().__init__(callback, priority)
+        self.cache = cache
+        self.observe = observe
+        # Called with the name of the directory and each chunk of a large listing, see DirectoryParser.parse_chunks()
+        self.chunk_callback: Optional[Callable[[str, DirectoryListing], None]] = None
+
+    @property
+    @abc.abstractmethod
+    def cache_key(self) -> str:
+        """
+        Path of the directory whose listing is expected in the response.
+        """
+        pass
+
+    @property
+    def coap_options(self) -> CoAPOptions:
+        options = []
+        if self.observe:
+            options.append((CoAP.OPTION_OBSERVE, CoAP.encode_uint(CoAP.OBSERVE_REGISTER)))
+        entry = self.cache.get(self.cache_key) if self.cache is not None else None
+        if entry and entry.etag is not None:
+            options.append((CoAP.OPTION_ETAG, entry.etag))
+        return CoAPOptions(options) if options else CoAPOptions.EMPTY
+
+    @property
+    def coalesce_key(self) -> Optional[Hashable]:
+        return FSCommand.request_key(self.get_coap_class(), self.get_coap_code(), self.coap_payload, self.coap_options)
+
+    def cancel_observation(self):
+        """
+        Stops the command from receiving notifications. Can be called from any thread: the client removes
+        the observation and deregisters it from the server the next time it checks its observations,
+        see BaseClient.forget_cancelled_observations().
+        """
+        self.observe = False
+
+    def exec_response(self, coap_response: CoAPMessage):
+        entry = self.cache.get(self.cache_key) if self.cache is not None else None
+        max_age = coap_response.options.get_uint(CoAP.OPTION_MAX_AGE, DirectoryCache.DEFAULT_MAX_AGE)
+        if entry and coap_response.msg_code == CoAP.CODE_VALID and coap_response.payload_length == 0:
+            # The cached listing is still valid
+            entry.refresh(max_age)
+            self.deliver(entry.directory)
+            return
+        # Parse straight from the received payload, without decoding it into the message first
+        if self.chunk_callback and coap_response.payload_length > CachedListingCommand.STREAM_THRESHOLD:
+            component = self.parse_streaming(FSParser.decode(coap_response.payload_buffer))
+        else:
+            component = FSParser.parse(coap_response.payload_buffer)
+        if self.cache is not None and isinstance(component, Directory):
+            self.cache.put(component.name, component, coap_response.get_option(CoAP.OPTION_ETAG),
+                           coap_response.payload_length, max_age)
+        self.deliver(component)
+
+    def parse_streaming(self, string: str) -> FSComponent:
+        if not string.startswith('d'):
+            return FSParser.parse(string)
+        name, chunks = DirectoryParser.parse_chunks(string)
+        directory = Directory(name)
+        for chunk in chunks:
+            directory.children.extend(chunk)
+            # The callback may be removed by another thread while the listing is parsed
+            chunk_callback = self.chunk_callback
+            if chunk_callback:
+                chunk_callback(name, chunk)
+        return directory
+
+    def exec(self, response_data: str):
+        self.deliver(FSParser.parse(response_data))
+
+    def deliver(self, component: FSComponent):
+        """
+        Hands the received component to the callback of the command and of the commands coalesced with it.
+        """
+        for cmd in (self, *self.take_coalesced()):
+            if cmd.callback:
+                cmd.callback(component)
+
+
 class PingCommand(FSCommand):
     """
     Class that implements the PING command.
@@ -96,7 +292,7 @@ class PingCommand(FSCommand):
         pass
 
 
-class BackCommand(FSCommand):
+class BackCommand(CachedListingCommand):
     """
     Class that implements the BACK command.
     Allows the user to go to the previous directory.
@@ -104,10 +300,15 @@ class BackCommand(FSCommand):
     CoAP payload = <CMD_BACK><path_to_dir>
     """
 
-    def __init__(self, current_dir_path: str, callback: Callable = None):
-        super().__init__(callback)
+    def __init__(self, current_dir_path: str, callback: Callable = None, cache: DirectoryCache = None,
+                 observe: bool = False, priority: int = FSCommand.PRIORITY_INTERACTIVE):
+        super().__init__(callback, cache, observe, priority)
         self.current_dir_path = current_dir_path
 
+    @property
+    def cache_key(self) -> str:
+        return posixpath.dirname(self.current_dir_path)
+
     @staticmethod
     def get_coap_class() -> int:
         return CoAP.CLASS_METHOD
@@ -124,14 +325,8 @@ class BackCommand(FSCommand):
     def coap_payload(self) -> str:
         return f'{FSCommand.CMD_BACK}{self.current_dir_path}'
 
-    def exec(self, response_data: str):
-        if self.callback:
-            # parse response and get the directory to go to
-            new_dir = FSParser.parse(response_data)
-            self.callback(new_dir)
 
-
-class OpenCommand(FSCommand):
+class OpenCommand(CachedListingCommand):
     """
     Class that implements the OPEN command.
     Allows the user to open a directory or file.
@@ -139,10 +334,15 @@ class OpenCommand(FSCommand):
     CoAP payload = <CMD_OPEN><path_to_component>
     """
 
-    def __init__(self, component_path: str, callback: Callable = None):
-        super().__init__(callback)
+    def __init__(self, component_path: str, callback: Callable = None, cache: DirectoryCache = None,
+                 observe: bool = False, priority: int = FSCommand.PRIORITY_INTERACTIVE):
+        super().__init__(callback, cache, observe, priority)
         self.component_path = component_path
 
+    @property
+    def cache_key(self) -> str:
+        return self.component_path
+
     @staticmethod
     def get_coap_class() -> int:
         return CoAP.CLASS_METHOD
@@ -159,23 +359,22 @@ class OpenCommand(FSCommand):
     def coap_payload(self) -> str:
         return f'{FSCommand.CMD_OPEN}{self.component_path}'
 
-    def exec(self, response_data: str):
-        if self.callback:
-            # Parse response and get the component to be opened
-            to_open = FSParser.parse(response_data)
-            self.callback(to_open)
-
 
 class SaveCommand(FSCommand):
     """
     Class that implements the SAVE command.
     Allows the user to save the state of the opened file.
 
+    Saving a large file is bulk work, scheduled after the other commands of the user.
+
     CoAP payload = <CMD_SAVE><path_to_file>\x00<file_content>
     """
 
+    BULK_SIZE = 4096
+
     def __init__(self, file_path: str, content: str, callback: Callable = None):
-        super().__init__(callback)
+        super().__init__(callback, FSCommand.PRIORITY_BULK if len(content) > SaveCommand.BULK_SIZE
+                         else FSCommand.PRIORITY_INTERACTIVE)
         self.file_path = file_path
         self.content = content
 
@@ -301,3 +500,95 @@ class DeleteCommand(FSCommand):
         if self.callback:
             # No need to parse the response, just delete the component
             self.callback()
+
+
+class BatchResult:
+    """
+    Outcome of a single operation of a batch.
+    """
+
+    def __init__(self, cmd_header: str, path: str, error: Optional[str] = None):
+        self.cmd_header = cmd_header
+        self.path = path
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def name(self) -> str:
+        return posixpath.basename(self.path)
+
+
+class BatchCommand(FSCommand):
+    """
+    Class that implements the BATCH command.
+    Executes several DELETE, NEW FILE and NEW DIR operations in a single exchange instead of one exchange
+    per component. Batches larger than a block are uploaded block-wise.
+    The server executes every operation, even if some of them fail, and answers with one result per operation,
+    in the order of the operations. The callback receives the list of BatchResult.
+
+    CoAP payload = <CMD_BATCH><cmd_header><path>\x00<cmd_header><path>...
+    Response payload = <result>\x00<result>... where result = <RESULT_OK> | <RESULT_ERROR><reason>
+    """
+
+    OPERATIONS = (FSCommand.CMD_DEL, FSCommand.CMD_NEWF, FSCommand.CMD_NEWD)
+    RESULT_OK = '+'
+    RESULT_ERROR = '-'
+
+    def __init__(self, operations: Iterable[Tuple[str, str]], callback: Callable = None):
+        super().__init__(callback)
+        self.operations = list(operations)
+        if not self.operations:
+            raise ValueError('Empty batch')
+        for cmd_header, path in self.operations:
+            if cmd_header not in BatchCommand.OPERATIONS:
+                raise ValueError(f'Unsupported batch operation: {cmd_header!r}')
+            if '\x00' in path:
+                raise ValueError(f'Invalid path: {path!r}')
+
+    @staticmethod
+    def delete(paths: Iterable[str], callback: Callable = None) -> 'BatchCommand':
+        return BatchCommand(((FSCommand.CMD_DEL, path) for path in paths), callback)
+
+    @staticmethod
+    def create(paths: Iterable[str], is_file: bool, callback: Callable = None) -> 'BatchCommand':
+        cmd_header = FSCommand.CMD_NEWF if is_file else FSCommand.CMD_NEWD
+        return BatchCommand(((cmd_header, path) for path in paths), callback)
+
+    @staticmethod
+    def get_coap_class() -> int:
+        return CoAP.CLASS_METHOD
+
+    @staticmethod
+    def get_coap_code() -> int:
+        return CoAP.CODE_POST
+
+    @staticmethod
+    def server_data_required() -> bool:
+        return True
+
+    @property
+    def coap_payload(self) -> str:
+        return FSCommand.CMD_BATCH + '\x00'.join(f'{cmd_header}{path}' for cmd_header, path in self.operations)
+
+    @staticmethod
+    def parse_results(operations: List[Tuple[str, str]], response_data: str) -> List[BatchResult]:
+        results = response_data.split('\x00')
+        if len(results) != len(operations):
+            raise InvalidFormat(f'Expected {len(operations)} batch results, got {len(results)}')
+        parsed = []
+        for (cmd_header, path), result in zip(operations, results):
+            if result == BatchCommand.RESULT_OK:
+                parsed.append(BatchResult(cmd_header, path))
+            elif result.startswith(BatchCommand.RESULT_ERROR):
+                parsed.append(BatchResult(cmd_header, path, result[1:] or 'Unknown error'))
+            else:
+                raise InvalidFormat(f'Invalid batch result: {result!r}')
+        return parsed
+
+    def exec(self, response_data: str):
+        results = BatchCommand.parse_results(self.operations, response_data)
+        if self.callback:
+            self.callback(results)
@@ -0,0 +1,141 @@
+import collections
+import queue
+import threading
+import time
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+from src.client.command import FSCommand
+
+
+class QueueWaitStats:
+    """
+    Time spent in the queue by the commands of a priority class.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def record(self, wait: float):
+        self.count += 1
+        self.total += wait
+        self.maximum = max(self.maximum, wait)
+
+
+class CommandQueue:
+    """
+    Thread-safe queue of commands waiting to be sent, with the same put()/get() interface as queue.Queue.
+    Commands are served by priority (FSCommand.priority, lower first) and in FIFO order within a priority,
+    so commands issued by the user never wait behind background work such as prefetches, or behind bulk
+    work such as saving a large file.
+    A command identical to one that is still waiting (see FSCommand.coalesce_key) is not queued again: the two
+    share a single request, sent for the command that supersedes the other. The key of a command is computed
+    once, when it is queued, so a waiting command stays identical to the request it was queued for even if
+    its state changes afterwards, e.g. if its observation is cancelled.
+    The time each command spent in the queue is stored in FSCommand.queue_wait and aggregated per priority
+    in wait_stats.
+    """
+
+    def __init__(self):
+        self.queues: Deque[Deque[FSCommand]] = collections.deque()
+        self.by_priority: Dict[int, Deque[FSCommand]] = {}
+        self.pending: Dict[Hashable, FSCommand] = {}
+        self.queued_at: Dict[int, float] = {}
+        # Coalesce keys of the waiting commands, by id
+        self.keys: Dict[int, Hashable] = {}
+        self.wait_stats: Dict[int, QueueWaitStats] = collections.defaultdict(QueueWaitStats)
+        self.not_empty = threading.Condition(threading.Lock())
+        self.length = 0
+        # Called once a command was queued, e.g. to wake up a client that is waiting for messages
+        self.put_callback: Optional[Callable[[], None]] = None
+
+    def __len__(self) -> int:
+        with self.not_empty:
+            return self.length
+
+    def qsize(self) -> int:
+        return len(self)
+
+    def empty(self) -> bool:
+        return len(self) == 0
+
+    def put(self, cmd: FSCommand, block: bool = True, timeout: Optional[float] = None):
+        with self.not_empty:
+            key = cmd.coalesce_key
+            waiting = self.pending.get(key) if key is not None else None
+            if waiting is None:
+                self.queue_for(cmd.priority).append(cmd)
+                self.length += 1
+                self.queued_at[id(cmd)] = time.monotonic()
+            elif not cmd.supersedes(waiting):
+                waiting.coalesce(cmd)
+                return
+            else:
+                self.replace(waiting, cmd)
+            if key is not None:
+                self.pending[key] = cmd
+                self.keys[id(cmd)] = key
+            self.not_empty.notify()
+        if self.put_callback:
+            self.put_callback()
+
+    def put_nowait(self, cmd: FSCommand):
+        self.put(cmd, block=False)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> FSCommand:
+        """
+        Removes and returns the first command of the highest priority.
+
+        :raises queue.Empty: if no command is available, immediately or within the timeout.
+        """
+        with self.not_empty:
+            if block:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self.length:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            elif not self.length:
+                raise queue.Empty
+            commands = next(commands for commands in self.queues if commands)
+            self.length -= 1
+            cmd = commands.popleft()
+            key = self.keys.pop(id(cmd), None)
+            if key is not None and self.pending.get(key) is cmd:
+                del self.pending[key]
+            cmd.queue_wait = time.monotonic() - self.queued_at.pop(id(cmd))
+            self.wait_stats[cmd.priority].record(cmd.queue_wait)
+            return cmd
+
+    def get_nowait(self) -> FSCommand:
+        return self.get(block=False)
+
+    def replace(self, waiting: FSCommand, cmd: FSCommand):
+        """
+        Puts a command in the place of an identical one that is waiting, which is coalesced into it.
+        A command of higher priority moves to the end of its own queue instead.
+        """
+        commands = self.by_priority[waiting.priority]
+        if cmd.priority == waiting.priority:
+            commands[commands.index(waiting)] = cmd
+        else:
+            commands.remove(waiting)
+            self.queue_for(cmd.priority).append(cmd)
+        # The request was waiting since the first command was queued
+        self.queued_at[id(cmd)] = self.queued_at.pop(id(waiting))
+        del self.keys[id(waiting)]
+        cmd.coalesce(waiting)
+
+    def queue_for(self, priority: int) -> Deque[FSCommand]:
+        commands = self.by_priority.get(priority)
+        if commands is None:
+            commands = self.by_priority[priority] = collections.deque()
+            # Keep the queues sorted by priority, there are only a few of them
+            self.queues = collections.deque(self.by_priority[p] for p in sorted(self.by_priority))
+        return commands
@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Tuple
+
+from src.client.client import Client
+from src.client.command import FSCommand
+from src.client.command_queue import CommandQueue
+from src.client.metrics import MetricsRegistry
+from src.client.resolver import Resolver
+from src.file_system.remote_tree import RemoteTree
+
+
+class Connection:
+    """
+    A client connected to one server, together with the thread that runs it, its command queue
+    and the mirror of the directory tree of the server.
+    """
+
+    def __init__(self, client: Client):
+        self.client = client
+        self.remote_tree = RemoteTree()
+        self.thread = threading.Thread(target=self.run, name=f'client-{self.address}', daemon=True)
+        self.last_used = time.monotonic()
+
+    @property
+    def address(self) -> str:
+        ip = self.client.server_ip
+        return f'[{ip}]:{self.client.server_port}' if ':' in ip else f'{ip}:{self.client.server_port}'
+
+    @property
+    def is_alive(self) -> bool:
+        return self.thread.is_alive()
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.client.run()
+        finally:
+            # The socket is only used by this thread, so it is closed here once the client stopped
+            self.client.close()
+
+    def send(self, cmd: FSCommand):
+        self.last_used = time.monotonic()
+        self.client.msg_queue.put(cmd)
+
+    def stop(self):
+        """
+        Makes the client stop after the current iteration, at most Client.QUEUE_TIMEOUT seconds later.
+        """
+        self.client.is_running = False
+
+
+class ConnectionPool:
+    """
+    Clients of all the servers the user connected to, keyed by (ip, port).
+    Connecting to a server again reuses its client, so switching servers costs neither a name lookup nor
+    a new socket, and the listings of the server are still cached. Host names are resolved by the resolver
+    shared by all clients, which caches them and picks the address of hosts with several addresses.
+    Connections that were not used for idle_timeout seconds are shut down by close_idle(), and the least
+    recently used connection is shut down when the pool holds more than max_connections.
+    """
+
+    IDLE_TIMEOUT = 300.0
+    MAX_CONNECTIONS = 8
+
+    def __init__(self, idle_timeout: float = IDLE_TIMEOUT, max_connections: int = MAX_CONNECTIONS,
+                 resolver: Resolver = None, **client_params):
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.resolver = Client.RESOLVER if resolver is None else resolver
+        self.client_params = client_params
+        self.connections: 'OrderedDict[Tuple[str, int], Connection]' = OrderedDict()
+        # Connections are made from worker threads and closed from the GUI thread
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def __iter__(self) -> Iterator[Connection]:
+        with self.lock:
+            return iter(list(self.connections.values()))
+
+    def connect(self, host: str, port: int) -> Connection:
+        """
+        Returns the connection to a server, starting a new one if the server is not in the pool.
+
+        :raises OSError: if the host name cannot be resolved or the socket cannot be created.
+        """
+        connection = self.find(host, port)
+        if connection:
+            return connection
+        (_, address), sock = self.resolver.connect(host, port)
+        key = (address[0], port)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection and connection.is_alive:
+                if sock:
+                    sock.close()
+                self.connections.move_to_end(key)
+                connection.last_used = time.monotonic()
+                return connection
+            client = Client(server_ip=key[0], server_port=port, msg_queue=CommandQueue(), sock=sock,
+                            **self.client_params)
+            connection = self.connections[key] = Connection(client)
+            connection.start()
+            while len(self.connections) > self.max_connections:
+                _, evicted = self.connections.popitem(last=False)
+                evicted.stop()
+            return connection
+
+    def find(self, host: str, port: int) -> Optional[Connection]:
+        """
+        Finds a running connection to any address of the host.
+        """
+        addresses = self.resolver.resolve(host, port)
+        with self.lock:
+            for _, address in addresses:
+                key = (address[0], port)
+                connection = self.connections.get(key)
+                if connection and connection.is_alive:
+                    self.connections.move_to_end(key)
+                    connection.last_used = time.monotonic()
+                    return connection
+        return None
+
+    def close_idle(self, active: Optional[Connection] = None) -> List[Connection]:
+        """
+        Shuts down the connections that were not used for idle_timeout seconds, except for the active one.
+
+        :return: List[Connection] - the connections that were shut down.
+        """
+        now = time.monotonic()
+        with self.lock:
+            idle = [key for key, connection in self.connections.items()
+                    if connection is not active and (now - connection.last_used > self.idle_timeout
+                                                     or not connection.is_alive)]
+            closed = [self.connections.pop(key) for key in idle]
+        for connection in closed:
+            connection.stop()
+        return closed
+
+    def registries(self) -> List[MetricsRegistry]:
+        """
+        Metrics of the clients in the pool, for a MetricsExporter.
+        """
+        return [connection.client.metrics.registry for connection in self]
+
+    def close_all(self):
+        with self.lock:
+            closed = list(self.connections.values())
+            self.connections.clear()
+        for connection in closed:
+            connection.stop()
@@ -0,0 +1,145 @@
+import time
+from typing import Optional, Dict, Hashable, List
+
+from src.client.block_transfer import BlockTransfer
+from src.client.coap_message import CoAPMessage, CoAP
+from src.client.command import FSCommand
+
+
+class PendingRequest:
+    """
+    Bookkeeping for a CoAP request that has been sent and still awaits its response.
+    The request is considered done once a response has been matched to it or once it expired.
+    """
+
+    def __init__(self, coap_msg: CoAPMessage, cmd: FSCommand = None, timeout: float = 1.0, attempts: int = 1,
+                 max_retransmit: int = 0):
+        self.coap_msg = coap_msg
+        self.cmd = cmd
+        self.timeout = timeout
+        # Resend attempts left in case of invalid responses
+        self.attempts = attempts
+        # Retransmissions left in case of timeouts
+        self.max_retransmit = max_retransmit
+        self.retransmissions_left = max_retransmit
+        # State of the block-wise transfer, if the payloads do not fit in a single message
+        self.transfer: Optional[BlockTransfer] = None
+        self.started_at = self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timeout
+        # Whether the current message was sent more than once, in which case its round-trip time is unknown
+        self.retransmitted = False
+        self.acknowledged = False
+        self.response = None
+        self.done = False
+        # Whether the request registers an observation, later messages of the exchange do not carry the option
+        self.observe = coap_msg.get_option(CoAP.OPTION_OBSERVE) is not None
+        # Identity of the request as sent, see FSCommand.coalesce_key. The command may change while it is in flight
+        self.coalesce_key: Optional[Hashable] = None
+        if cmd is not None and cmd.coalesce_key is not None:
+            self.coalesce_key = FSCommand.request_key(coap_msg.msg_class, coap_msg.msg_code, coap_msg.payload,
+                                                      coap_msg.options)
+
+    @property
+    def msg_id(self) -> int:
+        return self.coap_msg.msg_id
+
+    @property
+    def token(self) -> Optional[int]:
+        return self.coap_msg.token if self.coap_msg.token_length else None
+
+    def restart_timer(self):
+        self.deadline = time.monotonic() + self.timeout
+
+    def back_off(self):
+        """
+        Doubles the timeout before a retransmission, as specified by RFC-7252 section 4.2.
+        """
+        self.retransmissions_left -= 1
+        self.timeout *= 2
+        self.retransmitted = True
+        self.restart_timer()
+
+    def continue_with(self, coap_msg: CoAPMessage, timeout: float):
+        """
+        Replaces the message of the request with the next message of the same exchange, e.g. the next block
+        of a block-wise transfer. The retransmission state starts over for the new message.
+        """
+        self.coap_msg = coap_msg
+        self.timeout = timeout
+        self.acknowledged = False
+        self.retransmissions_left = self.max_retransmit
+        self.retransmitted = False
+        self.sent_at = time.monotonic()
+        self.restart_timer()
+
+    def complete(self, response: Optional[CoAPMessage]):
+        self.response = response
+        self.done = True
+
+
+class InFlightTable:
+    """
+    Table of all requests currently awaiting a response, indexed both by message ID and by token.
+    Acknowledges and Resets are matched by message ID, while separate responses are matched by token,
+    which allows any number of requests to be outstanding at the same time.
+    Requests for data that identical commands can share are also indexed by FSCommand.coalesce_key.
+    """
+
+    def __init__(self):
+        self.by_msg_id: Dict[int, PendingRequest] = {}
+        self.by_token: Dict[int, PendingRequest] = {}
+        self.by_key: Dict[Hashable, PendingRequest] = {}
+
+    def __len__(self) -> int:
+        return len(self.by_msg_id)
+
+    def __iter__(self):
+        return iter(list(self.by_msg_id.values()))
+
+    def has_token(self, token: int) -> bool:
+        return token in self.by_token
+
+    def add(self, request: PendingRequest):
+        self.by_msg_id[request.msg_id] = request
+        if request.token is not None:
+            self.by_token[request.token] = request
+        if request.coalesce_key is not None:
+            self.by_key[request.coalesce_key] = request
+
+    def remove(self, request: PendingRequest):
+        self.by_msg_id.pop(request.msg_id, None)
+        if request.token is not None:
+            self.by_token.pop(request.token, None)
+        key = request.coalesce_key
+        if key is not None and self.by_key.get(key) is request:
+            del self.by_key[key]
+
+    def identical(self, cmd: FSCommand) -> Optional[PendingRequest]:
+        """
+        Finds the request in flight that already asks for the data of the given command.
+        """
+        key = cmd.coalesce_key
+        return self.by_key.get(key) if key is not None else None
+
+    def match(self, coap_response: CoAPMessage) -> Optional[PendingRequest]:
+        """
+        Finds the request answered by the given message.
+
+        :param coap_response: The message received from the server.
+        :return: Optional[PendingRequest] - None if the message does not belong to any request in flight.
+        """
+        if coap_response.msg_type in (CoAP.TYPE_ACK, CoAP.TYPE_RESET):
+            request = self.by_msg_id.get(coap_response.msg_id)
+            if request and coap_response.token_length and request.token != coap_response.token:
+                # Piggybacked response with a foreign token
+                return None
+            return request
+        if coap_response.token_length:
+            return self.by_token.get(coap_response.token)
+        return None
+
+    def next_deadline(self) -> Optional[float]:
+        return min((request.deadline for request in self.by_msg_id.values()), default=None)
+
+    def expired(self, now: float) -> List[PendingRequest]:
+        return [request for request in self.by_msg_id.values() if request.deadline <= now]
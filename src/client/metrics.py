@@ -0,0 +1,355 @@
+import abc
+import bisect
+import http.server
+import os
+import tempfile
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    """
+    Monotonically increasing count of events. By convention, the names of counters end with _total.
+    Metrics are only updated by the thread that runs the client, exporters merely read them.
+    """
+
+    TYPE = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        yield '', (), self.value
+
+
+class Gauge:
+    """
+    Value that goes up and down, e.g. the depth of a queue. A gauge with a function reads its value when
+    the metrics are collected, so the hot path pays nothing for it.
+    """
+
+    TYPE = 'gauge'
+
+    def __init__(self, function: Callable[[], float] = None):
+        self.function = function
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self.function() if self.function else self.value
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        yield '', (), self.get()
+
+
+class Histogram:
+    """
+    Distribution of observed values, counted in fixed buckets by their upper bound.
+    Observing a value costs a binary search and two additions.
+    """
+
+    TYPE = 'histogram'
+    # Seconds, from a local server to a very bad link
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        # The last bucket counts the values above every bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile by interpolating within its bucket, like Prometheus' histogram_quantile().
+        Values above the last bound are reported as the last bound.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.bounds[-1]
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield '_bucket', (('le', repr(bound)),), cumulative
+        yield '_bucket', (('le', '+Inf'),), self.count
+        yield '_sum', (), self.sum
+        yield '_count', (), self.count
+
+
+class MetricsRegistry:
+    """
+    Metrics of one component, e.g. of a client. Every metric is identified by its name and labels, and the labels
+    of the registry (e.g. the server address) are added to all of them when exported.
+    """
+
+    def __init__(self, labels: Dict[str, str] = None):
+        self.labels: Labels = tuple(sorted((labels or {}).items()))
+        # Name mapped to (type, help text) and (name, labels) mapped to the metric
+        self.families: Dict[str, Tuple[str, str]] = {}
+        self.metrics: Dict[Tuple[str, Labels], object] = {}
+        self.lock = threading.Lock()
+
+    def add_label(self, name: str, value: str):
+        """
+        Adds a label to all metrics of the registry, e.g. to tell apart several clients of the same server.
+        """
+        self.labels = tuple(sorted(dict(self.labels, **{name: value}).items()))
+
+    def counter(self, name: str, description: str, labels: Dict[str, str] = None) -> Counter:
+        return self.register(name, description, labels, Counter)
+
+    def gauge(self, name: str, description: str, function: Callable[[], float] = None,
+              labels: Dict[str, str] = None) -> Gauge:
+        return self.register(name, description, labels, lambda: Gauge(function))
+
+    def histogram(self, name: str, description: str, labels: Dict[str, str] = None,
+                  buckets: Tuple[float, ...] = Histogram.LATENCY_BUCKETS) -> Histogram:
+        return self.register(name, description, labels, lambda: Histogram(buckets))
+
+    def register(self, name: str, description: str, labels: Optional[Dict[str, str]], factory: Callable):
+        """
+        Returns the metric with the given name and labels, creating it the first time.
+
+        :raises ValueError: if a metric with the same name but of another type exists.
+        """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = factory()
+                family = self.families.setdefault(name, (metric.TYPE, description))
+                if family[0] != metric.TYPE:
+                    raise ValueError(f'Metric {name} is a {family[0]}, not a {metric.TYPE}')
+                self.metrics[key] = metric
+        return metric
+
+    def get(self, name: str, labels: Dict[str, str] = None):
+        return self.metrics.get((name, tuple(sorted((labels or {}).items()))))
+
+    def collect(self) -> List[Tuple[str, str, str, List[Tuple[str, Labels, float]]]]:
+        """
+        Reads the current value of all metrics.
+
+        :return: List[Tuple[str, str, str, List[Tuple[str, Labels, float]]]] - for every metric family,
+                 the name, type, help text and samples as (name, labels, value).
+        """
+        with self.lock:
+            metrics = list(self.metrics.items())
+            families = dict(self.families)
+        samples = {name: [] for name in families}
+        for (name, labels), metric in metrics:
+            for suffix, sample_labels, value in metric.samples():
+                samples[name].append((name + suffix, self.labels + labels + sample_labels, value))
+        return [(name, kind, description, samples[name]) for name, (kind, description) in families.items()]
+
+
+class PrometheusText:
+    """
+    Renders metrics in the Prometheus text exposition format.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    @staticmethod
+    def render(registries: Iterable[MetricsRegistry]) -> str:
+        # Samples of a family must be grouped, even if they come from several registries
+        families: Dict[str, Tuple[str, str, list]] = {}
+        for registry in registries:
+            for name, kind, description, samples in registry.collect():
+                families.setdefault(name, (kind, description, []))[2].extend(samples)
+        lines = []
+        for name, (kind, description, samples) in families.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample_name, labels, value in samples:
+                lines.append(f'{sample_name}{PrometheusText.format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def format_labels(labels: Labels) -> str:
+        if not labels:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+class MetricsExporter(metaclass=abc.ABCMeta):
+    """
+    Interface for publishing metrics outside of the application.
+    The exporter reads the registries returned by sources whenever it exports, so metrics of clients
+    created later are exported too.
+    """
+
+    def __init__(self, sources: Callable[[], Iterable[MetricsRegistry]]):
+        self.sources = sources
+
+    def render(self) -> str:
+        return PrometheusText.render(self.sources())
+
+    @abc.abstractmethod
+    def start(self):
+        pass
+
+    @abc.abstractmethod
+    def stop(self):
+        pass
+
+
+class PrometheusFileExporter(MetricsExporter):
+    """
+    Writes the metrics to a file every interval seconds, e.g. for the textfile collector of the node exporter.
+    The file is replaced atomically, so readers never see a partial dump.
+    """
+
+    INTERVAL = 10.0
+
+    def __init__(self, path: str, sources: Callable[[], Iterable[MetricsRegistry]], interval: float = INTERVAL):
+        super().__init__(sources)
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def export(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as file:
+            file.write(self.render())
+        os.replace(temp_path, self.path)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='metrics-exporter', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        # The last values are not lost
+        self.export()
+
+
+class PrometheusHttpExporter(MetricsExporter):
+    """
+    Serves the metrics over HTTP at /metrics, to be scraped by Prometheus.
+    Only listens on the loopback interface by default.
+    """
+
+    PORT = 9464
+
+    def __init__(self, sources: Callable[[], Iterable[MetricsRegistry]], ip: str = '127.0.0.1', port: int = PORT):
+        super().__init__(sources)
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', PrometheusText.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Scrapes are not worth logging
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((ip, port), Handler)
+        # The port is chosen by the system if 0 was given
+        self.port = self.server.server_address[1]
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+
+class ClientMetrics:
+    """
+    Metrics of a client: requests, retransmissions and errors, round-trip times, the time spent processing
+    responses and the time commands waited in the queue, by priority.
+    Round-trip times follow Karn's algorithm: exchanges with retransmissions are not measured, since the
+    response cannot be attributed to a transmission.
+    """
+
+    RESPONSE_CLASSES = {2: 'success', 4: 'client_error', 5: 'server_error'}
+
+    def __init__(self, server: str):
+        self.registry = MetricsRegistry({'server': server})
+        registry = self.registry
+        self.requests = registry.counter('coap_client_requests_total', 'Requests sent, not counting retransmissions')
+        self.retransmissions = registry.counter('coap_client_retransmissions_total',
+                                                'Requests sent again after a timeout or an invalid response')
+        self.timeouts = registry.counter('coap_client_timeouts_total', 'Requests abandoned without a response')
+        self.invalid_responses = registry.counter('coap_client_invalid_responses_total',
+                                                  'Messages that could not be parsed')
+        self.resets = registry.counter('coap_client_resets_total',
+                                       'Commands sent again after the server answered Reset')
+        self.responses = {msg_class: registry.counter('coap_client_responses_total', 'Responses by class',
+                                                      {'class': name})
+                          for msg_class, name in ClientMetrics.RESPONSE_CLASSES.items()}
+        self.other_responses = registry.counter('coap_client_responses_total', 'Responses by class',
+                                                {'class': 'other'})
+        self.rtt = registry.histogram('coap_client_rtt_seconds',
+                                      'Round-trip time of exchanges answered without retransmission')
+        self.request_duration = registry.histogram('coap_client_request_duration_seconds',
+                                                   'Time from sending a request to its final response or timeout, '
+                                                   'including retransmissions and block-wise transfers')
+        self.processing = registry.histogram('coap_client_process_response_seconds',
+                                             'Time spent processing responses and executing their commands')
+        self.queue_waits: Dict[int, Histogram] = {}
+
+    def response(self, msg_class: int):
+        self.responses.get(msg_class, self.other_responses).inc()
+
+    def queue_wait(self, priority: int, wait: float):
+        histogram = self.queue_waits.get(priority)
+        if histogram is None:
+            histogram = self.queue_waits[priority] = self.registry.histogram(
+                'coap_client_queue_wait_seconds', 'Time commands waited in the queue, by priority',
+                {'priority': str(priority)})
+        histogram.observe(wait)
+
+    def gauge(self, name: str, description: str, function: Callable[[], float]) -> Gauge:
+        return self.registry.gauge(name, description, function)
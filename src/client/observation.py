@@ -0,0 +1,42 @@
+import time
+from typing import Optional
+
+from src.client.command import FSCommand
+
+
+class Observation:
+    """
+    Registration of a command for notifications about the resource it requested, as specified by RFC-7641.
+    Notifications are matched to the observation by the token of the original request and are executed
+    by the same command, as if they were responses to it.
+    """
+
+    # Observe option values are 24-bit sequence numbers (RFC-7641 section 3.4)
+    SEQUENCE_MODULUS = 1 << 24
+    # Notifications received this long after the previous one are considered fresh regardless of their number
+    FRESHNESS_TIMEOUT = 128.0
+
+    def __init__(self, cmd: FSCommand, token: int, sequence: int):
+        self.cmd = cmd
+        self.token = token
+        self.sequence = sequence
+        self.last_update = time.monotonic()
+
+    def is_fresh(self, sequence: Optional[int]) -> bool:
+        """
+        Tells whether a notification is newer than the last one received, so that notifications
+        reordered by the network do not overwrite more recent ones.
+
+        :param sequence: The Observe option value of the notification, None for the final response.
+        :return: bool - False if the notification is outdated and must be ignored.
+        """
+        if sequence is None:
+            return True
+        half = Observation.SEQUENCE_MODULUS // 2
+        last = self.sequence
+        return (last < sequence and sequence - last < half) or (last > sequence and last - sequence > half) \
+            or time.monotonic() > self.last_update + Observation.FRESHNESS_TIMEOUT
+
+    def update(self, sequence: int):
+        self.sequence = sequence
+        self.last_update = time.monotonic()
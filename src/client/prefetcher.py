@@ -0,0 +1,90 @@
+import collections
+import itertools
+import posixpath
+from typing import Callable, Deque, Dict, List, Set
+
+from src.client.command import FSCommand, OpenCommand
+from src.file_system.dir_cache import DirectoryCache
+from src.file_system.file_system import Directory, FSComponent, DirectoryListing
+from src.file_system.remote_tree import RemoteTree
+
+
+class Prefetcher:
+    """
+    Speculatively requests the listings the user is likely to open next: the parent of the displayed directory
+    and its first subdirectories. The listings end up in the remote tree mirror, from which they are displayed
+    without waiting for the server.
+    Prefetches are background commands, so commands issued by the user are always sent before them.
+    The number of prefetches in flight is limited, and so is the amount of prefetched data that was not opened yet.
+    """
+
+    MAX_CHILDREN = 4
+    MAX_CONCURRENT = 2
+    MAX_BYTES = 1024 * 1024
+
+    def __init__(self, tree: RemoteTree, send: Callable[[FSCommand], None], max_children: int = MAX_CHILDREN,
+                 max_concurrent: int = MAX_CONCURRENT, max_bytes: int = MAX_BYTES):
+        self.tree = tree
+        self.send = send
+        self.max_children = max_children
+        self.max_concurrent = max_concurrent
+        self.max_bytes = max_bytes
+        # Prefetches are requested from the GUI and completed from the client thread. The state of the prefetcher
+        # is guarded by the lock of the tree, so that it is consistent with the listings it refers to
+        self.pending: Deque[str] = collections.deque()
+        self.in_flight: Set[str] = set()
+        # Sizes of the prefetched listings that were not opened yet, by path
+        self.unused: Dict[str, int] = {}
+
+    def prefetch_around(self, directory: Directory):
+        """
+        Schedules the prefetch of the neighbours of a directory the user just opened.
+        Prefetches scheduled for the previously opened directory that were not sent yet are dropped.
+        """
+        path = DirectoryCache.key(directory.name)
+        parent = posixpath.dirname(path)
+        candidates = [parent] if parent != path else []
+        children = (name for name, kind in directory.children.keys() if kind == DirectoryListing.KIND_DIR)
+        candidates.extend(posixpath.join(path, name) for name in itertools.islice(children, self.max_children))
+        with self.tree.lock:
+            # The opened directory no longer counts as speculative data
+            self.unused.pop(path, None)
+            self.pending.clear()
+            self.pending.extend(candidate for candidate in candidates if candidate not in self.in_flight)
+            commands = self.take_commands()
+        for cmd in commands:
+            self.send(cmd)
+
+    def take_commands(self) -> List[FSCommand]:
+        """
+        Creates the prefetch commands that can be sent now. Must be called while holding the lock of the tree.
+        """
+        commands = []
+        while self.pending and len(self.in_flight) < self.max_concurrent and self.unused_bytes() < self.max_bytes:
+            path = self.pending.popleft()
+            node = self.tree.peek(path)
+            if node and node.is_fresh:
+                continue
+            self.in_flight.add(path)
+            cmd = OpenCommand(path, callback=lambda component, p=path: self.on_prefetched(p, component),
+                              cache=self.tree, priority=FSCommand.PRIORITY_BACKGROUND)
+            cmd.failure_callback = lambda reason, p=path: self.on_prefetched(p, None)
+            commands.append(cmd)
+        return commands
+
+    def unused_bytes(self) -> int:
+        # Evicted listings do not take up any space anymore
+        for path in [path for path in self.unused if path not in self.tree]:
+            del self.unused[path]
+        return sum(self.unused.values())
+
+    def on_prefetched(self, path: str, component: FSComponent):
+        with self.tree.lock:
+            self.in_flight.discard(path)
+            if isinstance(component, Directory):
+                node = self.tree.peek(component.name)
+                if node:
+                    self.unused[node.path] = node.size
+            commands = self.take_commands()
+        for cmd in commands:
+            self.send(cmd)
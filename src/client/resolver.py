@@ -0,0 +1,188 @@
+import concurrent.futures
+import ipaddress
+import random
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from src.client.coap_message import CoAP, CoAPMessage
+
+# Address family and socket address, as returned by socket.getaddrinfo()
+Address = Tuple[int, tuple]
+
+
+class Resolver:
+    """
+    Resolves server host names into the addresses datagrams are sent to.
+    Names are resolved with getaddrinfo(), so IPv6 servers are supported as well, and the addresses are cached
+    for ttl seconds. Lookups may run in a worker thread with resolve_async(), so that a slow name server
+    does not block the caller.
+    When a name has several addresses, connect() picks one Happy Eyeballs style (RFC-8305): addresses of both
+    families are tried in turn, a new attempt starting every ATTEMPT_DELAY seconds, and the first one that
+    answers wins. The winner is tried first from then on.
+    """
+
+    TTL = 300.0
+    MAX_ENTRIES = 256
+    # Delay between connection attempts (RFC-8305 section 5)
+    ATTEMPT_DELAY = 0.25
+    # Time to wait for any address to answer before settling for the preferred one
+    CONNECT_TIMEOUT = 2.0
+    # Answers to pings are empty messages, only their arrival matters
+    REPLY_BUFFER_SIZE = 1024
+
+    def __init__(self, ttl: float = TTL, max_entries: int = MAX_ENTRIES, max_workers: int = 2):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+        self.entries: 'OrderedDict[Tuple[str, int], Tuple[float, List[Address]]]' = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    @staticmethod
+    def literal(host: str, port: int) -> Optional[Address]:
+        """
+        Returns the address of a host given as an IPv4 or IPv6 literal, without any lookup.
+        """
+        try:
+            ip = ipaddress.ip_address(host.strip('[]'))
+        except ValueError:
+            return None
+        family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+        return family, (str(ip), port)
+
+    def resolve(self, host: str, port: int) -> List[Address]:
+        """
+        Returns the addresses of a host, the preferred one first.
+
+        :raises OSError: if the name cannot be resolved.
+        """
+        address = Resolver.literal(host, port)
+        if address:
+            return [address]
+        key = (host, port)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                return list(entry[1])
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+        addresses = Resolver.interleave([(family, sockaddr) for family, _, _, _, sockaddr in infos])
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, addresses)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return list(addresses)
+
+    def resolve_async(self, host: str, port: int) -> 'concurrent.futures.Future[List[Address]]':
+        """
+        Resolves a host in a worker thread. Cached names are resolved right away.
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix='resolver')
+        return self.executor.submit(self.resolve, host, port)
+
+    def prefer(self, host: str, port: int, address: Address):
+        """
+        Makes an address of a host the first one to be tried.
+        """
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry and address in entry[1]:
+                entry[1].remove(address)
+                entry[1].insert(0, address)
+
+    def invalidate(self, host: str, port: int):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+    def connect(self, host: str, port: int) -> Tuple[Address, Optional[socket.socket]]:
+        """
+        Finds the address of the host that answers first. Since UDP has no handshake, every attempt sends
+        a CoAP ping (an empty Confirmable message), which any CoAP server answers.
+        Hosts with a single address are not probed.
+
+        :return: Tuple[Address, Optional[socket.socket]] - the address and the socket that reached it,
+                 or the preferred address and None if no address answered in time.
+        :raises OSError: if the name cannot be resolved.
+        """
+        addresses = self.resolve(host, port)
+        if len(addresses) == 1:
+            return addresses[0], None
+        winner, sock = Resolver.race(addresses, Resolver.ATTEMPT_DELAY, Resolver.CONNECT_TIMEOUT)
+        if winner is None:
+            return addresses[0], None
+        self.prefer(host, port, winner)
+        return winner, sock
+
+    @staticmethod
+    def race(addresses: List[Address], attempt_delay: float,
+             timeout: float) -> Tuple[Optional[Address], Optional[socket.socket]]:
+        ping = CoAP.wrap(CoAPMessage('', CoAP.TYPE_CONF, CoAP.CLASS_METHOD, CoAP.CODE_EMPTY,
+                                     random.randint(0, 0xFFFF)))
+        selector = selectors.DefaultSelector()
+        attempts = {}
+        deadline = time.monotonic() + timeout
+        next_attempt = time.monotonic()
+        pending = list(addresses)
+        winner = None
+        try:
+            while winner is None and time.monotonic() < deadline and (pending or attempts):
+                if pending and time.monotonic() >= next_attempt:
+                    family, sockaddr = pending.pop(0)
+                    try:
+                        sock = socket.socket(family, socket.SOCK_DGRAM)
+                        sock.setblocking(False)
+                        sock.sendto(ping, sockaddr)
+                    except OSError:
+                        # E.g. no route for this family, move on to the next address right away
+                        continue
+                    attempts[sock] = (family, sockaddr)
+                    selector.register(sock, selectors.EVENT_READ)
+                    next_attempt = time.monotonic() + attempt_delay
+                if not attempts:
+                    continue
+                wake_up = min(deadline, next_attempt) if pending else deadline
+                for key, _ in selector.select(max(0.0, wake_up - time.monotonic())):
+                    try:
+                        key.fileobj.recv(Resolver.REPLY_BUFFER_SIZE)
+                    except OSError:
+                        # E.g. ICMP port unreachable
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        del attempts[key.fileobj]
+                        continue
+                    winner = key.fileobj
+                    break
+        finally:
+            for sock in attempts:
+                if sock is not winner:
+                    sock.close()
+            selector.close()
+        if winner is None:
+            return None, None
+        winner.setblocking(True)
+        return attempts[winner], winner
+
+    @staticmethod
+    def interleave(addresses: List[Address]) -> List[Address]:
+        """
+        Orders the addresses alternating between families, starting with the family of the first address,
+        as recommended by RFC-8305 section 4. Duplicates are removed.
+        """
+        by_family = OrderedDict()
+        for address in addresses:
+            family_addresses = by_family.setdefault(address[0], [])
+            if address not in family_addresses:
+                family_addresses.append(address)
+        ordered = []
+        while any(by_family.values()):
+            for family_addresses in by_family.values():
+                if family_addresses:
+                    ordered.append(family_addresses.pop(0))
+        return ordered
@@ -0,0 +1,126 @@
+import posixpath
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from src.file_system.file_system import Directory
+
+
+class CacheEntry:
+    """
+    A directory listing received from the server, together with the ETag the server attached to it.
+    The listing is fresh for max_age seconds after it was received (or revalidated), like any CoAP response.
+    """
+
+    def __init__(self, path: str, directory: Directory, etag: Optional[bytes], size: int, max_age: float):
+        self.path = path
+        self.directory = directory
+        self.etag = etag
+        self.size = size
+        self.expires = time.monotonic() + max_age
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.monotonic() < self.expires
+
+    def refresh(self, max_age: float):
+        self.expires = time.monotonic() + max_age
+
+
+class DirectoryCache:
+    """
+    Client-side cache of directory listings, keyed by directory path.
+    The least recently used listings are evicted once the cache holds more than max_entries listings
+    or more than max_bytes of encoded listing data.
+    With intern_names set, the names of cached entries are interned. Directories of the same tree tend to
+    share many names, e.g. build outputs or project templates, which are then stored only once.
+    The cache is read from the GUI thread and updated from the client thread, every access holds the lock.
+    """
+
+    DEFAULT_MAX_ENTRIES = 256
+    DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+    # Freshness of responses without a Max-Age option (RFC-7252 section 5.10.5)
+    DEFAULT_MAX_AGE = 60
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES,
+                 intern_names: bool = False):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.intern_names = intern_names
+        self.size = 0
+        self.entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        # Reentrant, since subclasses extend the operations and call each other while holding it
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+    def __contains__(self, path: str) -> bool:
+        with self.lock:
+            return DirectoryCache.key(path) in self.entries
+
+    @staticmethod
+    def key(path: str) -> str:
+        # '/home//rcp/' and '/home/rcp' are the same directory
+        return posixpath.normpath(path) if path else path
+
+    def get(self, path: str) -> Optional[CacheEntry]:
+        path = DirectoryCache.key(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry:
+                self.entries.move_to_end(path)
+            return entry
+
+    def peek(self, path: str) -> Optional[CacheEntry]:
+        """
+        Same as get(), but does not count as a use of the entry.
+        """
+        with self.lock:
+            return self.entries.get(DirectoryCache.key(path))
+
+    def put(self, path: str, directory: Directory, etag: Optional[bytes], size: int,
+            max_age: float = DEFAULT_MAX_AGE) -> Optional[CacheEntry]:
+        """
+        Stores a listing as the most recently used one, evicting older listings if needed.
+        Listings larger than the whole cache are not stored.
+
+        :return: Optional[CacheEntry] - the new entry, None if the listing was not stored.
+        """
+        path = DirectoryCache.key(path)
+        if self.intern_names:
+            directory.children.intern_names()
+        with self.lock:
+            self.invalidate(path)
+            if size > self.max_bytes:
+                return None
+            entry = self.create_entry(path, directory, etag, size, max_age)
+            self.entries[path] = entry
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.removed(evicted)
+            return entry
+
+    def create_entry(self, path: str, directory: Directory, etag: Optional[bytes], size: int,
+                     max_age: float) -> CacheEntry:
+        return CacheEntry(path, directory, etag, size, max_age)
+
+    def invalidate(self, path: str):
+        with self.lock:
+            entry = self.entries.pop(DirectoryCache.key(path), None)
+            if entry:
+                self.removed(entry)
+
+    def removed(self, entry: CacheEntry):
+        """
+        Called for every entry that leaves the cache, either evicted or invalidated.
+        """
+        self.size -= entry.size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -1,7 +1,17 @@
 import abc
+import sys
+from collections.abc import MutableSequence
+from typing import Iterable, Iterator, Tuple, Union, List, Optional
 
 
 class FSComponent(metaclass=abc.ABCMeta):
+    """
+    Base class of the file system model.
+    All components use __slots__, since listings of many directories may be kept in memory at the same time.
+    """
+
+    __slots__ = ()
+
     @abc.abstractmethod
     def __str__(self) -> str:
         pass
@@ -13,6 +23,8 @@ class FSComponent(metaclass=abc.ABCMeta):
 
 
 class FileContent(FSComponent):
+    __slots__ = ('content',)
+
     def __init__(self, content: str = ''):
         self.content = content
 
@@ -30,14 +42,40 @@ class FSNamedComponent(FSComponent, abc.ABC):
     This type of component is displayed in the GUI by its name.
     """
 
+    __slots__ = ('name',)
+
     def __init__(self, name: str):
         self.name = name
 
+    def __eq__(self, other) -> bool:
+        # Components of a directory listing are identified by their name and type
+        return type(self) is type(other) and self.name == other.name
+
+    def __hash__(self) -> int:
+        return hash((type(self), self.name))
+
 
 class File(FSNamedComponent):
-    def __init__(self, name: str, content: FileContent = FileContent()):
+    """
+    File whose content is only known once it has been opened.
+    The content is created on first access, files that are only listed do not carry one.
+    """
+
+    __slots__ = ('_content',)
+
+    def __init__(self, name: str, content: Optional[FileContent] = None):
         super().__init__(name)
-        self.content = content
+        self._content = content
+
+    @property
+    def content(self) -> FileContent:
+        if self._content is None:
+            self._content = FileContent()
+        return self._content
+
+    @content.setter
+    def content(self, content: FileContent):
+        self._content = content
 
     def __str__(self) -> str:
         return f"[FILE]: {self.name} {self.content}"
@@ -48,9 +86,26 @@ class File(FSNamedComponent):
 
 
 class Directory(FSNamedComponent):
+    """
+    Directory whose children are only known once it has been opened.
+    Like the content of a File, the listing is created on first access.
+    """
+
+    __slots__ = ('_children',)
+
     def __init__(self, name: str):
         super().__init__(name)
-        self.children = []
+        self._children = None
+
+    @property
+    def children(self) -> 'DirectoryListing':
+        if self._children is None:
+            self._children = DirectoryListing()
+        return self._children
+
+    @children.setter
+    def children(self, children: 'DirectoryListing'):
+        self._children = children
 
     def add_child(self, child: FSNamedComponent):
         self.children.append(child)
@@ -65,3 +120,101 @@ class Directory(FSNamedComponent):
     @staticmethod
     def get_type() -> str:
         return "DIRECTORY"
+
+
+class DirectoryListing(MutableSequence):
+    """
+    Compact list of the children of a directory.
+    Children are stored as two parallel arrays, one with their names and one with their type flags,
+    which are the same as the headers of the encoded components ('f' or 'd').
+    File and Directory objects are only created when children are accessed, e.g. for the visible rows of the GUI.
+    Since components are compared by name and type, the created objects behave like the stored ones.
+    """
+
+    __slots__ = ('names', 'kinds')
+
+    KIND_FILE = ord('f')
+    KIND_DIR = ord('d')
+
+    def __init__(self, components: Iterable[FSNamedComponent] = ()):
+        self.names: List[str] = []
+        self.kinds = bytearray()
+        for component in components:
+            self.append(component)
+
+    @staticmethod
+    def kind_of(component: FSNamedComponent) -> int:
+        return DirectoryListing.KIND_DIR if isinstance(component, Directory) else DirectoryListing.KIND_FILE
+
+    @staticmethod
+    def component(name: str, kind: int) -> FSNamedComponent:
+        return Directory(name) if kind == DirectoryListing.KIND_DIR else File(name)
+
+    def add(self, name: str, kind: int):
+        """
+        Appends a child without creating a component object for it.
+        """
+        self.names.append(name)
+        self.kinds.append(kind)
+
+    def intern_names(self):
+        """
+        Replaces the names with interned strings, so that listings sharing names also share the string objects.
+        """
+        self.names[:] = map(sys.intern, self.names)
+
+    def keys(self) -> Iterator[Tuple[str, int]]:
+        return zip(self.names, self.kinds)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[FSNamedComponent, List[FSNamedComponent]]:
+        if isinstance(index, slice):
+            return [DirectoryListing.component(name, kind)
+                    for name, kind in zip(self.names[index], self.kinds[index])]
+        return DirectoryListing.component(self.names[index], self.kinds[index])
+
+    def __setitem__(self, index: int, component: FSNamedComponent):
+        self.names[index] = component.name
+        self.kinds[index] = DirectoryListing.kind_of(component)
+
+    def __delitem__(self, index: int):
+        del self.names[index]
+        del self.kinds[index]
+
+    def __iter__(self) -> Iterator[FSNamedComponent]:
+        return (DirectoryListing.component(name, kind) for name, kind in zip(self.names, self.kinds))
+
+    def __contains__(self, component) -> bool:
+        return isinstance(component, FSNamedComponent) and self.index_of(component) >= 0
+
+    def index_of(self, component: FSNamedComponent) -> int:
+        kind = DirectoryListing.kind_of(component)
+        start = 0
+        while True:
+            try:
+                index = self.names.index(component.name, start)
+            except ValueError:
+                return -1
+            if self.kinds[index] == kind:
+                return index
+            start = index + 1
+
+    def remove(self, component: FSNamedComponent):
+        index = self.index_of(component)
+        if index < 0:
+            raise ValueError(f'{component.name} is not in the listing')
+        del self[index]
+
+    def insert(self, index: int, component: FSNamedComponent):
+        self.names.insert(index, component.name)
+        self.kinds.insert(index, DirectoryListing.kind_of(component))
+
+    def extend(self, components: Iterable[FSNamedComponent]):
+        # Chunks of a listing are appended array to array, without creating component objects
+        if isinstance(components, DirectoryListing):
+            self.names.extend(components.names)
+            self.kinds.extend(components.kinds)
+        else:
+            super().extend(components)
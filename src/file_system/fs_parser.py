@@ -1,5 +1,12 @@
+import itertools
+import re
+from typing import Iterator, Tuple, Union
+
 from src.client.exceptions import InvalidFormat
-from src.file_system.file_system import File, Directory, FSComponent, FileContent
+from src.file_system.file_system import Directory, FSComponent, FileContent, DirectoryListing
+
+# Encoded component data: text or the raw UTF-8 payload (bytes or a memoryview into a receive buffer)
+EncodedData = Union[str, bytes, memoryview]
 
 
 class FileParser:
@@ -12,23 +19,64 @@ class FileParser:
 
 
 class DirectoryParser:
+    """
+    Parses encoded directories: <'d'><dir_path>\\0<child_header><child_name>\\0...
+    Children are found one at a time, without splitting the whole listing up front, and can be consumed
+    in chunks while the rest of the listing is still being parsed.
+    """
+
+    # A non-empty entry between separators
+    ENTRY_PATTERN = re.compile('[^\x00]+')
+    CHUNK_SIZE = 4096
+
     def __init__(self):
         raise NotImplemented(f"Cannot instantiate {self.__class__.__name__} class")
 
     @staticmethod
     def parse(string: str) -> Directory:
-        split_str = list(filter(lambda x: x != '', string[1:].split('\x00')))
-        directory = Directory(split_str[0])
-
-        for child in split_str[1:]:
-            if child[0] == 'f':
-                directory.add_child(File(child[1:]))
-            elif child[0] == 'd':
-                directory.add_child(Directory(child[1:]))
-            else:
-                raise InvalidFormat("Invalid header for directory child")
+        # A chunk as large as the string holds all the children
+        name, chunks = DirectoryParser.parse_chunks(string, len(string))
+        directory = Directory(name)
+        for chunk in chunks:
+            directory.children = chunk
         return directory
 
+    @staticmethod
+    def parse_chunks(string: str, chunk_size: int = CHUNK_SIZE) -> Tuple[str, Iterator[DirectoryListing]]:
+        """
+        Parses the name of an encoded directory right away and its children lazily.
+
+        :param string: The encoded directory.
+        :param chunk_size: Number of children in each chunk, except for the last one.
+        :return: Tuple[str, Iterator[DirectoryListing]] - the name of the directory and the listings of
+                 consecutive chunks of its children, parsed as they are consumed.
+        """
+        entries = DirectoryParser.ENTRY_PATTERN.finditer(string, 1)
+        first_entry = next(entries, None)
+        if first_entry is None:
+            raise InvalidFormat("Expected directory name")
+        return first_entry.group(), DirectoryParser.iter_chunks(entries, chunk_size)
+
+    @staticmethod
+    def iter_chunks(entries: Iterator[re.Match], chunk_size: int) -> Iterator[DirectoryListing]:
+        while True:
+            chunk = DirectoryListing()
+            # Children are appended to the listing directly, without a call per child
+            names = chunk.names
+            kinds = chunk.kinds
+            for entry in itertools.islice(entries, chunk_size):
+                child = entry.group()
+                kind = ord(child[0])
+                if kind != DirectoryListing.KIND_FILE and kind != DirectoryListing.KIND_DIR:
+                    raise InvalidFormat("Invalid header for directory child")
+                kinds.append(kind)
+                names.append(child[1:])
+            if not names:
+                return
+            yield chunk
+            if len(names) < chunk_size:
+                return
+
 
 class FSParser:
     """
@@ -36,13 +84,15 @@ class FSParser:
     The FSParser.parse static method receives an encoded string
     representing the contents of the current directory/file and returns
     the FSComponent encoded in it.
+    Raw payloads are decoded in a single pass, so a memoryview into the receive buffer is never copied.
     """
 
     def __init__(self):
         raise NotImplemented(f"Cannot instantiate {self.__class__.__name__} class")
 
     @staticmethod
-    def parse(string: str) -> FSComponent:
+    def parse(data: EncodedData) -> FSComponent:
+        string = FSParser.decode(data)
         if len(string) == 0:
             raise InvalidFormat("Expected file system component, got empty string")
         if string[0] == 'f':
@@ -51,3 +101,12 @@ class FSParser:
             return DirectoryParser.parse(string)
         else:
             raise InvalidFormat("Invalid header for file system component")
+
+    @staticmethod
+    def decode(data: EncodedData) -> str:
+        if isinstance(data, str):
+            return data
+        try:
+            return str(data, 'utf-8')
+        except UnicodeDecodeError:
+            raise InvalidFormat("Encoded component is not valid UTF-8")
@@ -0,0 +1,99 @@
+import posixpath
+from typing import Optional, Dict
+
+from src.file_system.dir_cache import CacheEntry, DirectoryCache
+from src.file_system.file_system import Directory
+
+
+class TreeNode(CacheEntry):
+    """
+    Directory of the remote tree mirror: a cached listing linked to the nodes of its parent directory
+    and of its subdirectories, as far as those were listed too.
+    """
+
+    def __init__(self, path: str, directory: Directory, etag: Optional[bytes], size: int, max_age: float):
+        super().__init__(path, directory, etag, size, max_age)
+        self.parent: Optional[TreeNode] = None
+        self.subdirs: Dict[str, TreeNode] = {}
+
+    @property
+    def name(self) -> str:
+        return posixpath.basename(self.path)
+
+
+class RemoteTree(DirectoryCache):
+    """
+    Client-side mirror of the directory tree of the server.
+    Every listing received is merged into a single tree, in which each directory is linked to its parent
+    and to its subdirectories. The cache entries double as an index from absolute path to node, so any
+    directory that was listed before can be found in constant time and displayed without asking the server,
+    for as long as its listing is fresh.
+    Nodes are evicted like any other cache entry, which only cuts their links. Subdirectories that disappear
+    from a newer listing are removed from the mirror together with everything below them.
+    """
+
+    def get(self, path: str) -> Optional[TreeNode]:
+        return super().get(path)
+
+    def parent(self, path: str) -> Optional[TreeNode]:
+        """
+        Finds the node of the parent directory of a directory, through the links of the tree if it has a node.
+        """
+        with self.lock:
+            node = self.get(path)
+            return node.parent if node else self.get(posixpath.dirname(DirectoryCache.key(path)))
+
+    def fresh(self, path: str) -> Optional[TreeNode]:
+        """
+        Finds the node of a directory whose listing can be displayed without asking the server.
+        """
+        node = self.get(path)
+        return node if node and node.is_fresh else None
+
+    def put(self, path: str, directory: Directory, etag: Optional[bytes], size: int,
+            max_age: float = DirectoryCache.DEFAULT_MAX_AGE) -> Optional[TreeNode]:
+        path = DirectoryCache.key(path)
+        with self.lock:
+            previous = self.entries.get(path)
+            previous_subdirs = dict(previous.subdirs) if previous else {}
+            node = super().put(path, directory, etag, size, max_age)
+            if node is None:
+                return None
+            parent = self.entries.get(posixpath.dirname(path))
+            if parent is not None and parent is not node:
+                RemoteTree.link(parent, node)
+            # Directories listed before this one may be its subdirectories
+            for entry in self.entries.values():
+                if entry.parent is None and entry is not node and posixpath.dirname(entry.path) == path \
+                        and Directory(entry.name) in directory.children:
+                    RemoteTree.link(node, entry)
+            for name, subdir in previous_subdirs.items():
+                if name not in node.subdirs:
+                    # No longer on the server
+                    self.invalidate_tree(subdir)
+            return node
+
+    def create_entry(self, path: str, directory: Directory, etag: Optional[bytes], size: int,
+                     max_age: float) -> TreeNode:
+        return TreeNode(path, directory, etag, size, max_age)
+
+    def removed(self, entry: TreeNode):
+        super().removed(entry)
+        if entry.parent and entry.parent.subdirs.get(entry.name) is entry:
+            del entry.parent.subdirs[entry.name]
+        for subdir in entry.subdirs.values():
+            subdir.parent = None
+        entry.parent = None
+        entry.subdirs = {}
+
+    def invalidate_tree(self, node: TreeNode):
+        with self.lock:
+            for subdir in list(node.subdirs.values()):
+                self.invalidate_tree(subdir)
+            if self.entries.get(node.path) is node:
+                self.invalidate(node.path)
+
+    @staticmethod
+    def link(parent: TreeNode, child: TreeNode):
+        parent.subdirs[child.name] = child
+        child.parent = parent
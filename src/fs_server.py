@@ -0,0 +1,482 @@
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import posixpath
+import random
+import shutil
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from src.client.block_transfer import BlockOption
+from src.client.coap_message import CoAPMessage, CoAP
+from src.client.command import BatchCommand, FSCommand
+from src.client.exceptions import InvalidResponse
+
+Peer = Tuple[str, int]
+
+
+class Outcome:
+    """
+    Result of executing a request: the response and the directories whose listings changed.
+    listing_path is the directory listed by the response, if any, which can be observed.
+    """
+
+    def __init__(self, response: CoAPMessage, listing_path: Optional[str] = None, changed: List[str] = ()):
+        self.response = response
+        self.listing_path = listing_path
+        self.changed = list(changed)
+
+
+class FileSystemServer(asyncio.DatagramProtocol):
+    """
+    Reference server that serves a directory of the local file system, using the payload format of the commands.
+    Paths sent by clients are absolute paths below the root directory, '/' being the root itself.
+
+    The server runs on an asyncio event loop and executes file system operations in a worker pool, so any number
+    of clients are served concurrently and a slow disk never blocks the receive loop. Besides the commands:
+    * Retransmitted requests are answered with the response already sent, without executing them twice
+    * Large requests and responses are transferred block-wise
+    * Directory listings carry an ETag and can be observed, observers are notified whenever a listing changes
+    * Confirmable notifications are retransmitted until acknowledged, with timers instead of blocking reads
+    """
+
+    BLOCK_SIZE = 1024
+    # Number of responses kept for answering retransmitted requests, and of large responses kept for block requests
+    DEDUP_ENTRIES = 4096
+    DOWNLOAD_ENTRIES = 256
+    ACK_TIMEOUT = 2.0
+    MAX_RETRANSMIT = 4
+
+    def __init__(self, root: str, ip: str = '127.0.0.1', port: int = 5683, workers: int = 4,
+                 confirmable_notifications: bool = False):
+        self.root = os.path.realpath(root)
+        self.ip = ip
+        self.port = port
+        self.confirmable_notifications = confirmable_notifications
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='fs-server')
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stopped: Optional[asyncio.Event] = None
+        self.thread: Optional[threading.Thread] = None
+        # Encoded responses by (peer, message ID), None while the request is being executed
+        self.responses: 'OrderedDict[Tuple[Peer, int], Optional[bytes]]' = OrderedDict()
+        # Blocks of block-wise requests received so far, by (peer, token)
+        self.uploads: Dict[Tuple[Peer, int], bytearray] = {}
+        # Large responses, by (peer, token), or by (peer, request payload) for notifications
+        self.downloads: 'OrderedDict[tuple, CoAPMessage]' = OrderedDict()
+        # Observers by directory path: (peer, token) mapped to the payload of the observing request
+        self.observers: Dict[str, Dict[Tuple[Peer, int], bytes]] = {}
+        # Notifications sent, by (peer, message ID): the path and the observer they were sent to
+        self.notifications: 'OrderedDict[Tuple[Peer, int], Tuple[str, Tuple[Peer, int]]]' = OrderedDict()
+        # Retransmission timers of confirmable notifications not acknowledged yet, by (peer, message ID)
+        self.pending_acks: Dict[Tuple[Peer, int], asyncio.TimerHandle] = {}
+        self.last_msg_id = random.randint(0, 0xFFFF)
+        self.observe_sequence = 0
+
+    # Life cycle
+
+    def start(self):
+        """
+        Runs the server on an event loop of its own, in a background thread.
+        """
+        started = threading.Event()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.serve_forever(started)), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self):
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        if self.thread:
+            self.thread.join()
+
+    async def serve_forever(self, started: threading.Event = None):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        await self.loop.create_datagram_endpoint(lambda: self, local_addr=(self.ip, self.port))
+        # The port is chosen by the system if 0 was given
+        self.port = self.transport.get_extra_info('sockname')[1]
+        print(f'\t\t[SERVING {self.root} ON {self.ip}:{self.port}]')
+        if started:
+            started.set()
+        try:
+            await self.stopped.wait()
+        finally:
+            for timer in self.pending_acks.values():
+                timer.cancel()
+            self.transport.close()
+            self.executor.shutdown(wait=False)
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    # Receiving
+
+    def datagram_received(self, data: bytes, addr: Peer):
+        try:
+            msg = CoAPMessage.from_bytes(memoryview(data))
+        except InvalidResponse:
+            return
+        if msg.msg_type in (CoAP.TYPE_ACK, CoAP.TYPE_RESET):
+            self.handle_reply(msg, addr)
+            return
+        exchange = (addr, msg.msg_id)
+        if exchange in self.responses:
+            # Retransmission - answer again, unless the request is still being executed
+            if self.responses[exchange] is not None:
+                self.transport.sendto(self.responses[exchange], addr)
+            return
+        self.remember(exchange, None)
+        if msg.msg_class == CoAP.CLASS_METHOD and msg.msg_code == CoAP.CODE_EMPTY:
+            # Ping
+            self.respond(msg, addr, FileSystemServer.reply(CoAP.CLASS_SUCCESS, CoAP.CODE_VALID))
+            return
+        if self.handle_block_request(msg, addr):
+            return
+        payload = bytes(self.uploads.pop((addr, msg.token), b'')) + bytes(msg.payload_bytes)
+        self.loop.create_task(self.handle_request(msg, payload, addr))
+
+    def handle_block_request(self, msg: CoAPMessage, addr: Peer) -> bool:
+        """
+        Stores the intermediate blocks of block-wise requests and serves the blocks of large responses.
+
+        :return: bool - True if the request was answered.
+        """
+        block1 = msg.get_option(CoAP.OPTION_BLOCK1)
+        if block1 is not None and BlockOption.from_bytes(block1).more:
+            self.uploads.setdefault((addr, msg.token), bytearray()).extend(msg.payload_bytes)
+            self.respond(msg, addr, FileSystemServer.reply(CoAP.CLASS_SUCCESS, CoAP.CODE_CONTINUE,
+                                                           options=[(CoAP.OPTION_BLOCK1, block1)]))
+            return True
+        block2 = msg.get_option(CoAP.OPTION_BLOCK2)
+        if block2 is None:
+            return False
+        key = (addr, msg.token)
+        if key not in self.downloads:
+            key = (addr, bytes(msg.payload_bytes))
+        block = BlockOption.from_bytes(block2)
+        full_response = self.downloads.get(key)
+        if full_response is None:
+            return False
+        block.more = block.offset + block.size < len(full_response.payload_bytes)
+        if not block.more:
+            del self.downloads[key]
+        response = FileSystemServer.response_block(full_response, block)
+        response.remove_option(CoAP.OPTION_OBSERVE)
+        self.respond(msg, addr, response, split=False)
+        return True
+
+    def handle_reply(self, msg: CoAPMessage, addr: Peer):
+        exchange = (addr, msg.msg_id)
+        timer = self.pending_acks.pop(exchange, None)
+        if timer:
+            timer.cancel()
+        notification = self.notifications.pop(exchange, None)
+        if msg.msg_type == CoAP.TYPE_RESET and notification:
+            # The client is no longer interested in the resource
+            path, observer = notification
+            self.remove_observer(path, observer)
+
+    async def handle_request(self, msg: CoAPMessage, payload: bytes, addr: Peer):
+        try:
+            outcome = await self.loop.run_in_executor(self.executor, self.execute, msg, payload)
+        except Exception as e:
+            outcome = Outcome(FileSystemServer.reply(CoAP.CLASS_SERROR, 0, payload=str(e)))
+        response = outcome.response
+        block1 = msg.get_option(CoAP.OPTION_BLOCK1)
+        if block1 is not None:
+            response.set_option(CoAP.OPTION_BLOCK1, block1)
+        if outcome.listing_path is not None:
+            observe = self.handle_observe_request(msg, outcome.listing_path, payload, addr)
+            if observe is not None:
+                response.set_option(CoAP.OPTION_OBSERVE, observe)
+        self.respond(msg, addr, response)
+        for path in outcome.changed:
+            await self.notify(path)
+
+    def handle_observe_request(self, msg: CoAPMessage, path: str, payload: bytes, addr: Peer) -> Optional[bytes]:
+        """
+        Registers or removes the observer of a directory listing.
+
+        :return: Optional[bytes] - the Observe option value confirming the registration, None if there is none.
+        """
+        observe = msg.options.get_uint(CoAP.OPTION_OBSERVE)
+        observer = (addr, msg.token)
+        if observe == CoAP.OBSERVE_DEREGISTER:
+            self.remove_observer(path, observer)
+        elif observe == CoAP.OBSERVE_REGISTER and msg.token_length:
+            self.observers.setdefault(path, {})[observer] = payload
+            return self.next_observe_sequence()
+        return None
+
+    def remove_observer(self, path: str, observer: Tuple[Peer, int]):
+        observers = self.observers.get(path)
+        if observers is not None:
+            observers.pop(observer, None)
+            if not observers:
+                del self.observers[path]
+
+    # Sending
+
+    def respond(self, msg: CoAPMessage, addr: Peer, response: CoAPMessage, split: bool = True):
+        """
+        Sends the response to a request: piggybacked on the acknowledge of confirmable requests, as a
+        non-confirmable message otherwise. Responses larger than a block are split into blocks.
+        """
+        if msg.msg_type == CoAP.TYPE_CONF:
+            response.msg_type, response.msg_id = CoAP.TYPE_ACK, msg.msg_id
+        else:
+            response.msg_type, response.msg_id = CoAP.TYPE_NON_CONF, self.next_msg_id()
+        response.token_length, response.token = msg.token_length, msg.token
+        if split and len(response.payload_bytes) > FileSystemServer.BLOCK_SIZE:
+            self.store_download((addr, msg.token), response)
+            response = FileSystemServer.response_block(response, BlockOption(0, True, FileSystemServer.BLOCK_SIZE))
+        data = CoAP.wrap(response)
+        self.remember((addr, msg.msg_id), data)
+        self.transport.sendto(data, addr)
+
+    async def notify(self, path: str):
+        """
+        Sends the new listing of a directory to its observers.
+        """
+        observers = self.observers.get(path)
+        if not observers:
+            return
+        outcome = await self.loop.run_in_executor(self.executor, self.list_directory, path)
+        if outcome.response.msg_class != CoAP.CLASS_SUCCESS:
+            # The directory itself is gone
+            self.observers.pop(path, None)
+            return
+        msg_type = CoAP.TYPE_CONF if self.confirmable_notifications else CoAP.TYPE_NON_CONF
+        for observer, request_payload in list(observers.items()):
+            addr, token = observer
+            listing = outcome.response
+            notification = CoAPMessage(payload=listing.payload_bytes, msg_type=msg_type, msg_class=listing.msg_class,
+                                       msg_code=listing.msg_code, msg_id=self.next_msg_id(),
+                                       token_length=CoAP.token_length(token), token=token,
+                                       options=listing.options.copy())
+            notification.set_option(CoAP.OPTION_OBSERVE, self.next_observe_sequence())
+            if len(notification.payload_bytes) > FileSystemServer.BLOCK_SIZE:
+                # The remaining blocks are requested without the token of the observation
+                self.store_download((addr, request_payload), notification)
+                notification = FileSystemServer.response_block(notification,
+                                                               BlockOption(0, True, FileSystemServer.BLOCK_SIZE))
+            exchange = (addr, notification.msg_id)
+            self.notifications[exchange] = (path, observer)
+            while len(self.notifications) > FileSystemServer.DEDUP_ENTRIES:
+                self.notifications.popitem(last=False)
+            data = CoAP.wrap(notification)
+            self.transport.sendto(data, addr)
+            if msg_type == CoAP.TYPE_CONF:
+                self.expect_ack(exchange, data, FileSystemServer.ACK_TIMEOUT, FileSystemServer.MAX_RETRANSMIT)
+
+    def expect_ack(self, exchange: Tuple[Peer, int], data: bytes, timeout: float, retransmissions_left: int):
+        """
+        Retransmits a confirmable message with exponential backoff until it is acknowledged.
+        An observer that never acknowledges is removed.
+        """
+        def on_timeout():
+            if retransmissions_left <= 0:
+                del self.pending_acks[exchange]
+                notification = self.notifications.pop(exchange, None)
+                if notification:
+                    self.remove_observer(*notification)
+                return
+            self.transport.sendto(data, exchange[0])
+            self.expect_ack(exchange, data, timeout * 2, retransmissions_left - 1)
+        self.pending_acks[exchange] = self.loop.call_later(timeout, on_timeout)
+
+    def remember(self, exchange: Tuple[Peer, int], data: Optional[bytes]):
+        self.responses[exchange] = data
+        while len(self.responses) > FileSystemServer.DEDUP_ENTRIES:
+            self.responses.popitem(last=False)
+
+    def store_download(self, key: tuple, response: CoAPMessage):
+        self.downloads[key] = response
+        while len(self.downloads) > FileSystemServer.DOWNLOAD_ENTRIES:
+            self.downloads.popitem(last=False)
+
+    def next_msg_id(self) -> int:
+        self.last_msg_id = (self.last_msg_id + 1) & 0xFFFF
+        return self.last_msg_id
+
+    def next_observe_sequence(self) -> bytes:
+        self.observe_sequence = (self.observe_sequence + 1) & 0xFFFFFF
+        return CoAP.encode_uint(self.observe_sequence)
+
+    # File system operations, executed by the worker pool
+
+    def execute(self, msg: CoAPMessage, payload: bytes) -> Outcome:
+        try:
+            text = payload.decode('utf-8')
+        except UnicodeDecodeError:
+            return Outcome(FileSystemServer.reply(CoAP.CLASS_CERROR, 0, payload='Invalid payload encoding'))
+        cmd_header, argument = text[:1], text[1:]
+        try:
+            if cmd_header == FSCommand.CMD_OPEN:
+                return self.open(argument, msg)
+            if cmd_header == FSCommand.CMD_BACK:
+                parent = posixpath.dirname(FileSystemServer.normalize(argument))
+                return self.list_directory(parent, msg)
+            if cmd_header == FSCommand.CMD_SAVE:
+                path, _, content = argument.partition('\x00')
+                return self.save(path, content)
+            if cmd_header == FSCommand.CMD_BATCH:
+                return self.batch(argument)
+            if cmd_header in (FSCommand.CMD_NEWF, FSCommand.CMD_NEWD, FSCommand.CMD_DEL):
+                error, changed = self.modify(cmd_header, argument)
+                if error:
+                    return Outcome(error)
+                code = CoAP.CODE_DELETED if cmd_header == FSCommand.CMD_DEL else CoAP.CODE_CREATED
+                return Outcome(FileSystemServer.reply(CoAP.CLASS_SUCCESS, code), changed=changed)
+        except PermissionError:
+            return Outcome(FileSystemServer.reply(CoAP.CLASS_CERROR, 3))
+        except FileNotFoundError:
+            return Outcome(FileSystemServer.reply(CoAP.CLASS_CERROR, 4))
+        return Outcome(FileSystemServer.reply(CoAP.CLASS_CERROR, 0, payload='Unknown command'))
+
+    def open(self, path: str, msg: CoAPMessage) -> Outcome:
+        local_path = self.local_path(path)
+        if os.path.isdir(local_path):
+            return self.list_directory(path, msg)
+        with open(local_path, 'r', encoding='utf-8', errors='replace') as file:
+            content = file.read()
+        return Outcome(FileSystemServer.reply(CoAP.CLASS_SUCCESS, CoAP.CODE_CONTENT, payload=f'f{content}'))
+
+    def list_directory(self, path: str, msg: CoAPMessage = None) -> Outcome:
+        """
+        Lists a directory, tagged with an ETag. If the request carries the same ETag, the listing is replaced
+        with an empty 2.03 Valid response.
+        """
+        path = FileSystemServer.normalize(path)
+        try:
+            entries = sorted(os.scandir(self.local_path(path)), key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            return Outcome(FileSystemServer.reply(CoAP.CLASS_CERROR, 4))
+        listing = '\x00'.join([f'd{path}'] + [f'{"d" if entry.is_dir() else "f"}{entry.name}' for entry in entries])
+        payload = listing.encode('utf-8')
+        etag = zlib.crc32(payload).to_bytes(4, 'big')
+        if msg is not None and etag in msg.options.get_all(CoAP.OPTION_ETAG):
+            response = FileSystemServer.reply(CoAP.CLASS_SUCCESS, CoAP.CODE_VALID, options=[(CoAP.OPTION_ETAG, etag)])
+        else:
+            response = FileSystemServer.reply(CoAP.CLASS_SUCCESS, CoAP.CODE_CONTENT, payload=payload,
+                                              options=[(CoAP.OPTION_ETAG, etag)])
+        return Outcome(response, listing_path=path)
+
+    def save(self, path: str, content: str) -> Outcome:
+        local_path = self.local_path(path)
+        existed = os.path.exists(local_path)
+        with open(local_path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        changed = [] if existed else [posixpath.dirname(FileSystemServer.normalize(path))]
+        return Outcome(FileSystemServer.reply(CoAP.CLASS_SUCCESS, CoAP.CODE_CHANGED), changed=changed)
+
+    def batch(self, argument: str) -> Outcome:
+        results, changed = [], set()
+        for operation in argument.split('\x00'):
+            error, operation_changed = self.modify(operation[:1], operation[1:])
+            if error:
+                results.append(f'{BatchCommand.RESULT_ERROR}{error.payload or FileSystemServer.describe(error)}')
+            else:
+                results.append(BatchCommand.RESULT_OK)
+                changed.update(operation_changed)
+        return Outcome(FileSystemServer.reply(CoAP.CLASS_SUCCESS, CoAP.CODE_CHANGED, payload='\x00'.join(results)),
+                       changed=sorted(changed))
+
+    def modify(self, cmd_header: str, path: str) -> Tuple[Optional[CoAPMessage], List[str]]:
+        """
+        Creates or deletes a file or directory.
+
+        :return: Tuple[Optional[CoAPMessage], List[str]] - the error response if the operation failed,
+                 and the directories whose listings changed.
+        """
+        try:
+            local_path = self.local_path(path)
+        except PermissionError:
+            return FileSystemServer.reply(CoAP.CLASS_CERROR, 3), []
+        if local_path == self.root:
+            return FileSystemServer.reply(CoAP.CLASS_CERROR, 3, payload='Cannot change the root'), []
+        try:
+            if cmd_header == FSCommand.CMD_NEWF:
+                open(local_path, 'x').close()
+            elif cmd_header == FSCommand.CMD_NEWD:
+                os.mkdir(local_path)
+            elif cmd_header == FSCommand.CMD_DEL:
+                if os.path.isdir(local_path) and not os.path.islink(local_path):
+                    shutil.rmtree(local_path)
+                else:
+                    os.remove(local_path)
+            else:
+                return FileSystemServer.reply(CoAP.CLASS_CERROR, 0, payload='Unsupported operation'), []
+        except FileExistsError:
+            return FileSystemServer.reply(CoAP.CLASS_CERROR, 0, payload='Already exists'), []
+        except FileNotFoundError:
+            return FileSystemServer.reply(CoAP.CLASS_CERROR, 4, payload='No such file or directory'), []
+        except OSError as e:
+            return FileSystemServer.reply(CoAP.CLASS_SERROR, 0, payload=e.strerror or str(e)), []
+        path = FileSystemServer.normalize(path)
+        changed = [posixpath.dirname(path)]
+        if cmd_header == FSCommand.CMD_DEL:
+            # Observers of the deleted directory learn that it is gone
+            changed.append(path)
+        return None, changed
+
+    def local_path(self, path: str) -> str:
+        """
+        Maps a path sent by a client to a path below the root directory.
+        Symbolic links are resolved for the check, so links that point outside of the root are refused too.
+
+        :raises PermissionError: if the path leads outside of the root directory.
+        """
+        local_path = os.path.normpath(os.path.join(self.root, FileSystemServer.normalize(path).lstrip('/')))
+        if os.path.commonpath([self.root, os.path.realpath(local_path)]) != self.root:
+            raise PermissionError(path)
+        return local_path
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        return posixpath.normpath('/' + path.lstrip('/'))
+
+    @staticmethod
+    def describe(response: CoAPMessage) -> str:
+        response_code = 100 * response.msg_class + response.msg_code
+        return CoAP.RESPONSE_CODE.get(response_code, 'Unknown error')
+
+    @staticmethod
+    def reply(msg_class: int, msg_code: int, payload=b'', options=()) -> CoAPMessage:
+        # Type, message ID and token are set once the response is sent
+        return CoAPMessage(payload=payload, msg_type=CoAP.TYPE_ACK, msg_class=msg_class, msg_code=msg_code,
+                           msg_id=0, options=list(options))
+
+    @staticmethod
+    def response_block(response: CoAPMessage, block: BlockOption) -> CoAPMessage:
+        payload = response.payload_bytes[block.offset:block.offset + block.size]
+        options = response.options.copy()
+        options.set(CoAP.OPTION_BLOCK2, block.to_bytes())
+        if block.num == 0:
+            options.set(CoAP.OPTION_SIZE2, CoAP.encode_uint(len(response.payload_bytes)))
+        return CoAPMessage(payload=payload, msg_type=response.msg_type, msg_class=response.msg_class,
+                           msg_code=response.msg_code, msg_id=response.msg_id, token_length=response.token_length,
+                           token=response.token, options=options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves a local directory to CoAP file system browsers.')
+    parser.add_argument('--root', default='.', help='directory to serve')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5683)
+    parser.add_argument('--workers', type=int, default=4, help='threads executing file system operations')
+    parser.add_argument('--confirmable-notifications', action='store_true')
+    args = parser.parse_args()
+    server = FileSystemServer(args.root, args.ip, args.port, args.workers, args.confirmable_notifications)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
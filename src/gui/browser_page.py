@@ -1,11 +1,20 @@
 import tkinter as tk
 import tkinter.ttk as ttk
 
-from src.client.command import FSCommand, OpenCommand, BackCommand, DeleteCommand
-from src.file_system.file_system import FSNamedComponent, File, Directory, FSComponent, FileContent
+from typing import List, Optional
+
+from src.client.connection_pool import Connection
+from src.client.command import FSCommand, OpenCommand, BackCommand, DeleteCommand, CachedListingCommand, \
+    BatchCommand, BatchResult
+from src.client.prefetcher import Prefetcher
+from src.file_system.remote_tree import RemoteTree, TreeNode
+from src.file_system.file_system import FSNamedComponent, File, Directory, FSComponent, FileContent, \
+    DirectoryListing
 from src.gui.creation_box import CreationBox
+from src.gui.directory_view import DirectoryView
 from src.gui.base_page import BasePage
 from src.gui.file_editor import FileEditor
+from src.gui.metrics_panel import MetricsPanel
 
 
 class BrowserPage(BasePage):
@@ -14,28 +23,66 @@ class BrowserPage(BasePage):
     def __init__(self, title: str, *args, **kwargs):
         BasePage.__init__(self, title, *args, **kwargs)
         self.entries.append(self.path_entry)
-        self.components = []
+        self.components = DirectoryListing()
         self.current_dir_path = ''
+        self.current_dir = None
         self.selected_component = None
+        # Mirror of the visited part of the server tree. Fresh listings are displayed without asking the server,
+        # other listings are displayed right away and revalidated
+        self.remote_tree = RemoteTree()
+        # Command observing the displayed directory, the server notifies it about changes
+        self.observing_cmd = None
+        # Directory whose listing is displayed while it is still being parsed, see open_dir_chunk()
+        self.streamed_dir_path: Optional[str] = None
+        # Requests the listings the user is likely to open next
+        self.prefetcher: Optional[Prefetcher] = None
+        self.metrics_panel: Optional[MetricsPanel] = None
 
     def reset(self):
         super().reset()
         self.path_entry.insert(tk.END, '')
 
     def display_message(self, msg: str, duration: int = 2, color: str = 'red'):
-        self._display_message_impl(msg, duration, color, anchor='nw', relx='0.1', width='880', height='30')
+        self._display_message_impl(msg, duration, color, anchor='nw', relx='0.1', width='780', height='30')
 
     def send_to_client(self, cmd: FSCommand):
         self.master.send_to_client(cmd)
 
+    def switch_server(self, connection: Connection):
+        """
+        Browses the server of another connection, starting from its cached tree mirror.
+        """
+        self.observe_with(None)
+        self.streamed_dir_path = None
+        self.remote_tree = connection.remote_tree
+        # Prefetches go to the server they were scheduled for, even after switching again
+        self.prefetcher = Prefetcher(self.remote_tree, connection.send) if self.master.prefetch else None
+        self.current_dir = None
+        self.current_dir_path = ''
+        self.components = DirectoryListing()
+        self.display_current_dir()
+
+    def on_switch_server(self):
+        self.master.show_page('connection')
+
+    def on_show_metrics(self):
+        # A single panel, raised if it is already open
+        if self.metrics_panel is not None and self.metrics_panel.winfo_exists():
+            self.metrics_panel.lift()
+            return
+        self.metrics_panel = MetricsPanel(master=self)
+
     def on_component_select(self, event):
-        component_iid = self.component_view.identify_row(event.y)
-        if component_iid != '':
-            component_data = self.component_view.item(component_iid)['values']
-            component_name = component_data[0]
-            component = next((comp for comp in self.components if comp.name == component_name), None)
+        component = self.component_view.component_at(event.y)
+        if component is not None:
             self.selected_component = component
 
+    def on_component_toggle(self, event):
+        self.selected_component = self.component_view.toggle_at(event.y)
+
+    def on_component_range(self, event):
+        self.component_view.select_range_to(event.y)
+
     def open_component(self, component: FSComponent, callback_data: FSComponent):
         if isinstance(component, File):
             self.open_file(component, callback_data)
@@ -53,41 +100,160 @@ class BrowserPage(BasePage):
         if not isinstance(new_dir, Directory):
             self.display_message('Incorrect server data: Expected directory', duration=3)
             return
-        self.components = new_dir.children
+        if new_dir is self.current_dir:
+            # Cached listing confirmed by the server - already displayed
+            return
+        if new_dir.name == self.streamed_dir_path:
+            # The chunks displayed so far make up the same listing, which now takes their place
+            self.streamed_dir_path = None
+            self.current_dir = new_dir
+            self.components = new_dir.children
+            self.component_view.set_components(self.components, keep_position=True)
+        elif new_dir.name == self.current_dir_path:
+            # Newer listing of the displayed directory, e.g. a notification
+            self.update_dir(new_dir)
+            return
+        else:
+            self.streamed_dir_path = None
+            self.current_dir = new_dir
+            self.show_listing(new_dir.name, new_dir.children)
+        if self.prefetcher:
+            self.prefetcher.prefetch_around(new_dir)
+
+    def open_dir_chunk(self, dir_path: str, chunk: DirectoryListing):
+        """
+        Displays the children of a large directory while the rest of its listing is still being parsed,
+        see CachedListingCommand.chunk_callback. Only the command that opened the displayed directory streams
+        its listing, see observe_with(). The complete listing is passed to open_dir() afterwards.
+        Newer listings of the displayed directory are not streamed, since open_dir() merges them with it.
+        """
+        if dir_path != self.streamed_dir_path:
+            if dir_path == self.current_dir_path:
+                return
+            self.streamed_dir_path = dir_path
+            self.current_dir = None
+            self.show_listing(dir_path, DirectoryListing())
+        self.component_view.extend(chunk)
+
+    def show_listing(self, dir_path: str, components: DirectoryListing):
+        self.components = components
         self.display_current_dir()
         self.path_entry.delete(0, 'end')
-        self.path_entry.insert(tk.END, new_dir.name)
-        self.current_dir_path = new_dir.name
+        self.path_entry.insert(tk.END, dir_path)
+        self.current_dir_path = dir_path
 
     def display_current_dir(self):
-        self.component_view.delete(*self.component_view.get_children())
-        for comp in self.components:
-            row = (comp.name, comp.get_type())
-            self.component_view.insert('', 'end', values=row)
+        self.selected_component = None
+        self.component_view.selected_component = None
+        self.component_view.selected = set()
+        self.component_view.set_components(self.components)
+
+    def update_dir(self, new_dir: Directory):
+        """
+        Replaces the displayed listing with a newer listing of the same directory.
+        Components that are still in the directory keep their position and the view stays where it was scrolled.
+        """
+        old_keys = set(self.components.keys())
+        new_keys = set(new_dir.children.keys())
+        listing = DirectoryListing()
+        for name, kind in self.components.keys():
+            if (name, kind) in new_keys:
+                listing.add(name, kind)
+        for name, kind in new_dir.children.keys():
+            if (name, kind) not in old_keys:
+                listing.add(name, kind)
+        new_dir.children = listing
+        self.components = listing
+        self.current_dir = new_dir
+        self.component_view.set_components(listing, keep_position=True)
+        if self.selected_component and self.selected_component not in listing:
+            self.selected_component = None
 
     def remove_component(self, component: FSNamedComponent):
-        self.components.remove(component)
-        self.display_current_dir()
-        self.selected_component = None
+        if component not in self.components:
+            # Already removed, e.g. by a notification
+            return
+        self.component_view.remove(component)
+        if self.selected_component == component:
+            self.selected_component = None
 
     def insert_component(self, component: FSNamedComponent):
-        row = (component.name, component.get_type())
-        self.component_view.insert('', 'end', values=row)
-        self.components.append(component)
+        if component.name in self.component_view:
+            # Already inserted, e.g. by a notification
+            return
+        self.component_view.extend((component,))
+
+    def on_batch_deleted(self, components: List[FSNamedComponent], results: List[BatchResult]):
+        for component, result in zip(components, results):
+            if result.ok:
+                self.remove_component(component)
+        self.report_batch_failures(results)
+
+    def on_batch_created(self, results: List[BatchResult], is_file: bool):
+        for result in results:
+            if result.ok:
+                self.insert_component(File(result.name) if is_file else Directory(result.name))
+        self.report_batch_failures(results)
+
+    def report_batch_failures(self, results: List[BatchResult]):
+        failures = [result for result in results if not result.ok]
+        if failures:
+            self.display_message(f'{len(failures)} of {len(results)} operations failed - '
+                                 f'{failures[0].name}: {failures[0].error}', duration=3)
+
+    def open_local_dir(self, node: Optional[TreeNode]) -> bool:
+        """
+        Displays a directory from the mirror of the server tree, if it was listed before.
+
+        :return: bool - True if the listing is fresh, in which case the server does not need to be asked.
+        """
+        if node is None:
+            return False
+        self.open_dir(node.directory)
+        if node.is_fresh:
+            # Nothing to observe, the listing will simply be requested again once it is stale
+            self.observe_with(None)
+            return True
+        return False
+
+    def observe_with(self, cmd: Optional[CachedListingCommand]):
+        """
+        Makes the command the observer of the displayed directory. The previous observation is cancelled,
+        since its directory is no longer displayed, and the chunks of its listing are no longer displayed either.
+        """
+        if self.observing_cmd:
+            self.observing_cmd.cancel_observation()
+            self.observing_cmd.chunk_callback = None
+        self.observing_cmd = cmd
+        if cmd:
+            cmd.chunk_callback = self.open_dir_chunk
 
     def on_set_path(self):
         dir_path = self.path_entry.get()
-        cmd = OpenCommand(dir_path, callback=self.open_dir)
+        if self.open_local_dir(self.remote_tree.get(dir_path)):
+            return
+        cmd = OpenCommand(dir_path, callback=self.open_dir, cache=self.remote_tree, observe=True)
+        self.observe_with(cmd)
         self.send_to_client(cmd)
 
     def on_open(self):
         if self.selected_component:
-            cmd = OpenCommand(f'{self.current_dir_path}/{self.selected_component.name}',
-                              callback=lambda data: self.open_component(self.selected_component, data))
+            component = self.selected_component
+            component_path = f'{self.current_dir_path}/{component.name}'
+            is_dir = isinstance(component, Directory)
+            if is_dir and self.open_local_dir(self.remote_tree.get(component_path)):
+                return
+            cmd = OpenCommand(component_path, callback=lambda data: self.open_component(component, data),
+                              cache=self.remote_tree, observe=is_dir)
+            if is_dir:
+                self.observe_with(cmd)
             self.send_to_client(cmd)
 
     def on_back(self):
-        cmd = BackCommand(self.current_dir_path, callback=self.open_dir)
+        if self.open_local_dir(self.remote_tree.parent(self.current_dir_path)):
+            return
+        cmd = BackCommand(self.current_dir_path, callback=self.open_dir, cache=self.remote_tree, observe=True)
+        self.observe_with(cmd)
         self.send_to_client(cmd)
 
     def on_new_dir(self):
@@ -97,9 +263,16 @@ class BrowserPage(BasePage):
         CreationBox(master=self, title='New File', is_file=True)
 
     def on_delete(self):
-        if self.selected_component:
-            cmd = DeleteCommand(f'{self.current_dir_path}/{self.selected_component.name}',
-                                callback=lambda: self.remove_component(self.selected_component))
+        components = self.component_view.selected_components
+        if len(components) > 1:
+            # A single exchange for all the selected components
+            cmd = BatchCommand.delete((f'{self.current_dir_path}/{component.name}' for component in components),
+                                      callback=lambda results: self.on_batch_deleted(components, results))
+            self.send_to_client(cmd)
+        elif components:
+            component = components[0]
+            cmd = DeleteCommand(f'{self.current_dir_path}/{component.name}',
+                                callback=lambda: self.remove_component(component))
             self.send_to_client(cmd)
 
     def on_confirmation_toggle(self):
@@ -112,14 +285,20 @@ class BrowserPage(BasePage):
 
         self.path_entry = tk.Entry(self)
         self.path_entry.config(exportselection='false')
-        self.path_entry.place(anchor='nw', relx='0.1', width='880', height='30')
+        self.path_entry.place(anchor='nw', relx='0.1', width='780', height='30')
         self.path_entry.bind('<Return>', lambda e: self.on_set_path())
 
-        self.component_view = ttk.Treeview(self, columns=(1, 2), show='headings')
-        self.component_view.heading(1, text='Name')
-        self.component_view.heading(2, text='Type')
+        self.metrics_btn = ttk.Button(self)
+        self.metrics_btn.config(text='Metrics')
+        self.metrics_btn.place(anchor='nw', height='30', relx='0.885', width='100')
+        self.metrics_btn.configure(command=self.on_show_metrics)
+
+        # Only the visible part of the directory is turned into Treeview rows
+        self.component_view = DirectoryView(self)
         self.component_view.place(anchor='nw', height='500', width='1000', rely='0.05')
-        self.component_view.bind('<Button 1>', self.on_component_select)
+        self.component_view.bind_rows('<Button 1>', self.on_component_select)
+        self.component_view.bind_rows('<Control-Button-1>', self.on_component_toggle)
+        self.component_view.bind_rows('<Shift-Button-1>', self.on_component_range)
 
         self.back_btn = ttk.Button(self)
         self.back_btn.config(text='Back')
@@ -151,5 +330,10 @@ class BrowserPage(BasePage):
                                               onvalue=1, offvalue=0, command=self.on_confirmation_toggle)
         self.confirmable_chk.place(anchor='nw', height='40', relx='0.62', rely=self.BUTTONS_RELY, )
 
+        self.servers_btn = ttk.Button(self)
+        self.servers_btn.config(text='Servers')
+        self.servers_btn.place(anchor='nw', height='40', relx='0.725', rely=self.BUTTONS_RELY, width='100')
+        self.servers_btn.configure(command=self.on_switch_server)
+
         self.config(height='600', width='1000')
         self.place(anchor='nw', x='0', y='0')
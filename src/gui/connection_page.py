@@ -1,4 +1,5 @@
 import tkinter as tk
+import tkinter.ttk as ttk
 
 from src.gui.base_page import BasePage
 
@@ -8,17 +9,30 @@ class ConnectionPage(BasePage):
         BasePage.__init__(self, title, *args, **kwargs)
         self.entries.append(self.addr_entry)
 
+    def reset(self):
+        super().reset()
+        # Servers that are still connected can be switched to right away
+        self.servers_box.config(values=[connection.address for connection in self.master.connections])
+        self.servers_box.set('')
+
     def display_message(self, msg: str, duration: int = 2, color: str = 'red'):
         self._display_message_impl(msg, duration, color, anchor='nw', relx='0.05', rely='0.35', width='900')
 
+    def on_server_select(self):
+        self.addr_entry.delete(0, 'end')
+        self.addr_entry.insert(tk.END, self.servers_box.get())
+        self.on_connect()
+
     def on_connect(self):
         addr = self.addr_entry.get()
-        split_addr = addr.strip().split(':')
-        if len(split_addr) != 2:
+        # IPv6 addresses contain colons too, e.g. [::1]:5683
+        split_addr = addr.strip().rsplit(':', 1)
+        if len(split_addr) != 2 or not split_addr[0]:
             self.display_message('Invalid address')
             return
         try:
             ip, port = split_addr
+            ip = ip.strip('[]')
             port = int(port)
             if port < 0 or port > 65535:
                 raise ValueError
@@ -40,5 +54,13 @@ class ConnectionPage(BasePage):
         self.addr_lbl.config(text='Server address:')
         self.addr_lbl.place(anchor='nw', relx='0.25', rely='0.4')
 
+        self.servers_box = ttk.Combobox(self, state='readonly')
+        self.servers_box.place(anchor='nw', relx='0.4', rely='0.52', width='200')
+        self.servers_box.bind('<<ComboboxSelected>>', lambda e: self.on_server_select())
+
+        self.servers_lbl = tk.Label(self)
+        self.servers_lbl.config(text='Connected servers:')
+        self.servers_lbl.place(anchor='nw', relx='0.25', rely='0.52')
+
         self.config(height='600', width='1000')
         self.place(anchor='nw')
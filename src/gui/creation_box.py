@@ -1,6 +1,7 @@
 import tkinter as tk
+from typing import List
 
-from src.client.command import NewFileCommand, NewDirCommand
+from src.client.command import FSCommand, NewFileCommand, NewDirCommand, BatchCommand
 from src.file_system.file_system import File, Directory
 
 
@@ -8,38 +9,54 @@ class CreationBox(tk.Toplevel):
     """
     Window that appears when the user wants to create a new file or directory.
     Creating the component requires confirmation from the server.
+    Several components can be created at once by entering one name per line. Names may contain any other
+    character, so a single line always creates a single component.
     """
 
     def __init__(self, title: str, is_file: bool, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.title(title)
         self.is_file = is_file
-        self.geometry('500x150')
+        self.geometry('500x220')
         self.resizable(False, False)
         self.build_gui()
 
     def on_create(self):
-        name = self.name_entry.get().strip()
-        if len(name) == 0:
+        names = CreationBox.names(self.name_text.get('1.0', tk.END))
+        if len(names) == 0:
             return
-        if self.is_file:
-            cmd = NewFileCommand(new_file_path=f'{self.master.current_dir_path}/{name}',
-                                 callback=lambda: self.master.insert_component(File(name)))
-        else:
-            cmd = NewDirCommand(new_dir_path=f'{self.master.current_dir_path}/{name}',
-                                callback=lambda: self.master.insert_component(Directory(name)))
-        self.master.send_to_client(cmd)
+        self.master.send_to_client(self.create_command(names))
         self.destroy()
 
+    @staticmethod
+    def names(text: str) -> List[str]:
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+    def create_command(self, names: List[str]) -> FSCommand:
+        """
+        A single exchange creates all the components: one NEW FILE or NEW DIR command, or a batch for several names.
+        """
+        name = names[0]
+        if len(names) > 1:
+            is_file = self.is_file
+            return BatchCommand.create((f'{self.master.current_dir_path}/{name}' for name in names), is_file,
+                                       callback=lambda results: self.master.on_batch_created(results, is_file))
+        elif self.is_file:
+            return NewFileCommand(new_file_path=f'{self.master.current_dir_path}/{name}',
+                                  callback=lambda: self.master.insert_component(File(name)))
+        else:
+            return NewDirCommand(new_dir_path=f'{self.master.current_dir_path}/{name}',
+                                 callback=lambda: self.master.insert_component(Directory(name)))
+
     def build_gui(self):
         self.main_frame = tk.Frame(master=self)
-        self.name_entry = tk.Entry(self.main_frame)
-        self.name_entry.place(anchor='nw', height='40', width='400', relx='0.1', rely='0.1')
+        self.name_text = tk.Text(self.main_frame)
+        self.name_text.place(anchor='nw', height='110', width='400', relx='0.1', rely='0.06')
 
         self.create_btn = tk.Button(self.main_frame)
         self.create_btn.config(activebackground='#5cff5c', background='#91ff98', text='create')
-        self.create_btn.place(anchor='nw', height='50', relx='0.3', rely='0.5', width='200')
+        self.create_btn.place(anchor='nw', height='50', relx='0.3', rely='0.65', width='200')
         self.create_btn.configure(command=self.on_create)
 
-        self.main_frame.config(height='150', width='500')
+        self.main_frame.config(height='220', width='500')
         self.main_frame.place(anchor='nw')
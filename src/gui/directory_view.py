@@ -0,0 +1,200 @@
+import tkinter as tk
+import tkinter.ttk as ttk
+from typing import Optional, Iterable, List, Set
+
+from src.file_system.file_system import FSNamedComponent, DirectoryListing
+
+
+class DirectoryView(tk.Frame):
+    """
+    Scrollable table of the components of a directory.
+    The Treeview only holds as many rows as fit on the screen. Scrolling fills these rows with the components
+    at the new position, so the cost of displaying a directory does not depend on the number of components.
+    Components can be appended in chunks, e.g. while a large listing is still being parsed,
+    see BrowserPage.open_dir_chunk().
+    Component objects only exist for the visible rows, the listing itself only holds names and type flags.
+    Several components can be selected, so the selection is kept as a set of components rather than by the
+    Treeview, whose rows are reused while scrolling.
+    selected_component is the component the user clicked last, the anchor of range selections.
+    """
+
+    VISIBLE_ROWS = 23
+    WHEEL_ROWS = 3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.components = DirectoryListing()
+        # Index of the component displayed in the top row
+        self.first = 0
+        # Components displayed in the rows
+        self.visible: List[FSNamedComponent] = []
+        self.selected_component = None
+        self.selected: Set[FSNamedComponent] = set()
+        self.build_gui()
+
+    def __len__(self) -> int:
+        return len(self.components)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.components.names
+
+    def set_components(self, components: DirectoryListing, keep_position: bool = False):
+        """
+        Displays a new list of components. The list is not copied, so it must only be changed through this view.
+
+        :param components: The components to be displayed.
+        :param keep_position: Whether to stay at the current scroll position, e.g. when refreshing the same directory.
+        :return: None
+        """
+        self.components = components
+        if not keep_position:
+            self.first = 0
+        if self.selected_component is not None and self.selected_component not in components:
+            self.selected_component = None
+        self.selected = {component for component in self.selected if component in components}
+        self.render()
+
+    @property
+    def selected_components(self) -> List[FSNamedComponent]:
+        return list(self.selected)
+
+    def extend(self, components: Iterable[FSNamedComponent]):
+        """
+        Appends components to the end of the listing. Rows are only refreshed if the new components are visible.
+        """
+        start = len(self.components)
+        self.components.extend(components)
+        if start < self.first + DirectoryView.VISIBLE_ROWS:
+            self.render()
+        else:
+            self.update_scrollbar()
+
+    def remove(self, component: FSNamedComponent):
+        self.components.remove(component)
+        if self.selected_component == component:
+            self.selected_component = None
+        self.selected.discard(component)
+        self.render()
+
+    def index_at(self, y: int) -> Optional[int]:
+        iid = self.tree.identify_row(y)
+        if iid == '':
+            return None
+        index = self.first + self.tree.index(iid)
+        return index if index < len(self.components) else None
+
+    def component_at(self, y: int) -> Optional[FSNamedComponent]:
+        """
+        Finds the component displayed at the given height and makes it the only selected component.
+        """
+        index = self.index_at(y)
+        if index is None:
+            return None
+        self.selected_component = self.components[index]
+        self.selected = {self.selected_component}
+        self.render_selection()
+        return self.selected_component
+
+    def toggle_at(self, y: int) -> Optional[FSNamedComponent]:
+        """
+        Adds the component displayed at the given height to the selection, or removes it if it was selected.
+        """
+        index = self.index_at(y)
+        if index is None:
+            return None
+        component = self.components[index]
+        if component in self.selected:
+            self.selected.discard(component)
+            self.selected_component = None
+        else:
+            self.selected.add(component)
+            self.selected_component = component
+        self.render_selection()
+        return self.selected_component
+
+    def select_range_to(self, y: int) -> Optional[FSNamedComponent]:
+        """
+        Selects the components between the last clicked component and the one displayed at the given height.
+        """
+        index = self.index_at(y)
+        if index is None:
+            return None
+        anchor = self.components.index_of(self.selected_component) if self.selected_component else -1
+        if anchor < 0:
+            return self.component_at(y)
+        self.selected = set(self.components[min(anchor, index):max(anchor, index) + 1])
+        self.render_selection()
+        return self.selected_component
+
+    def scroll_to(self, first: int):
+        last_first = max(0, len(self.components) - DirectoryView.VISIBLE_ROWS)
+        first = min(max(0, first), last_first)
+        if first != self.first:
+            self.first = first
+            self.render()
+
+    def render(self):
+        """
+        Fills the rows of the Treeview with the components at the current scroll position.
+        Rows past the end of the listing are detached.
+        """
+        self.first = min(self.first, max(0, len(self.components) - DirectoryView.VISIBLE_ROWS))
+        self.visible = self.components[self.first:self.first + DirectoryView.VISIBLE_ROWS]
+        for position, iid in enumerate(self.row_ids):
+            if position < len(self.visible):
+                comp = self.visible[position]
+                self.tree.item(iid, values=(comp.name, comp.get_type()))
+                self.tree.move(iid, '', position)
+            else:
+                self.tree.detach(iid)
+        self.render_selection()
+        self.update_scrollbar()
+
+    def render_selection(self):
+        # The highlighted rows must follow the selected components, not the positions on the screen
+        self.tree.selection_set([iid for iid, comp in zip(self.row_ids, self.visible) if comp in self.selected])
+
+    def update_scrollbar(self):
+        total = len(self.components)
+        if total <= DirectoryView.VISIBLE_ROWS:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.first / total, (self.first + DirectoryView.VISIBLE_ROWS) / total)
+
+    def on_scrollbar(self, action: str, amount: str, unit: str = None):
+        """
+        Handles the commands of the scrollbar: 'moveto <fraction>' or 'scroll <count> units|pages'.
+        """
+        if action == tk.MOVETO:
+            self.scroll_to(int(float(amount) * len(self.components)))
+        elif unit == tk.PAGES:
+            self.scroll_to(self.first + int(amount) * (DirectoryView.VISIBLE_ROWS - 1))
+        else:
+            self.scroll_to(self.first + int(amount))
+
+    def on_mouse_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.scroll_to(self.first - DirectoryView.WHEEL_ROWS)
+        else:
+            self.scroll_to(self.first + DirectoryView.WHEEL_ROWS)
+        # The Treeview must not scroll its own rows
+        return 'break'
+
+    def bind_rows(self, sequence: str, func):
+        self.tree.bind(sequence, func, add='+')
+
+    def build_gui(self):
+        self.tree = ttk.Treeview(self, columns=(1, 2), show='headings', height=DirectoryView.VISIBLE_ROWS,
+                                 selectmode='none')
+        self.tree.heading(1, text='Name')
+        self.tree.heading(2, text='Type')
+        self.tree.place(anchor='nw', relheight='1', relwidth='0.98')
+        self.row_ids = [self.tree.insert('', 'end', values=('', '')) for _ in range(DirectoryView.VISIBLE_ROWS)]
+        for iid in self.row_ids:
+            self.tree.detach(iid)
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.tree.bind(sequence, self.on_mouse_wheel)
+
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.scrollbar.place(anchor='ne', relheight='1', relx='1')
+        self.update_scrollbar()
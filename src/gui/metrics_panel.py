@@ -0,0 +1,84 @@
+import tkinter as tk
+import tkinter.ttk as ttk
+from typing import List, Optional, Tuple
+
+from src.client.command import FSCommand
+from src.client.metrics import ClientMetrics, Histogram
+
+PRIORITY_NAMES = {
+    FSCommand.PRIORITY_INTERACTIVE: 'interactive',
+    FSCommand.PRIORITY_BACKGROUND: 'background',
+    FSCommand.PRIORITY_BULK: 'bulk',
+}
+
+
+class MetricsPanel(tk.Toplevel):
+    """
+    Window that shows the metrics of the client of the active connection, refreshed every second.
+    Helps to size timeouts and to spot bad links: retransmissions and timeouts, round-trip times and the time
+    commands wait in the queue.
+    """
+
+    REFRESH_INTERVAL = 1000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.title('Metrics')
+        self.geometry('500x400')
+        self.resizable(False, False)
+        # Scheduled refresh, cancelled when the window is closed
+        self.refresh_id = None
+        self.build_gui()
+        self.refresh()
+
+    def refresh(self):
+        client = self.master.master.client
+        self.metrics_view.delete(*self.metrics_view.get_children())
+        for name, value in MetricsPanel.rows(client.metrics if client else None):
+            self.metrics_view.insert('', tk.END, values=(name, value))
+        self.refresh_id = self.after(MetricsPanel.REFRESH_INTERVAL, self.refresh)
+
+    def destroy(self):
+        if self.refresh_id is not None:
+            self.after_cancel(self.refresh_id)
+            self.refresh_id = None
+        super().destroy()
+
+    @staticmethod
+    def rows(metrics: Optional[ClientMetrics]) -> List[Tuple[str, str]]:
+        if metrics is None:
+            return [('Not connected', '')]
+        registry = metrics.registry
+        rows = [
+            ('Server', dict(registry.labels)['server']),
+            ('Requests', str(metrics.requests.value)),
+            ('Retransmissions', str(metrics.retransmissions.value)),
+            ('Timeouts', str(metrics.timeouts.value)),
+            ('Invalid responses', str(metrics.invalid_responses.value)),
+            ('Resets', str(metrics.resets.value)),
+            ('RTT p50 / p99', MetricsPanel.percentiles(metrics.rtt)),
+            ('Request duration p50 / p99', MetricsPanel.percentiles(metrics.request_duration)),
+            ('Response processing p50 / p99', MetricsPanel.percentiles(metrics.processing)),
+        ]
+        for priority, histogram in sorted(metrics.queue_waits.items()):
+            rows.append((f'Queue wait ({PRIORITY_NAMES.get(priority, priority)}) p50 / p99',
+                         MetricsPanel.percentiles(histogram)))
+        for name, label in (('coap_client_queue_depth', 'Queue depth'), ('coap_client_in_flight', 'In flight')):
+            gauge = registry.get(name)
+            if gauge is not None:
+                rows.append((label, f'{gauge.get():.0f}'))
+        return rows
+
+    @staticmethod
+    def percentiles(histogram: Histogram) -> str:
+        if not histogram.count:
+            return '-'
+        return f'{histogram.quantile(0.5) * 1000:.1f} / {histogram.quantile(0.99) * 1000:.1f} ms'
+
+    def build_gui(self):
+        self.metrics_view = ttk.Treeview(self, columns=('metric', 'value'), show='headings', selectmode='none')
+        self.metrics_view.heading('metric', text='Metric')
+        self.metrics_view.heading('value', text='Value')
+        self.metrics_view.column('metric', width='280')
+        self.metrics_view.column('value', width='200')
+        self.metrics_view.place(anchor='nw', height='380', width='480', relx='0.02', rely='0.025')
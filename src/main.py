@@ -5,7 +5,8 @@ if __name__ == '__main__':
     my_server = TestServer('127.0.0.1', 5683)
     my_server.start()
 
-    app = AppRoot()
+    # The test server answers with scripted listings, which prefetches would use up
+    app = AppRoot(prefetch=False)
     app.mainloop()
 
     my_server.stop()
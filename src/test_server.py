@@ -1,16 +1,25 @@
 import socket
 import threading
-from typing import Iterator
+import zlib
+from typing import Dict, Iterator, Optional
 
+from src.client.block_transfer import BlockOption
 from src.client.coap_message import CoAPMessage, CoAP
+from src.client.command import BatchCommand, FSCommand
 
 
 class TestServer:
     """
-    Test server with hard-coded responses
+    Test server with hard-coded responses.
+    Large responses are sent block-wise and block-wise requests are reassembled before being answered.
+    Directory listings carry an ETag, and are answered with an empty 2.03 Valid if the client already has them.
+    Clients can observe directory listings (RFC-7641). Changed listings are pushed to their observers with notify().
+    Batch requests are answered outside of the script, with a result for every operation. The server has no
+    file system: it remembers the paths batches created and deleted, any other path can be deleted or created.
     """
     MSG_BUFFER_SIZE = 65535
     SOCK_TIMEOUT = 1
+    BLOCK_SIZE = 1024
 
     def __init__(self, ip: str, port: int):
         self.ip = ip
@@ -21,6 +30,18 @@ class TestServer:
         self.is_running = False
         self.run_thread = threading.Thread(target=self.run)
         self.responses = TestServer.gen_responses()
+        # Payloads of block-wise responses, by token (or by request payload for notifications)
+        self.downloads = {}
+        # Blocks of block-wise requests received so far, by token
+        self.uploads: Dict[int, bytes] = {}
+        # Whether paths exist after being created or deleted by a batch
+        self.batch_paths: Dict[str, bool] = {}
+        # Observers of directory listings, by token: (address, directory path, request payload)
+        self.observers = {}
+        # Message IDs of notifications sent, mapped to the token of their observer
+        self.notification_ids = {}
+        self.last_msg_id = 0
+        self.observe_sequence = 0
 
     def start(self):
         self.is_running = True
@@ -37,6 +58,15 @@ class TestServer:
             except socket.timeout:
                 continue
             msg = CoAPMessage.from_bytes(coap_bytes)
+            if msg.msg_type in (CoAP.TYPE_ACK, CoAP.TYPE_RESET):
+                self.handle_notification_reply(msg)
+                continue
+            if self.handle_block_request(msg, addr):
+                continue
+            payload = self.uploads.pop(msg.token, b'') + bytes(msg.payload_bytes)
+            if payload.startswith(FSCommand.CMD_BATCH.encode('utf-8')):
+                self.handle_batch_request(msg, payload, addr)
+                continue
             try:
                 response = next(self.responses)
             except StopIteration:
@@ -46,9 +76,17 @@ class TestServer:
             response.msg_id = msg.msg_id
             response.token_length = msg.token_length
             response.token = msg.token
+            observe = self.handle_observe_request(msg, response, addr)
+            response = TestServer.validate_listing(msg, response)
+            if observe is not None:
+                response.set_option(CoAP.OPTION_OBSERVE, observe)
+            if len(response.payload_bytes) > TestServer.BLOCK_SIZE:
+                # Response too large for a single message - send the first block
+                self.downloads[msg.token] = response
+                response = TestServer.response_block(response, BlockOption(0, True, TestServer.BLOCK_SIZE))
             print("\t\t[SENDING RESPONSE ...]")
             self.socket_inst.sendto(CoAP.wrap(response), addr)
-            if response.requires_acknowledge():
+            if response.msg_type == CoAP.TYPE_CONF:
                 # Client should send acknowledge
                 try:
                     self.socket_inst.recvfrom(TestServer.MSG_BUFFER_SIZE)
@@ -56,6 +94,168 @@ class TestServer:
                     continue
         print("\t\t[STOPED TEST SERVER]")
 
+    def handle_block_request(self, msg: CoAPMessage, addr) -> bool:
+        """
+        Answers requests that are part of a block-wise transfer without consuming the scripted responses.
+        Intermediate Block1 blocks are acknowledged with 2.31 Continue and Block2 requests are served
+        from the stored response payload.
+
+        :return: bool - True if the request was answered.
+        """
+        block1 = msg.get_option(CoAP.OPTION_BLOCK1)
+        if block1 is not None and BlockOption.from_bytes(block1).more:
+            self.uploads[msg.token] = self.uploads.get(msg.token, b'') + bytes(msg.payload_bytes)
+            response = CoAPMessage(payload='', msg_type=TestServer.response_type(msg), msg_class=CoAP.CLASS_SUCCESS,
+                                   msg_code=CoAP.CODE_CONTINUE, msg_id=msg.msg_id, token_length=msg.token_length,
+                                   token=msg.token, options=[(CoAP.OPTION_BLOCK1, block1)])
+            self.socket_inst.sendto(CoAP.wrap(response), addr)
+            return True
+        block2 = msg.get_option(CoAP.OPTION_BLOCK2)
+        download_key = msg.token if msg.token in self.downloads else bytes(msg.payload_bytes)
+        if block2 is not None and download_key in self.downloads:
+            block = BlockOption.from_bytes(block2)
+            full_response = self.downloads[download_key]
+            block.more = block.offset + block.size < len(full_response.payload_bytes)
+            if not block.more:
+                del self.downloads[download_key]
+            response = TestServer.response_block(full_response, block)
+            response.msg_id = msg.msg_id
+            response.token_length = msg.token_length
+            response.token = msg.token
+            response.remove_option(CoAP.OPTION_OBSERVE)
+            self.socket_inst.sendto(CoAP.wrap(response), addr)
+            return True
+        return False
+
+    def handle_batch_request(self, msg: CoAPMessage, payload: bytes, addr):
+        """
+        Executes the operations of a batch and answers with 2.04 Changed and the result of every operation.
+        """
+        print(f"\t\t[SERVER RECEIVED BATCH]")
+        results = []
+        for operation in payload.decode('utf-8')[1:].split('\x00'):
+            results.append(self.batch_result(operation[:1], operation[1:]))
+        options = []
+        block1 = msg.get_option(CoAP.OPTION_BLOCK1)
+        if block1 is not None:
+            options.append((CoAP.OPTION_BLOCK1, block1))
+        response = CoAPMessage(payload='\x00'.join(results), msg_type=TestServer.response_type(msg),
+                               msg_class=CoAP.CLASS_SUCCESS, msg_code=CoAP.CODE_CHANGED, msg_id=msg.msg_id,
+                               token_length=msg.token_length, token=msg.token, options=options)
+        if len(response.payload_bytes) > TestServer.BLOCK_SIZE:
+            self.downloads[msg.token] = response
+            response = TestServer.response_block(response, BlockOption(0, True, TestServer.BLOCK_SIZE))
+        self.socket_inst.sendto(CoAP.wrap(response), addr)
+
+    def batch_result(self, cmd_header: str, path: str) -> str:
+        if not path:
+            return f'{BatchCommand.RESULT_ERROR}Missing path'
+        if cmd_header == FSCommand.CMD_DEL:
+            if not self.batch_paths.get(path, True):
+                return f'{BatchCommand.RESULT_ERROR}No such file or directory'
+            self.batch_paths[path] = False
+        elif cmd_header in (FSCommand.CMD_NEWF, FSCommand.CMD_NEWD):
+            if self.batch_paths.get(path, False):
+                return f'{BatchCommand.RESULT_ERROR}Already exists'
+            self.batch_paths[path] = True
+        else:
+            return f'{BatchCommand.RESULT_ERROR}Unsupported operation'
+        return BatchCommand.RESULT_OK
+
+    def handle_observe_request(self, msg: CoAPMessage, response: CoAPMessage, addr) -> Optional[bytes]:
+        """
+        Registers or removes the observer of a directory listing.
+
+        :return: Optional[bytes] - the Observe option value confirming the registration, None if there is none.
+        """
+        observe = msg.options.get_uint(CoAP.OPTION_OBSERVE)
+        if observe == CoAP.OBSERVE_DEREGISTER:
+            self.observers.pop(msg.token, None)
+        elif observe == CoAP.OBSERVE_REGISTER and response.msg_class == CoAP.CLASS_SUCCESS:
+            path = TestServer.listing_path(response.payload_bytes)
+            if path is not None:
+                self.observers[msg.token] = (addr, path, bytes(msg.payload_bytes))
+                return self.next_observe_sequence()
+        return None
+
+    def handle_notification_reply(self, msg: CoAPMessage):
+        """
+        An observer that answers a notification with a Reset is no longer interested in it.
+        """
+        token = self.notification_ids.pop(msg.msg_id, None)
+        if msg.msg_type == CoAP.TYPE_RESET and token is not None:
+            print(f"\t\t[OBSERVER REMOVED]")
+            self.observers.pop(token, None)
+
+    def notify(self, listing: str, confirmable: bool = False):
+        """
+        Sends a changed directory listing to every observer of the directory.
+
+        :param listing: The encoded listing, in the same format as the responses to OPEN.
+        :param confirmable: Whether the notifications must be acknowledged by the observers.
+        """
+        payload = listing.encode('utf-8')
+        path = TestServer.listing_path(payload)
+        etag = zlib.crc32(payload).to_bytes(4, 'big')
+        for token, (addr, observed_path, request_payload) in list(self.observers.items()):
+            if observed_path != path:
+                continue
+            self.last_msg_id = (self.last_msg_id + 1) & 0xFFFF
+            msg_type = CoAP.TYPE_CONF if confirmable else CoAP.TYPE_NON_CONF
+            notification = CoAPMessage(payload=payload, msg_type=msg_type, msg_class=CoAP.CLASS_SUCCESS,
+                                       msg_code=CoAP.CODE_CONTENT, msg_id=self.last_msg_id,
+                                       token_length=CoAP.token_length(token), token=token,
+                                       options=[(CoAP.OPTION_ETAG, etag),
+                                                (CoAP.OPTION_OBSERVE, self.next_observe_sequence())])
+            if len(payload) > TestServer.BLOCK_SIZE:
+                # The remaining blocks are requested without the token of the observation
+                self.downloads[request_payload] = notification
+                notification = TestServer.response_block(notification, BlockOption(0, True, TestServer.BLOCK_SIZE))
+            self.notification_ids[self.last_msg_id] = token
+            print(f"\t\t[SENDING NOTIFICATION ...]")
+            self.socket_inst.sendto(CoAP.wrap(notification), addr)
+
+    def next_observe_sequence(self) -> bytes:
+        self.observe_sequence = (self.observe_sequence + 1) & 0xFFFFFF
+        return CoAP.encode_uint(self.observe_sequence)
+
+    @staticmethod
+    def listing_path(payload: bytes) -> Optional[bytes]:
+        if not payload.startswith(b'd'):
+            return None
+        return bytes(payload[1:]).split(b'\x00', 1)[0]
+
+    @staticmethod
+    def validate_listing(msg: CoAPMessage, response: CoAPMessage) -> CoAPMessage:
+        """
+        Tags directory listings with an ETag. If the request carries the same ETag, the listing is replaced
+        with an empty 2.03 Valid response.
+        """
+        if response.msg_class != CoAP.CLASS_SUCCESS or not response.payload_bytes.startswith(b'd'):
+            return response
+        etag = zlib.crc32(response.payload_bytes).to_bytes(4, 'big')
+        response.set_option(CoAP.OPTION_ETAG, etag)
+        if etag not in msg.options.get_all(CoAP.OPTION_ETAG):
+            return response
+        return CoAPMessage(payload='', msg_type=response.msg_type, msg_class=CoAP.CLASS_SUCCESS,
+                           msg_code=CoAP.CODE_VALID, msg_id=response.msg_id, token_length=response.token_length,
+                           token=response.token, options=[(CoAP.OPTION_ETAG, etag)])
+
+    @staticmethod
+    def response_block(response: CoAPMessage, block: BlockOption) -> CoAPMessage:
+        payload = response.payload_bytes[block.offset:block.offset + block.size]
+        options = response.options.copy()
+        options.set(CoAP.OPTION_BLOCK2, block.to_bytes())
+        if block.num == 0:
+            options.set(CoAP.OPTION_SIZE2, CoAP.encode_uint(len(response.payload_bytes)))
+        return CoAPMessage(payload=payload, msg_type=response.msg_type, msg_class=response.msg_class,
+                           msg_code=response.msg_code, msg_id=response.msg_id, token_length=response.token_length,
+                           token=response.token, options=options)
+
+    @staticmethod
+    def response_type(msg: CoAPMessage) -> int:
+        return CoAP.TYPE_ACK if msg.msg_type == CoAP.TYPE_CONF else CoAP.TYPE_NON_CONF
+
     @staticmethod
     def gen_responses() -> Iterator[CoAPMessage]:
         # Scenario
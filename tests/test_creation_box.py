@@ -0,0 +1,40 @@
+import unittest
+
+from src.client.command import BatchCommand, FSCommand, NewDirCommand, NewFileCommand
+from src.gui.creation_box import CreationBox
+
+
+class FakeBrowserPage:
+    current_dir_path = '/docs'
+
+
+def creation_box(is_file: bool) -> CreationBox:
+    # The command is built without opening the window
+    box = CreationBox.__new__(CreationBox)
+    box.master = FakeBrowserPage()
+    box.is_file = is_file
+    return box
+
+
+class CreationBoxTest(unittest.TestCase):
+    def test_name_with_commas_creates_one_component(self):
+        names = CreationBox.names('report, final,v2.txt\n')
+        cmd = creation_box(is_file=True).create_command(names)
+        self.assertEqual(names, ['report, final,v2.txt'])
+        self.assertIsInstance(cmd, NewFileCommand)
+        self.assertEqual(cmd.coap_payload, FSCommand.CMD_NEWF + '/docs/report, final,v2.txt')
+
+    def test_directory_name_with_commas_creates_one_directory(self):
+        cmd = creation_box(is_file=False).create_command(CreationBox.names('a,b'))
+        self.assertIsInstance(cmd, NewDirCommand)
+        self.assertEqual(cmd.coap_payload, FSCommand.CMD_NEWD + '/docs/a,b')
+
+    def test_one_name_per_line_creates_a_batch(self):
+        names = CreationBox.names('a,b\n\n  c  \n')
+        cmd = creation_box(is_file=True).create_command(names)
+        self.assertEqual(names, ['a,b', 'c'])
+        self.assertIsInstance(cmd, BatchCommand)
+
+
+if __name__ == '__main__':
+    unittest.main()